@@ -0,0 +1,74 @@
+# gunicorn config สำหรับ production — ใช้แทน app.run(threaded=True) ของ Flask dev server
+#   gunicorn -c gunicorn.conf.py main:app
+#
+# ขนาดตั้งไว้สำหรับเครื่อง 1 GB (Railway / Fly shared-cpu-1x):
+#   1 worker process (~150 MB หลัง preload) + soffice 1 ตัว (~200 MB) + เผื่อ PDF/ภาพระหว่าง render
+#   state ที่อยู่ใน memory (job queue, Idempotency-Key, render/text cache) เป็นของแต่ละ process
+#   ถ้าเพิ่ม GUNICORN_WORKERS ต้องมี RAM ให้ soffice ของทุก worker และ /jobs/<id> ต้องกลับมา process เดิม
+import os
+import threading
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", "1"))
+# thread ต่อ worker: งาน LibreOffice เข้าคิวของ SofficePool อยู่แล้ว ส่วนที่เหลือ (PyMuPDF/PIL) ติด GIL
+# มากกว่านี้ไม่ได้เร็วขึ้น แค่ถือ PDF ค้างใน memory พร้อมกันมากขึ้น
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+# connection ที่รอ accept — เกินนี้ client ได้ connection refused (failover ไป host สำรองได้ทันที ไม่ต้องรอ timeout)
+backlog = int(os.environ.get("GUNICORN_BACKLOG", "64"))
+
+# โหลด app (template, ฟอนต์, archive ของ renderer ตรง) ครั้งเดียวใน master แล้ว fork — worker ใหม่พร้อมทันที
+preload_app = True
+
+# recycle worker หลัง N request กัน memory โตจาก fragmentation ของ PyMuPDF/PIL (jitter กันทุกตัว restart พร้อมกัน)
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "500"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "50"))
+
+# SOFFICE_CONVERT_TIMEOUT (120 s) + เผื่อ — request ที่ค้างนานกว่านี้ worker ถูก kill แล้ว fork ใหม่
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "180"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "60"))
+keepalive = 5
+# heartbeat ของ worker อยู่บน tmpfs (disk ของ container อาจช้า/เต็ม)
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+accesslog = "-"
+errorlog = "-"
+
+
+def on_starting(server):
+    import main
+    main.preload_resources()
+
+
+def pre_fork(server, worker):
+    # ให้แต่ละ worker มี slot คงที่ (0..workers-1) สำหรับแยก port/profile ของ soffice
+    used = {getattr(w, "slot", None) for w in server.WORKERS.values()}
+    worker.slot = next(i for i in range(len(used) + 1) if i not in used)
+
+
+def post_fork(server, worker):
+    import main
+    offset = 2 * max(1, main.SOFFICE_POOL_SIZE) * worker.slot
+    main.SOFFICE_DAEMON_PORT += offset
+    main.SOFFICE_DAEMON_UNO_PORT += offset
+    main.SOFFICE_PROFILE_ROOT = os.path.join(main.SOFFICE_PROFILE_ROOT, f"gunicorn-{worker.slot}")
+    # soffice เป็น process + thread ของ worker เอง (fork ไม่พาไปด้วย) — อุ่นแบบ background
+    threading.Thread(target=main.get_soffice_pool, daemon=True).start()
+    # process pool ของภาพลายเซ็นก็เช่นกัน (start forkserver ~1-2 s) ไม่ให้ request แรกต้องรอ
+    threading.Thread(target=_warm_signature_pool, args=(main,), daemon=True).start()
+
+
+def _warm_signature_pool(main):
+    pool = main.get_signature_pool()
+    if pool is not None:
+        for f in [pool.submit(int) for _ in range(main.SIGNATURE_POOL_WORKERS)]:
+            f.result()
+
+
+def worker_exit(server, worker):
+    # ตอน recycle/restart: job และผลของ /jobs, Idempotency-Key อยู่ใน memory ของ process นี้
+    # process ใหม่ดึงผลเหล่านี้ไม่ได้ (client ได้ 404 แล้ว submit ใหม่) — ไม่ทำงานที่ค้างต่อให้เสียเปล่า
+    # ปิดคิว ทิ้งงานที่ยังไม่เริ่ม และลบไฟล์ผลใน JOB_RESULT_DIR ไม่ให้ค้างใน /tmp
+    import main
+    main.discard_spooled_results()
@@ -1,16 +1,39 @@
 import subprocess
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Request, request, send_file, jsonify, has_request_context, g
 from docxtpl import DocxTemplate
+from docx import Document
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 import os
 import tempfile
 import fitz  # PyMuPDF
-from PIL import Image
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 import io
 import json
+import math
+import html
+import re
+import zipfile
+import collections
+import concurrent.futures
+import copy
+import functools
+import hashlib
 import traceback
+import atexit
+import queue
+import socket
+import threading
+import time
+import urllib.parse
+import uuid
+import xmlrpc.client
+import jinja2
+import multiprocessing
 from flask_cors import CORS
 import jwt
+from werkzeug.test import EnvironBuilder
+from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -40,8 +63,223 @@ def verify_supabase_jwt():
     except jwt.InvalidTokenError:
         return jsonify({"error": "Invalid token"}), 401
 
-# --- ฟังก์ชันแปลง docx → pdf ด้วย LibreOffice ---
-def convert_docx_to_pdf(docx_path, output_pdf_path):
+# --- LibreOffice daemon (unoserver) สำหรับแปลง docx → pdf แบบ warm ---
+# เดิมทุก /pdf, /2in1memo spawn `libreoffice --headless --convert-to pdf` ใหม่ทุกครั้ง
+# เสีย cold start หลายวินาทีต่อ memo (หนักสุดบนเครื่อง shared-cpu 1 GB)
+# ตอนนี้เปิด soffice ค้างไว้ผ่าน unoserver (XML-RPC บน localhost) แล้วส่งงานเข้าไป
+# จำนวน worker ตั้งได้ด้วย SOFFICE_POOL_SIZE (soffice 1 ตัวกิน RAM ~200 MB — เครื่อง 1 GB ใช้ 1-2)
+# ถ้า daemon ใช้ไม่ได้ (เช่น local dev ไม่มี unoserver) จะ fallback ไปวิธีเดิมอัตโนมัติ
+SOFFICE_DAEMON_ENABLED = os.environ.get("SOFFICE_DAEMON", "1") == "1"
+UNOSERVER_PYTHON = os.environ.get("UNOSERVER_PYTHON", "/usr/bin/python3")
+SOFFICE_DAEMON_PORT = int(os.environ.get("SOFFICE_DAEMON_PORT", "2003"))
+SOFFICE_DAEMON_UNO_PORT = int(os.environ.get("SOFFICE_DAEMON_UNO_PORT", "2002"))
+SOFFICE_POOL_SIZE = int(os.environ.get("SOFFICE_POOL_SIZE", "1"))
+SOFFICE_PROFILE_ROOT = os.environ.get("SOFFICE_PROFILE_ROOT", os.path.join(tempfile.gettempdir(), "soffice-profiles"))
+SOFFICE_QUEUE_TIMEOUT = float(os.environ.get("SOFFICE_QUEUE_TIMEOUT", "60"))
+SOFFICE_STARTUP_TIMEOUT = float(os.environ.get("SOFFICE_STARTUP_TIMEOUT", "60"))
+SOFFICE_CONVERT_TIMEOUT = float(os.environ.get("SOFFICE_CONVERT_TIMEOUT", "120"))
+SOFFICE_HEALTH_INTERVAL = float(os.environ.get("SOFFICE_HEALTH_INTERVAL", "15"))
+# start ไม่ขึ้น (เช่นไม่ได้ติดตั้ง unoserver) → รอ backoff ก่อนลองใหม่ ไม่ให้ทุก request เสียเวลา spawn ซ้ำ
+SOFFICE_RETRY_BACKOFF = float(os.environ.get("SOFFICE_RETRY_BACKOFF", "60"))
+
+
+class _TimeoutTransport(xmlrpc.client.Transport):
+    """xmlrpc Transport ที่มี socket timeout (ของเดิมรอได้ไม่จำกัด)"""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self._timeout = timeout
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self._timeout
+        return conn
+
+
+class SofficeDaemon:
+    """soffice ที่รันค้างไว้ผ่าน unoserver — start ครั้งเดียวแล้ว reuse ทุก conversion
+
+    - start() เปิด process แล้วรอจน XML-RPC port ตอบ
+    - is_healthy() เช็คว่า process ยังอยู่และ port ยังรับ connection
+    - convert() ส่งไฟล์ให้ daemon แปลง ถ้าพัง raise ให้ caller (SofficePool) restart/fallback
+    """
+
+    def __init__(self, port=SOFFICE_DAEMON_PORT, uno_port=SOFFICE_DAEMON_UNO_PORT, user_installation=None):
+        self.port = port
+        self.uno_port = uno_port
+        self.user_installation = user_installation
+        self.proc = None
+        self.lock = threading.Lock()
+        self.retry_after = 0.0
+
+    def _cmd(self):
+        cmd = [
+            UNOSERVER_PYTHON, "-m", "unoserver.server",
+            "--interface", "127.0.0.1",
+            "--port", str(self.port),
+            "--uno-port", str(self.uno_port),
+        ]
+        if self.user_installation:
+            cmd += ["--user-installation", self.user_installation]
+        return cmd
+
+    def _port_open(self):
+        try:
+            with socket.create_connection(("127.0.0.1", self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def is_healthy(self):
+        return self.proc is not None and self.proc.poll() is None and self._port_open()
+
+    def start(self):
+        with self.lock:
+            if self.is_healthy():
+                return True
+            if time.monotonic() < self.retry_after:
+                return False
+            self._stop_locked()
+            if not self._start_locked():
+                self.retry_after = time.monotonic() + SOFFICE_RETRY_BACKOFF
+                return False
+            return True
+
+    def _start_locked(self):
+        try:
+            self.proc = subprocess.Popen(self._cmd(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            print(f"soffice daemon start failed: {e}")
+            self.proc = None
+            return False
+        deadline = time.monotonic() + SOFFICE_STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                print(f"soffice daemon exited during startup (returncode={self.proc.returncode})")
+                self.proc = None
+                return False
+            if self._port_open():
+                print(f"soffice daemon ready on port {self.port} (pid={self.proc.pid})")
+                return True
+            time.sleep(0.25)
+        print("soffice daemon startup timed out")
+        self._stop_locked()
+        return False
+
+    def _stop_locked(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.proc = None
+
+    def stop(self):
+        with self.lock:
+            self._stop_locked()
+
+    def restart(self):
+        self.stop()
+        self.retry_after = 0.0
+        return self.start()
+
+    def convert(self, docx_path, output_pdf_path):
+        if not self.is_healthy() and not self.start():
+            raise RuntimeError("soffice daemon unavailable")
+        proxy = xmlrpc.client.ServerProxy(
+            f"http://127.0.0.1:{self.port}",
+            transport=_TimeoutTransport(SOFFICE_CONVERT_TIMEOUT),
+            allow_none=True,
+        )
+        # ลำดับ argument ตาม unoserver.server.convert:
+        # (inpath, indata, outpath, convert_to, filtername, filter_options, update_index, infiltername)
+        proxy.convert(os.path.abspath(docx_path), None, os.path.abspath(output_pdf_path), "pdf", None, [], True, None)
+        if not os.path.exists(output_pdf_path) or os.path.getsize(output_pdf_path) == 0:
+            raise RuntimeError(f"soffice daemon produced no output for {docx_path}")
+
+
+class SofficePool:
+    """pool ของ SofficeDaemon N ตัว แต่ละตัวมี user profile (-env:UserInstallation) แยกกัน
+
+    เดิม soffice ทุกตัวใช้ profile default ร่วมกัน request ที่มาพร้อมกันจึงแย่ง profile lock
+    (แปลงทีละงานหรือพังไปเลย) — ตอนนี้แต่ละ worker มี profile + port ของตัวเอง
+    งานเข้าคิว (idle queue) แล้วได้ worker ว่างตัวแรก จึงแปลงขนานกันได้ตามจำนวน worker
+    """
+
+    def __init__(self, size=SOFFICE_POOL_SIZE, profile_root=SOFFICE_PROFILE_ROOT):
+        self.workers = [
+            SofficeDaemon(
+                port=SOFFICE_DAEMON_PORT + 2 * i,
+                uno_port=SOFFICE_DAEMON_UNO_PORT + 2 * i,
+                user_installation=os.path.join(profile_root, f"worker-{i}"),
+            )
+            for i in range(max(1, size))
+        ]
+        self.idle = queue.Queue()
+        for w in self.workers:
+            self.idle.put(w)
+
+    def start(self):
+        # start พร้อมกันทุกตัว — soffice แต่ละตัวใช้เวลา boot หลายวินาที
+        threads = [threading.Thread(target=w.start, daemon=True) for w in self.workers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def stop(self):
+        for w in self.workers:
+            w.stop()
+
+    def convert(self, docx_path, output_pdf_path):
+        try:
+            worker = self.idle.get(timeout=SOFFICE_QUEUE_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError(f"no idle soffice worker after {SOFFICE_QUEUE_TIMEOUT}s")
+        try:
+            worker.convert(docx_path, output_pdf_path)
+        except Exception:
+            # worker ค้าง/ตาย — restart แบบ background (convert ถัดไปบน worker นี้จะรอ lock จน start เสร็จ)
+            if worker.proc is not None:
+                threading.Thread(target=worker.restart, daemon=True).start()
+            raise
+        finally:
+            self.idle.put(worker)
+
+
+_soffice_pool = None
+_soffice_pool_lock = threading.Lock()
+
+
+def get_soffice_pool():
+    """คืน pool ตัวเดียวของ process (start ตอนเรียกครั้งแรก) — None ถ้าปิดไว้"""
+    global _soffice_pool
+    if not SOFFICE_DAEMON_ENABLED:
+        return None
+    with _soffice_pool_lock:
+        if _soffice_pool is None:
+            # อ่านค่า config ตอนสร้าง (gunicorn post_fork อาจเลื่อน port/profile ให้แต่ละ worker process)
+            _soffice_pool = SofficePool(SOFFICE_POOL_SIZE, SOFFICE_PROFILE_ROOT)
+            atexit.register(_soffice_pool.stop)
+            _soffice_pool.start()
+            threading.Thread(target=_soffice_health_loop, args=(_soffice_pool,), daemon=True).start()
+        return _soffice_pool
+
+
+def _soffice_health_loop(pool):
+    """health check เป็นระยะ — ถ้า soffice ตัวไหนตาย (OOM kill ฯลฯ) ให้ start ใหม่ก่อน request ถัดไปจะมาเจอ"""
+    while True:
+        time.sleep(SOFFICE_HEALTH_INTERVAL)
+        for daemon in pool.workers:
+            if not daemon.is_healthy() and time.monotonic() >= daemon.retry_after:
+                print(f"soffice daemon on port {daemon.port} unhealthy, restarting...")
+                daemon.start()
+
+
+def _convert_docx_to_pdf_cold(docx_path, output_pdf_path):
     cmd = [
         "libreoffice",
         "--headless",
@@ -52,6 +290,19 @@ def convert_docx_to_pdf(docx_path, output_pdf_path):
     subprocess.run(cmd, check=True)
 
 
+# --- ฟังก์ชันแปลง docx → pdf ด้วย LibreOffice ---
+def convert_docx_to_pdf(docx_path, output_pdf_path):
+    pool = get_soffice_pool()
+    if pool is not None:
+        try:
+            pool.convert(docx_path, output_pdf_path)
+            return
+        except Exception as e:
+            # แปลงรอบนี้ด้วยวิธีเดิมไปก่อน (worker ที่พังถูก restart แบบ background แล้ว)
+            print(f"soffice daemon convert failed (falling back to cold start): {e}")
+    _convert_docx_to_pdf_cold(docx_path, output_pdf_path)
+
+
 # --- ฟังก์ชัน compress PDF lossless ด้วย qpdf ---
 # PyMuPDF เวลา rasterize หน้าใหม่ + ใส่ลายเซ็น ทิ้ง orphan objects เยอะ ทำให้ไฟล์
 # โตเรื่อยๆ ทุกรอบที่ผ่าน sign (empirical: 0.3 MB → 6.7 MB สำหรับ 12-page input).
@@ -60,8 +311,12 @@ def convert_docx_to_pdf(docx_path, output_pdf_path):
 def compress_pdf_inplace(pdf_path, *, timeout_sec=30):
     """Compress a PDF lossless via qpdf. If qpdf fails for any reason, the file
     at pdf_path is left untouched so the sign flow doesn't break."""
-    out_path = pdf_path + ".qpdf.tmp"
+    out_path = None
     try:
+        # ชื่อ temp ไม่ซ้ำต่อการเรียก (ไฟล์เดียวกันถูก compress พร้อมกันได้) และอยู่ directory เดียวกัน → os.replace เป็น atomic
+        fd, out_path = tempfile.mkstemp(dir=os.path.dirname(pdf_path) or ".",
+                                        prefix=os.path.basename(pdf_path) + ".", suffix=".qpdf.tmp")
+        os.close(fd)
         result = subprocess.run(
             [
                 "qpdf",
@@ -83,12 +338,394 @@ def compress_pdf_inplace(pdf_path, *, timeout_sec=30):
                 os.unlink(out_path)
     except (FileNotFoundError, subprocess.TimeoutExpired, OSError) as e:
         print(f"qpdf compress error (using original): {e}")
-        if os.path.exists(out_path):
+        if out_path and os.path.exists(out_path):
             try:
                 os.unlink(out_path)
             except OSError:
                 pass
 
+
+# --- save PDF แบบ optimize ในตัว (แทน qpdf subprocess) ---
+# เดิม save ครั้งหนึ่งแล้ว fork qpdf เขียนไฟล์ใหม่อีกรอบ ตอนนี้ให้ MuPDF ทำในการ save ครั้งเดียว:
+# garbage=4 (ลบ orphan objects + รวม stream ที่ซ้ำกัน เช่นภาพลายเซ็นเดียวกันหลายหน้า),
+# deflate ทุก stream/ภาพ/ฟอนต์ และ object streams — qpdf ใช้เป็น fallback เมื่อ save แบบนี้ล้มเหลว
+# PDF_OPTIMIZER: pymupdf (default) | qpdf (save ธรรมดา + qpdf แบบเดิม)
+PDF_OPTIMIZER = os.environ.get("PDF_OPTIMIZER", "pymupdf").strip().lower()
+PDF_SAVE_OPTIONS = dict(garbage=4, deflate=True, deflate_images=True, deflate_fonts=True, use_objstms=1)
+
+
+# --- นโยบาย compress: ส่ง qpdf เฉพาะเอกสารที่น่าจะคุ้ม ---
+# qpdf (PDF_OPTIMIZER=qpdf หรือ fallback) กิน thread ของ request ได้ถึง 30 s
+# ข้ามเมื่อ: ไฟล์เล็ก + object น้อย, ไฟล์แทบไม่โตจาก input (เช่น /receive_num2 ที่แปะภาพเล็กๆ),
+# หรือประวัติของ endpoint นั้นประหยัดได้ไม่ถึงเกณฑ์ (ยังสุ่มลองทุก PDF_COMPRESS_PROBE_EVERY ครั้งเพื่ออัพเดตประวัติ)
+# PDF_COMPRESS_ASYNC=1: ไฟล์ที่เก็บต่อหลังตอบ (render cache) ให้ qpdf ทำ background หลังส่ง response
+PDF_COMPRESS_MIN_BYTES = int(os.environ.get("PDF_COMPRESS_MIN_BYTES", str(256 * 1024)))
+PDF_COMPRESS_MIN_OBJECTS = int(os.environ.get("PDF_COMPRESS_MIN_OBJECTS", "500"))
+PDF_COMPRESS_MIN_GROWTH = float(os.environ.get("PDF_COMPRESS_MIN_GROWTH", "1.2"))
+PDF_COMPRESS_MIN_SAVING = float(os.environ.get("PDF_COMPRESS_MIN_SAVING", "0.05"))
+PDF_COMPRESS_HISTORY = int(os.environ.get("PDF_COMPRESS_HISTORY", "20"))
+PDF_COMPRESS_PROBE_EVERY = int(os.environ.get("PDF_COMPRESS_PROBE_EVERY", "10"))
+PDF_COMPRESS_ASYNC = os.environ.get("PDF_COMPRESS_ASYNC", "0") == "1"
+
+
+class CompressionPolicy:
+    """ตัดสินต่อเอกสารว่าจะส่ง qpdf ไหม + เก็บ metrics ของการตัดสินใจและที่ประหยัดได้"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.savings = collections.defaultdict(lambda: collections.deque(maxlen=PDF_COMPRESS_HISTORY))
+        self.skipped = collections.Counter()
+        self.metrics = collections.defaultdict(lambda: {"bytes_in": 0, "bytes_out": 0, "ms": 0.0})
+        self.decisions = collections.Counter()
+        self.in_flight = set()  # path ที่ compress_async กำลังทำอยู่
+
+    def decide(self, endpoint, size, input_size, object_count):
+        if size < PDF_COMPRESS_MIN_BYTES and object_count < PDF_COMPRESS_MIN_OBJECTS:
+            return "skip-small"
+        if input_size and size < input_size * PDF_COMPRESS_MIN_GROWTH:
+            return "skip-no-growth"
+        with self.lock:
+            history = self.savings[endpoint]
+            if len(history) >= 3 and sum(history) / len(history) < PDF_COMPRESS_MIN_SAVING:
+                self.skipped[endpoint] += 1
+                if self.skipped[endpoint] % PDF_COMPRESS_PROBE_EVERY:
+                    return "skip-history"
+        return "qpdf"
+
+    def record(self, endpoint, decision, size_before, size_after, elapsed):
+        with self.lock:
+            self.decisions[(endpoint, decision)] += 1
+            m = self.metrics[endpoint]
+            m["bytes_in"] += size_before
+            m["bytes_out"] += size_after
+            m["ms"] += elapsed * 1000
+            if decision.startswith("qpdf") and size_before:
+                self.savings[endpoint].append(1 - size_after / size_before)
+
+    def compress(self, endpoint, pdf_path, decision="qpdf"):
+        size_before = os.path.getsize(pdf_path)
+        t0 = time.perf_counter()
+        compress_pdf_inplace(pdf_path)
+        self.record(endpoint, decision, size_before, os.path.getsize(pdf_path), time.perf_counter() - t0)
+
+    def compress_bytes(self, endpoint, data):
+        """qpdf ต้องการ path — ใช้ไฟล์ชั่วคราวแล้วลบทิ้งเสมอ"""
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_pdf:
+            tmp_pdf.write(data)
+        try:
+            self.compress(endpoint, tmp_pdf.name)
+            with open(tmp_pdf.name, "rb") as f:
+                return f.read()
+        finally:
+            os.unlink(tmp_pdf.name)
+
+    def compress_async(self, endpoint, pdf_path):
+        """qpdf แบบ background — path เดียวกันทำทีละงาน (ถ้ากำลังทำอยู่ งานที่ค้างอยู่ได้ผลเดียวกันอยู่แล้ว)"""
+        with self.lock:
+            if pdf_path in self.in_flight:
+                return
+            self.in_flight.add(pdf_path)
+        threading.Thread(target=self._compress_background, args=(endpoint, pdf_path), daemon=True).start()
+
+    def _compress_background(self, endpoint, pdf_path):
+        try:
+            self.compress(endpoint, pdf_path, "qpdf-async")
+        except OSError as e:
+            # ไฟล์ถูก evict ออกจาก cache ระหว่างรอ
+            print(f"qpdf async compress skipped: {e}")
+        finally:
+            with self.lock:
+                self.in_flight.discard(pdf_path)
+
+    def stats(self):
+        with self.lock:
+            out = {}
+            for endpoint, m in self.metrics.items():
+                history = self.savings[endpoint]
+                out[endpoint] = {
+                    "bytes_in": m["bytes_in"],
+                    "bytes_out": m["bytes_out"],
+                    "ms": round(m["ms"], 1),
+                    "avg_qpdf_saving": round(sum(history) / len(history), 3) if history else None,
+                    "decisions": {d: n for (e, d), n in self.decisions.items() if e == endpoint},
+                }
+            return out
+
+
+compression_policy = CompressionPolicy()
+
+
+# --- บันทึกแบบ incremental update (ต่อท้ายไฟล์เดิม) ---
+# เอกสารสแกนขนาดใหญ่ (เช่น 30 MB) ผ่านหลายขั้นอนุมัติ แต่ละขั้นแค่วางตรา/ลายเซ็นหน้าเดียว
+# เดิม tobytes(garbage=4, deflate...) serialize + deflate ใหม่ทั้งไฟล์ทุกครั้ง → เวลาตามขนาดเอกสาร
+# incremental: คง bytes เดิมทุกตัว แล้วต่อท้ายเฉพาะ object ที่เปลี่ยน + xref ใหม่ → เวลาตามขนาด overlay
+# ใช้ได้กับเอกสารที่เปิดจากไฟล์ที่ upload (bytes หรือไฟล์ที่ spool) และไม่ได้ flatten หน้าไหน
+# (flatten = object ใหม่ทั้งหน้า + หน้าเดิมค้างเป็นขยะในไฟล์) — เอกสารที่สร้างใหม่ (2in1, merge, A4) ใช้ full เสมอ
+# PDF_INCREMENTAL: auto (default — เมื่อเอกสารเดิม >= PDF_INCREMENTAL_MIN_BYTES) | always | never
+# เลือกต่อ request ด้วย ?save_mode=incremental|full หรือ form field save_mode
+PDF_INCREMENTAL = os.environ.get("PDF_INCREMENTAL", "auto").strip().lower()
+PDF_INCREMENTAL_MIN_BYTES = int(os.environ.get("PDF_INCREMENTAL_MIN_BYTES", str(4 * 1024 * 1024)))
+
+
+def use_incremental_save(doc):
+    mode = PDF_INCREMENTAL
+    if has_request_context():
+        requested = str(request.args.get("save_mode") or request.form.get("save_mode") or "").strip().lower()
+        mode = {"incremental": "always", "full": "never"}.get(requested, mode)
+    source_size = pdf_source_size(doc)
+    if mode == "never" or not source_size or getattr(doc, "flattened", False):
+        return False
+    if not doc.can_save_incrementally():
+        return False
+    return mode == "always" or source_size >= PDF_INCREMENTAL_MIN_BYTES
+
+
+def incremental_pdf_bytes(doc):
+    """bytes เดิมของ doc + incremental update ต่อท้าย (mupdf เขียน bytes เดิมให้เองก่อน)"""
+    buf = fitz.mupdf.FzBuffer(pdf_source_size(doc) + 65536)
+    out = fitz.mupdf.FzOutput(buf)
+    opts = fitz.mupdf.PdfWriteOptions()
+    opts.do_incremental = 1
+    # stream ใหม่ (ภาพ/ข้อความ/font ของ overlay) deflate เหมือน PDF_SAVE_OPTIONS — garbage ใช้ไม่ได้ในโหมดนี้
+    opts.do_compress = 1
+    opts.do_compress_images = 1
+    opts.do_compress_fonts = 1
+    fitz.mupdf.pdf_write_document(fitz.mupdf.pdf_specifics(doc.this), out, opts)
+    out.fz_close_output()
+    return buf.fz_buffer_extract()
+
+
+def incremental_pdf_file(doc):
+    """เหมือน incremental_pdf_bytes แต่เขียนลงไฟล์ชั่วคราว (ลบเองเมื่อปิด) — คืน file object ที่ seek(0) แล้ว"""
+    out_file = tempfile.NamedTemporaryFile("w+b", dir=UPLOAD_SPOOL_DIR, prefix="result-", suffix=".pdf")
+    try:
+        # append=1: ไฟล์ว่างอยู่แล้ว และ MuPDF ไม่ลบ/สร้างไฟล์ใหม่ (fd ของ out_file ยังชี้ไฟล์เดียวกัน)
+        out = fitz.mupdf.FzOutput(out_file.name, 1)
+        opts = fitz.mupdf.PdfWriteOptions()
+        opts.do_incremental = 1
+        opts.do_compress = 1
+        opts.do_compress_images = 1
+        opts.do_compress_fonts = 1
+        fitz.mupdf.pdf_write_document(fitz.mupdf.pdf_specifics(doc.this), out, opts)
+        out.fz_close_output()
+    except Exception:
+        out_file.close()
+        raise
+    out_file.seek(0)
+    return out_file
+
+
+def save_pdf_bytes(doc, *, defer=False):
+    """serialize doc เป็น bytes พร้อม compress lossless — คืน (data, การตัดสินใจ)
+    การตัดสินใจ: incremental | inprocess | qpdf | skip-* | deferred — defer=True: ถ้าต้อง qpdf ให้ caller
+    เรียก compression_policy.compress_async เองกับไฟล์ที่เก็บต่อ (เมื่อเปิด PDF_COMPRESS_ASYNC)"""
+    endpoint = request.endpoint if has_request_context() else None
+    endpoint = endpoint or "-"
+    if use_incremental_save(doc):
+        try:
+            t0 = time.perf_counter()
+            data = incremental_pdf_bytes(doc)
+            compression_policy.record(endpoint, "incremental", len(data), len(data), time.perf_counter() - t0)
+            return data, "incremental"
+        except Exception as e:
+            print(f"incremental PDF save failed (falling back to full save): {e}")
+    input_size = request.content_length if has_request_context() else None
+    object_count = doc.xref_length()
+    if PDF_OPTIMIZER != "qpdf":
+        try:
+            t0 = time.perf_counter()
+            data = doc.tobytes(**PDF_SAVE_OPTIONS)
+            compression_policy.record(endpoint, "inprocess", len(data), len(data), time.perf_counter() - t0)
+            return data, "inprocess"
+        except Exception as e:
+            print(f"in-process PDF optimise failed (falling back to qpdf): {e}")
+    data = doc.tobytes()
+    decision = compression_policy.decide(endpoint, len(data), input_size, object_count)
+    if decision != "qpdf":
+        compression_policy.record(endpoint, decision, len(data), len(data), 0)
+    elif defer and PDF_COMPRESS_ASYNC:
+        decision = "deferred"
+    else:
+        data = compression_policy.compress_bytes(endpoint, data)
+    return data, decision
+
+
+# --- upload ขนาดใหญ่: spool ลง disk แล้วให้ MuPDF เปิดจาก path ---
+# เดิมทุก route ทำ request.files['pdf'].read() → bytes ทั้งไฟล์ใน Python แล้ว fitz.open(stream=) ถือไว้ตลอด request
+# (/PDFmerge ถือ input 2 ไฟล์ + ผลรวมพร้อมกัน) — เครื่อง 1 GB โดน OOM kill เมื่อมีสแกนใหญ่ 2-3 ไฟล์พร้อมกัน
+# ตอนนี้แต่ละไฟล์ใน form ที่ใหญ่กว่า UPLOAD_SPOOL_MAX_BYTES เขียนลง UPLOAD_SPOOL_DIR ตอน parse form
+# (ตัดสินต่อ part — PNG ลายเซ็นเล็กๆ ใน request ที่มีสแกนใหญ่ยังอยู่ใน memory)
+# แล้ว open_upload_pdf เปิดจาก path — MuPDF อ่านเฉพาะ object ที่ใช้ผ่าน buffer เล็กๆ ของตัวเอง
+# (PyMuPDF ไม่รับ mmap เป็น stream — เปิดจาก path ได้ผลเดียวกันโดย page cache ของ OS)
+# ไฟล์ถูกลบเมื่อ request ปิด (หรือ process ตาย — ลบชื่อทิ้งได้ทันทีเพราะ MuPDF ถือ fd ของตัวเอง)
+UPLOAD_SPOOL_MAX_BYTES = int(os.environ.get("UPLOAD_SPOOL_MAX_BYTES", str(1024 * 1024)))
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None
+
+
+def _upload_spool_file(filename):
+    """NamedTemporaryFile สำหรับ part หนึ่ง — นามสกุลตามชื่อไฟล์ที่ส่งมา (ไม่ใช่ .pdf เสมอ)"""
+    suffix = os.path.splitext(filename or "")[1]
+    if not re.fullmatch(r"\.[A-Za-z0-9]{1,10}", suffix):
+        suffix = ""
+    return tempfile.NamedTemporaryFile("w+b", dir=UPLOAD_SPOOL_DIR, prefix="upload-", suffix=suffix)
+
+
+class SpooledUpload:
+    """stream ของ part ที่ไม่รู้ขนาดล่วงหน้า: BytesIO จนกว่าจะเกิน UPLOAD_SPOOL_MAX_BYTES แล้วย้ายลงไฟล์
+    (tempfile.SpooledTemporaryFile ย้ายลงไฟล์ที่ไม่มีชื่อ — open_upload_pdf ต้องการ path)"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = io.BytesIO()
+        self._rolled = False
+
+    def write(self, data):
+        if not self._rolled and self._file.tell() + len(data) > UPLOAD_SPOOL_MAX_BYTES:
+            spooled = _upload_spool_file(self.filename)
+            spooled.write(self._file.getbuffer())
+            self._file = spooled
+            self._rolled = True
+        return self._file.write(data)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class SpooledUploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # ทั้ง request เล็ก หรือ part รู้ขนาดและเล็ก → memory; part รู้ขนาดและใหญ่ → disk ตรงๆ
+        # ไม่รู้ขนาด part (multipart ปกติ — werkzeug ส่ง content_length=0) → เริ่มใน memory แล้วย้ายลง disk เมื่อ part นั้นโตเกิน
+        if total_content_length is not None and total_content_length <= UPLOAD_SPOOL_MAX_BYTES:
+            return io.BytesIO()
+        if content_length:
+            if content_length > UPLOAD_SPOOL_MAX_BYTES:
+                return _upload_spool_file(filename)
+            return io.BytesIO()
+        return SpooledUpload(filename)
+
+
+app.request_class = SpooledUploadRequest
+
+
+def open_upload_pdf(upload):
+    """เปิด PDF จากไฟล์ใน request.files — ไฟล์ที่ spool ลง disk เปิดจาก path ไม่ต้องอ่านเข้า memory"""
+    path = getattr(upload.stream, "name", None)
+    if isinstance(path, str) and os.path.isfile(path):
+        upload.stream.flush()
+        return fitz.open(path, filetype="pdf")
+    return fitz.open(stream=upload.read(), filetype="pdf")
+
+
+def pdf_source_size(doc):
+    """ขนาดไฟล์ต้นฉบับของ doc (bytes ที่ upload หรือไฟล์ที่ spool) — 0 ถ้าเป็นเอกสารที่สร้างใหม่"""
+    if doc.stream:
+        return len(doc.stream)
+    if doc.name and os.path.isfile(doc.name):
+        return os.path.getsize(doc.name)
+    return 0
+
+
+# --- memory high-water ต่อ request (log) ---
+# peak RSS ของ process ระหว่าง request (VmHWM) — reset ด้วย /proc/self/clear_refs ตอนเริ่ม request
+# ถ้าไม่มี request อื่นค้างอยู่ ถ้ามี peak จะรวมของ request ที่ทับช่วงกัน (log บอก concurrent ไว้)
+# ไม่ใช่ Linux: ใช้ ru_maxrss ของทั้ง process แทน (reset ไม่ได้)
+MEMORY_LOG = os.environ.get("MEMORY_LOG", "1") == "1"
+_memory_lock = threading.Lock()
+_memory_inflight = 0
+
+
+def read_memory_mb():
+    """(rss, peak) ของ process เป็น MB"""
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if line.startswith(("VmRSS", "VmHWM")))
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return peak, peak
+
+
+@app.before_request
+def memory_watermark_begin():
+    global _memory_inflight
+    if not MEMORY_LOG or request.method != "POST":
+        return None
+    with _memory_lock:
+        if _memory_inflight == 0:
+            try:
+                with open("/proc/self/clear_refs", "w") as f:
+                    f.write("5")
+            except OSError:
+                pass
+        _memory_inflight += 1
+        g.memory_start = (read_memory_mb()[0], _memory_inflight)
+
+
+@app.after_request
+def memory_watermark_header(response):
+    if "memory_start" in g:
+        response.headers['X-Memory-Peak-MB'] = f"{read_memory_mb()[1]:.0f}"
+    return response
+
+
+@app.teardown_request
+def memory_watermark_end(exc):
+    global _memory_inflight
+    start = g.pop("memory_start", None)
+    if start is None:
+        return
+    rss_start, concurrent = start
+    with _memory_lock:
+        concurrent = max(concurrent, _memory_inflight)
+        _memory_inflight -= 1
+    rss, peak = read_memory_mb()
+    upload = request.content_length or 0
+    print(f"memory {request.path}: rss {rss_start:.0f} -> {rss:.0f} MB, peak {peak:.0f} MB "
+          f"(+{peak - rss_start:.0f}), upload {upload / 1048576:.1f} MB, concurrent {concurrent}")
+
+
+# --- ส่ง PDF กลับจาก memory แทน NamedTemporaryFile(delete=False) ---
+# เดิมทุก request เขียนผลลง /tmp แล้ว send_file(path) และไม่เคยลบ → disk เล็กๆ ของเครื่องเต็ม
+# ตอนนี้ส่งจาก BytesIO ตรงๆ ไฟล์ที่ใหญ่กว่า PDF_SPOOL_MAX_BYTES ย้ายไป TemporaryFile
+# (ไม่มีชื่อบน disk — OS ลบให้เองเมื่อ response ปิดไฟล์ แม้ process ตาย) เพื่อไม่ถือ memory ระหว่างส่งช้าๆ
+PDF_SPOOL_MAX_BYTES = int(os.environ.get("PDF_SPOOL_MAX_BYTES", str(16 * 1024 * 1024)))
+
+
+def pdf_response(data, download_name):
+    """response สำหรับ PDF bytes — ไฟล์ปิด/หายเองเมื่อส่งเสร็จ"""
+    if len(data) <= PDF_SPOOL_MAX_BYTES:
+        out = io.BytesIO(data)
+    else:
+        out = tempfile.TemporaryFile()
+        out.write(data)
+        out.seek(0)
+    response = send_file(out, mimetype="application/pdf", as_attachment=True, download_name=download_name)
+    response.content_length = len(data)
+    return response
+
+
+def send_pdf(doc, download_name):
+    """save doc แบบ compress แล้วส่งกลับจาก memory
+    เอกสารใหญ่ที่บันทึกแบบ incremental ได้ เขียนผลลงไฟล์ชั่วคราวตรงๆ แทน — ไม่ถือผลทั้งไฟล์ใน memory 2 ชุด
+    (buffer ของ MuPDF + bytes ของ Python)"""
+    if pdf_source_size(doc) > PDF_SPOOL_MAX_BYTES and use_incremental_save(doc):
+        try:
+            t0 = time.perf_counter()
+            out = incremental_pdf_file(doc)
+            size = os.fstat(out.fileno()).st_size
+            compression_policy.record(request.endpoint or "-", "incremental", size, size, time.perf_counter() - t0)
+            response = send_file(out, mimetype="application/pdf", as_attachment=True, download_name=download_name)
+            response.content_length = size
+            return response
+        except Exception as e:
+            print(f"incremental PDF save to file failed (falling back to in-memory save): {e}")
+    data, _ = save_pdf_bytes(doc)
+    return pdf_response(data, download_name)
+
 # --- ฟังก์ชันแปลงตัวเลขเป็นเลขไทย ---
 def to_thai_digits(text):
     thai_digits = '๐๑๒๓๔๕๖๗๘๙'
@@ -146,6 +783,349 @@ def process_text_with_markers(text):
 
     return lines if lines else [text]
 
+# --- template memo โหลด/parse ครั้งเดียว แล้ว clone ต่อ request ---
+# เดิมทุก request สร้าง DocxTemplate(path) ใหม่ = unzip + parse XML + patch_xml (regex ทั้งไฟล์)
+# + compile Jinja ของ template เดิมซ้ำทุกครั้ง ทั้งที่ template ไม่เปลี่ยน
+# ตอนนี้ parse Document ไว้ครั้งเดียว ต่อ request แค่ deepcopy และ cache ผลของ
+# patch_xml / Jinja compile ตาม source XML — reload อัตโนมัติเมื่อไฟล์ template เปลี่ยน (mtime/size)
+MEMO_TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "templates", "memo-template2.docx")
+
+
+class _CachingJinjaEnvironment(jinja2.Environment):
+    """Environment ที่จำ Template ที่ compile แล้วตาม source (docxtpl เรียก from_string ทุก render)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._compiled = {}
+        self._compiled_lock = threading.Lock()
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals is not None or template_class is not None:
+            return super().from_string(source, globals, template_class)
+        template = self._compiled.get(source)
+        if template is None:
+            template = super().from_string(source)
+            with self._compiled_lock:
+                self._compiled[source] = template
+        return template
+
+
+class _PreparedDocxTemplate(DocxTemplate):
+    """DocxTemplate ที่ cache ผลของ patch_xml (pure function ของ source XML)"""
+
+    _patched = {}
+
+    def patch_xml(self, src_xml):
+        patched = self._patched.get(src_xml)
+        if patched is None:
+            patched = super().patch_xml(src_xml)
+            # template มีไม่กี่ part (body/header/footer) — ล้างทิ้งถ้าโตผิดปกติจากการ reload บ่อย
+            if len(self._patched) > 64:
+                self._patched.clear()
+            self._patched[src_xml] = patched
+        return patched
+
+
+class MemoTemplate:
+    """memo-template2.docx ที่ preload ไว้ — render() คืน DocxTemplate ใหม่ที่ render แล้ว"""
+
+    def __init__(self, path=MEMO_TEMPLATE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.raw = None
+        self.sha256 = None
+        self.base_docx = None
+        self.jinja_env = None
+
+    def refresh(self):
+        """โหลดใหม่ถ้าไฟล์เปลี่ยน — คืน False ถ้าไม่มีไฟล์ template"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self.stamp:
+            return True
+        with self.lock:
+            if stamp != self.stamp:
+                with open(self.path, "rb") as f:
+                    raw = f.read()
+                self.base_docx = Document(io.BytesIO(raw))
+                self.raw = raw
+                self.sha256 = hashlib.sha256(raw).hexdigest()
+                # env ใหม่ = ทิ้ง Template ที่ compile จาก template ไฟล์เก่า
+                self.jinja_env = _CachingJinjaEnvironment()
+                self.stamp = stamp
+                print(f"memo template loaded: {self.path} ({len(raw)} bytes)")
+        return True
+
+    def render(self, data):
+        with self.lock:
+            raw, base_docx, jinja_env = self.raw, self.base_docx, self.jinja_env
+        doc = _PreparedDocxTemplate(io.BytesIO(raw))
+        # ตั้ง docx เป็นสำเนาของตัวที่ parse ไว้แล้ว → init_docx ไม่ unzip/parse ไฟล์ซ้ำ
+        doc.docx = copy.deepcopy(base_docx)
+        doc.render(data, jinja_env=jinja_env)
+        return doc
+
+
+memo_template = MemoTemplate()
+memo_template.refresh()
+
+# --- cache ผลลัพธ์ /pdf (content-addressed) ---
+# ผู้ใช้มัก generate memo เดิมซ้ำ (preview → final → retry ตอนเน็ตหลุด) ด้วย JSON เดียวกันเป๊ะ
+# key = hash ของไฟล์ template + payload ที่ผ่าน process_text_with_markers/to_thai_digits แล้ว
+# เก็บ PDF สุดท้าย (หลัง compress) ลง disk — hit แล้วข้าม docxtpl + LibreOffice + qpdf ทั้งหมด
+# จำกัดขนาดรวมด้วย LRU ตาม mtime (get() touch ไฟล์ทุกครั้งที่ใช้)
+RENDER_CACHE_ENABLED = os.environ.get("RENDER_CACHE", "1") == "1"
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "memo-render-cache"))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+# เปลี่ยนเลขนี้เมื่อแก้ logic การ render (justify ฯลฯ) เพื่อไม่ให้เสิร์ฟผลลัพธ์เก่า
+RENDER_CACHE_VERSION = "1"
+
+
+class RenderCache:
+    """cache ไฟล์ PDF บน local disk แบบ size-bounded LRU"""
+
+    def __init__(self, cache_dir=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pdf")
+
+    def get(self, key):
+        """คืนไฟล์ที่ cache ไว้ (เปิดแล้ว, ผู้เรียกต้องปิด) หรือ None — touch mtime ให้เป็นตัวล่าสุดของ LRU
+        เปิดภายใต้ lock เดียวกับ _evict: ถ้า put/evict ลบหรือแทนไฟล์หลังจากนี้ fd ที่เปิดไว้ยังอ่านได้ครบ"""
+        path = self.path(key)
+        with self.lock:
+            try:
+                f = open(path, "rb")
+            except OSError:
+                return None
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return f
+
+    def put(self, key, data):
+        path = self.path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"render cache put failed: {e}")
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".pdf"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(os.path.join(self.cache_dir, name))
+                    total -= size
+                except OSError:
+                    pass
+
+
+def render_cache_key(template_sha256, data, renderer="libreoffice"):
+    """key ของ cache = hash(template) + renderer + payload แบบ canonical JSON (sort_keys)"""
+    h = hashlib.sha256()
+    h.update(RENDER_CACHE_VERSION.encode())
+    h.update(template_sha256.encode())
+    h.update(renderer.encode())
+    h.update(json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    return h.hexdigest()
+
+
+render_cache = RenderCache() if RENDER_CACHE_ENABLED else None
+
+# --- renderer ตรง: สร้าง memo PDF ด้วย PyMuPDF (ไม่ผ่าน docx / LibreOffice) ---
+# layout ของ memo-template2.docx คงที่ → วาดเป็น HTML แล้วให้ fitz.Story จัดหน้า
+# (HarfBuzz shape ภาษาไทยจาก THSarabunNew ที่ bundle มา, justify, ตัดหน้าเอง)
+# เลือกได้ต่อ request ด้วย ?renderer=direct หรือ field "renderer" ใน payload
+# ค่า default ตั้งด้วย MEMO_RENDERER (libreoffice | direct)
+MEMO_RENDERERS = ("libreoffice", "direct")
+MEMO_RENDERER = os.environ.get("MEMO_RENDERER", "libreoffice").strip().lower()
+if MEMO_RENDERER not in MEMO_RENDERERS:
+    MEMO_RENDERER = "libreoffice"
+
+FONTS_DIR = os.path.join(os.path.dirname(__file__), "fonts")
+
+# ขนาดจาก template (twips / 20): A4, margin บน 35.6 ล่าง 34.85 ซ้าย 72, ตารางกว้าง 460.45
+MEMO_PAGE_RECT = fitz.Rect(0, 0, 595.3, 841.9)
+MEMO_CONTENT_RECT = fitz.Rect(72, 35.6, 72 + 460.45, 841.9 - 34.85)
+
+MEMO_DIRECT_CSS = """
+@font-face {font-family: sarabun; src: url("THSarabunNew.ttf");}
+@font-face {font-family: sarabun; src: url("THSarabunNew Bold.ttf"); font-weight: bold;}
+body {font-family: sarabun; font-size: 16pt; margin: 0;}
+p {margin: 0; padding: 0 5.4pt; text-align: justify;}
+p.left {text-align: left;}
+p.spacer {font-size: 6.5pt;}
+p.heading {padding-left: 68.95pt; font-weight: bold;}
+table {border-collapse: collapse;}
+td {padding: 0; vertical-align: top;}
+b.label {font-size: 20pt;}
+"""
+
+# ตัดบรรทัดภาษาไทย: MuPDF ไม่มีพจนานุกรมตัดคำ จึงแทรก ZWSP ตรงจุดที่ขึ้นพยางค์ใหม่แน่ ๆ
+# - ก่อนสระหน้า เ แ โ ใ ไ
+# - หลัง ์ และ ๆ (ถ้าตัวถัดไปไม่ใช่วรรณยุกต์/สระบนล่าง)
+# ไม่ตัดหลัง ะ/ำ/า — ได้คำขาดกลางแบบ "สำ|หรับ", "ประ|สิทธิ", "โครงกา|รพัฒนา"
+_THAI_LEADING_VOWELS = "เแโใไ"
+_THAI_BREAK_AFTER = "์ๆ"
+_THAI_COMBINING = "ัิีึืฺุู็่้๊๋์ํ๎"
+
+
+def _is_thai(ch):
+    return "ก" <= ch <= "๛"
+
+
+def thai_break_opportunities(text):
+    out = []
+    for i, ch in enumerate(text):
+        prev = text[i - 1] if i else ""
+        if ch in _THAI_LEADING_VOWELS and _is_thai(prev) and prev not in _THAI_LEADING_VOWELS and out[-1] != "\u200B":
+            out.append("\u200B")
+        out.append(ch)
+        nxt = text[i + 1] if i + 1 < len(text) else ""
+        if ch in _THAI_BREAK_AFTER and _is_thai(nxt) and nxt not in _THAI_COMBINING:
+            out.append("\u200B")
+    return "".join(out)
+
+
+def _memo_html_text(text):
+    """escape + คงช่องว่างซ้อน (docx เก็บ space ตามจริง, HTML จะยุบ) + จุดตัดคำไทย"""
+    text = html.escape(text, quote=False)
+    body = text.lstrip(" ")
+    lead = "\u00a0" * (len(text) - len(body))
+    body = re.sub(r" {2,}", lambda m: "\u00a0" * (len(m.group(0)) - 1) + " ", body)
+    return lead + thai_break_opportunities(body)
+
+
+def _memo_body_paragraph(line):
+    # เหมือน /pdf เดิม: บรรทัดที่มี \u200B ไม่ justify (แล้วลบ marker ทิ้ง)
+    css_class = ""
+    if "\u200B" in line:
+        css_class = ' class="left"'
+        line = line.replace("\u200B", "")
+    return f"<p{css_class}>{_memo_html_text(' ' * 20 + line)}</p>"
+
+
+def build_memo_html(data):
+    """HTML ของ memo ตามตาราง memo-template2.docx (justify ทุก paragraph เหมือน route เดิม)"""
+    parts = [
+        # แถวครุฑ + "บันทึกข้อความ" (ความกว้าง cell ตาม template)
+        '<table><tr>'
+        '<td style="width:76.5pt"><p><img src="garuda.png" style="width:42.5pt;height:42.45pt"></p></td>'
+        '<td style="width:93.35pt"></td>'
+        '<td style="width:128.5pt"><p style="font-size:10pt">&nbsp;</p>'
+        '<p style="font-size:28pt"><b>บันทึกข้อความ</b></p></td>'
+        '<td style="width:76.9pt"></td><td style="width:85.2pt"></td>'
+        '</tr></table>',
+        '<p><b class="label">ส่วนราชการ</b>'
+        + _memo_html_text("  ศูนย์การศึกษาพิเศษ  เขตการศึกษา ๖ จังหวัดลพบุรี    โทร ๐๖๒-๔๔๐-๑๓๓๖")
+        + '</p>',
+        '<table><tr>'
+        '<td style="width:224.5pt"><p><b class="label">ที่</b>'
+        + _memo_html_text("   ศธ ๐๔๐๐๗.๖๐๐/" + str(data.get("doc_number", "")))
+        + '</p></td>'
+        '<td style="width:235.95pt"><p><b class="label">วันที่</b>'
+        + _memo_html_text("  " + str(data.get("date", "")))
+        + '</p></td>'
+        '</tr></table>',
+        '<p><b class="label">เรื่อง</b>' + _memo_html_text("  " + str(data.get("subject", ""))) + '</p>',
+        '<p>' + _memo_html_text("เรียน   ผู้อำนวยการศูนย์การศึกษาพิเศษ เขตการศึกษา ๖ จังหวัดลพบุรี") + '</p>',
+    ]
+    sections = (
+        ("๑.", "ต้นเรื่อง", "introduction_lines"),
+        ("๒.", "ข้อเท็จจริง", "fact_lines"),
+        ("๓.", "ข้อเสนอและพิจารณา", "proposal_lines"),
+    )
+    for number, title, field in sections:
+        parts.append('<p class="spacer">&nbsp;</p>')
+        parts.append(f'<p class="heading">&nbsp;{number} <u>{_memo_html_text(title)}</u></p>')
+        parts.extend(_memo_body_paragraph(line) for line in data.get(field) or [])
+    parts.append('<p class="spacer">&nbsp;</p>')
+    parts.append('<p class="heading">' + _memo_html_text(" จึงเรียนมาเพื่อโปรดทราบและพิจารณา") + '</p>')
+    return "\n".join(parts)
+
+
+class DirectMemoRenderer:
+    """render memo เป็น PDF ด้วย fitz.Story — font + รูปครุฑ (จาก template) เก็บใน Archive ตัวเดียว"""
+
+    def __init__(self, template):
+        self.template = template
+        self.lock = threading.Lock()
+        self.archive = None
+        self.archive_sha256 = None
+
+    def _get_archive(self):
+        with self.lock:
+            if self.archive_sha256 != self.template.sha256:
+                with zipfile.ZipFile(io.BytesIO(self.template.raw)) as z:
+                    garuda = z.read("word/media/image1.png")
+                archive = fitz.Archive(FONTS_DIR)
+                archive.add(garuda, "garuda.png")
+                self.archive = archive
+                self.archive_sha256 = self.template.sha256
+            return self.archive
+
+    def render(self, data):
+        """คืน fitz.Document ของ memo (font subset แล้ว)"""
+        story = fitz.Story(build_memo_html(data), user_css=MEMO_DIRECT_CSS, archive=self._get_archive())
+        buf = io.BytesIO()
+        writer = fitz.DocumentWriter(buf)
+        more = True
+        while more:
+            device = writer.begin_page(MEMO_PAGE_RECT)
+            more, _ = story.place(MEMO_CONTENT_RECT)
+            story.draw(device)
+            writer.end_page()
+        writer.close()
+        pdf = fitz.open("pdf", buf.getvalue())
+        # Story ฝัง font ทั้งไฟล์ (~400KB/weight) → ตัดเหลือเฉพาะ glyph ที่ใช้
+        pdf.subset_fonts()
+        out = pdf.tobytes(garbage=3, deflate=True)
+        pdf.close()
+        return fitz.open("pdf", out)
+
+
+direct_memo_renderer = DirectMemoRenderer(memo_template)
+
+
+def select_memo_renderer(data):
+    """renderer ของ request นี้: ?renderer= > data['renderer'] > MEMO_RENDERER (ดึง key ออกจาก data)"""
+    renderer = request.args.get("renderer") or data.pop("renderer", None) or MEMO_RENDERER
+    data.pop("renderer", None)
+    renderer = str(renderer).strip().lower()
+    if renderer not in MEMO_RENDERERS:
+        raise ValueError(f"Unknown renderer: {renderer} (use {', '.join(MEMO_RENDERERS)})")
+    return renderer
+
 # --- ฟังก์ชันคำนวณ scale จากขนาดหน้า PDF ---
 A4_WIDTH_PT = 595.28
 A4_HEIGHT_PT = 841.89
@@ -155,7 +1135,7 @@ def get_page_scale(page):
     short_side = min(page.rect.width, page.rect.height)
     return short_side / A4_WIDTH_PT
 
-def normalize_to_a4(pdf_bytes, tol=2.0):
+def normalize_to_a4(src, tol=2.0):
     """แปลงทุกหน้าให้เป็น A4 แนวตั้ง (595.28 x 841.89 pt) แบบ scale-to-fit
     รักษาสัดส่วนเดิม วางกึ่งกลางบนพื้นขาว — ใช้กับเอกสารรับภายนอกที่ไม่ใช่ A4
 
@@ -163,35 +1143,77 @@ def normalize_to_a4(pdf_bytes, tol=2.0):
     ของฝั่งนี้) สมมติหน้าเป็น A4 แนวตั้งเสมอ พอทุกหน้าเป็น 595x842 จริง พิกัดลายเซ็น/
     ตรายางจึงตรงจุดที่คลิก และ get_page_scale คืน 1.0 ทำให้ขนาดฟอนต์ตรามาตรฐาน
 
-    show_pdf_page คัดลอกเนื้อหาแบบ vector (ไม่ใช่ raster) จึงไม่เสียคุณภาพ
-    ถ้าทุกหน้าเป็น A4 แนวตั้งอยู่แล้ว (visual rect ภายใน tol) คืนเอกสารเดิมโดยไม่แตะ
-    — รวมถึงหน้าที่ visual เป็น A4 แต่มี /Rotate (stamp code เดิม rotation-aware อยู่แล้ว)
+    แก้ในเอกสารเดิมทีละหน้า (fit_page_to_a4) เฉพาะหน้าที่ยังไม่ใช่ A4 แนวตั้ง (visual rect ภายใน tol)
+    หน้าที่เป็น A4 อยู่แล้วไม่ถูกแตะเลย — รวมถึงหน้าที่ visual เป็น A4 แต่มี /Rotate
+    (stamp code เดิม rotation-aware อยู่แล้ว) แก้ src ในที่แล้วคืนตัวเดิม — ยังผูกกับไฟล์ที่ upload
+    จึงบันทึกแบบ incremental ได้
     """
-    src = fitz.open(stream=pdf_bytes, filetype="pdf")
 
     def is_a4_portrait(r):
         return abs(r.width - A4_WIDTH_PT) <= tol and abs(r.height - A4_HEIGHT_PT) <= tol
 
-    if all(is_a4_portrait(pg.rect) for pg in src):
-        return src
-
-    out = fitz.open()
     for pg in src:
-        # show_pdf_page ไม่เคารพ /Rotate ของหน้าต้นทาง (เทสยืนยัน — หน้าหมุนจะวางผิดมุม)
-        # ต้อง bake การหมุนเข้า geometry ก่อน ด้วย remove_rotation() แล้ว rect จะตรง visual
-        if pg.rotation and hasattr(pg, "remove_rotation"):
-            pg.remove_rotation()
-        r = pg.rect
-        new_page = out.new_page(width=A4_WIDTH_PT, height=A4_HEIGHT_PT)
-        scale = min(A4_WIDTH_PT / r.width, A4_HEIGHT_PT / r.height)
-        tw, th = r.width * scale, r.height * scale
-        ox = (A4_WIDTH_PT - tw) / 2
-        oy = (A4_HEIGHT_PT - th) / 2
-        target = fitz.Rect(ox, oy, ox + tw, oy + th)
-        # target อัตราส่วนเท่าต้นฉบับ จึงไม่บิดเบี้ยว
-        new_page.show_pdf_page(target, src, pg.number)
-    src.close()
-    return out
+        if not is_a4_portrait(pg.rect):
+            fit_page_to_a4(pg)
+    return src
+
+
+def fit_page_to_a4(page):
+    """ย่อ/ขยายเนื้อหาหน้าให้พอดี A4 แนวตั้ง วางกึ่งกลาง — แก้หน้าเดิมในที่
+    (เดิมสร้างเอกสารใหม่ + show_pdf_page ทุกหน้า แล้ว full save ใหม่ทั้งไฟล์ ~2.5 s ที่ 200 หน้า)
+    ผลเหมือน show_pdf_page: เนื้อหาเดิมกลายเป็น Form XObject (กัน q/Q ไม่สมดุล), ตัดส่วนนอก
+    crop box เดิม, ไม่มี annotation/link ติดมา — แต่ไม่คัดลอก resources และไม่ parse เนื้อหา
+    (wrap_contents ต้องนับ q/Q ทั้งหน้า ~7 ms/หน้า) แล้วเพิ่ม content stream เล็กๆ ตัวเดียวที่ Do form นั้น"""
+    doc = page.parent
+    # visual rect ของหน้า (รวม /Rotate แล้ว) → พิกัดบนซ้าย → target บนหน้า A4 → PDF space ของหน้า A4 (แกน y กลับ)
+    r = page.rect
+    to_visual = page.transformation_matrix * page.rotation_matrix
+    scale = min(A4_WIDTH_PT / r.width, A4_HEIGHT_PT / r.height)
+    ox = (A4_WIDTH_PT - r.width * scale) / 2
+    oy = (A4_HEIGHT_PT - r.height * scale) / 2
+    fit = fitz.Matrix(scale, 0, 0, scale, ox - r.x0 * scale, oy - r.y0 * scale)
+    to_pdf = fitz.Matrix(1, 0, 0, -1, 0, A4_HEIGHT_PT)
+    cm = to_visual * fit * to_pdf
+    clip = r * ~to_visual
+    contents = page.get_contents()
+    if len(contents) == 1 and doc.xref_get_key(contents[0], "Subtype")[1] != "/Form":
+        # content stream เดี่ยว: เติม key ให้เป็น form ในที่ — ไม่แตะ data เลย
+        form = contents[0]
+    else:
+        # หลาย stream (เช่นเคยประทับมาแล้ว) หรือ stream ที่หน้าอื่นแปลงไปแล้ว: ต่อกันเป็น form ใหม่
+        form = doc.get_new_xref()
+        doc.update_object(form, "<<>>")
+        doc.update_stream(form, b"\n".join(doc.xref_stream(xref) for xref in contents))
+    doc.xref_set_key(form, "Type", "/XObject")
+    doc.xref_set_key(form, "Subtype", "/Form")
+    doc.xref_set_key(form, "BBox", f"[{clip.x0:g} {clip.y0:g} {clip.x1:g} {clip.y1:g}]")
+    resources = page_resources_source(doc, page.xref)
+    if resources:
+        doc.xref_set_key(form, "Resources", resources)
+    body = doc.get_new_xref()
+    doc.update_object(body, "<<>>")
+    doc.update_stream(body, (f"q {cm.a:g} {cm.b:g} {cm.c:g} {cm.d:g} {cm.e:g} {cm.f:g} cm "
+                             f"{clip.x0:g} {clip.y0:g} {clip.width:g} {clip.height:g} re W n "
+                             f"/fzA4Page Do Q").encode())
+    doc.xref_set_key(page.xref, "Resources", f"<</XObject<</fzA4Page {form} 0 R>>>>")
+    doc.xref_set_key(page.xref, "Contents", f"{body} 0 R")
+    # show_pdf_page ไม่พา annotation มาด้วย — ทิ้งเหมือนกัน (ตำแหน่งเดิมไม่ตรงหน้าใหม่แล้ว)
+    doc.xref_set_key(page.xref, "Annots", "null")
+    # การหมุนอยู่ใน cm แล้ว — ตั้ง 0 ตรงๆ (ลบ key ทิ้งไม่พอ: /Rotate ที่สืบทอดจาก /Pages แม่ยังมีผล)
+    doc.xref_set_key(page.xref, "Rotate", "0")
+    page.set_mediabox(fitz.Rect(0, 0, A4_WIDTH_PT, A4_HEIGHT_PT))
+
+
+def page_resources_source(doc, xref):
+    """/Resources ของหน้า (รวมที่สืบทอดจาก /Pages แม่) เป็น PDF source สำหรับ xref_set_key"""
+    while xref:
+        kind, value = doc.xref_get_key(xref, "Resources")
+        if kind in ("xref", "dict"):
+            return value
+        kind, parent = doc.xref_get_key(xref, "Parent")
+        xref = int(parent.split()[0]) if kind == "xref" else 0
+    return None
+
 
 def visual_to_mb_rect(page, vis_rect):
     """แปลง visual rect → mediabox rect ด้วย derotation_matrix"""
@@ -219,17 +1241,215 @@ def apply_sig_rotation(img, rotation):
 def save_rotated_png(img, rotation=0):
     """Save PIL image as PNG bytes พร้อมหมุนตาม rotation"""
     rotated = apply_sig_rotation(img, rotation)
+    return encode_png(rotated), rotated.width, rotated.height
+
+# --- เตรียมภาพลายเซ็น (decode + LANCZOS resize + หมุน + PNG) ขนานกันใน process pool ---
+# งานภาพของลายเซ็นกิน CPU มากสุดใน endpoint ลงนาม และเดิมทำบน thread ของ request ทีละภาพ (ติด GIL)
+# ตอนนี้ handler ส่งภาพทุกตัวที่ต้องใช้เข้า pool ก่อนเริ่มวนหน้า แล้วค่อยรับผลตอนวาง
+# ภาพเดียวกัน (file_key, ความสูง, rotation) ทำครั้งเดียวต่อ request
+# SIGNATURE_POOL_WORKERS=0: ทำใน thread เดิม (default เมื่อเครื่องมี CPU เดียว — แยก process ไม่ได้อะไร)
+SIGNATURE_POOL_WORKERS = int(os.environ.get("SIGNATURE_POOL_WORKERS", str(min(4, (os.cpu_count() or 1) - 1))))
+_signature_pool = None
+_signature_pool_lock = threading.Lock()
+
+
+def prepare_signature_png(data, height, rotation=0):
+    """bytes ของภาพลายเซ็น → (PNG bytes, width, height) ที่ resize/หมุนแล้ว"""
+    img = Image.open(io.BytesIO(data))
+    width = int(img.width * (height / img.height))
+    img = img.resize((width, height), resample=Image.LANCZOS)
+    img = apply_sig_rotation(img, rotation)
     bio = io.BytesIO()
-    rotated.save(bio, format='PNG')
-    return bio.getvalue(), rotated.width, rotated.height
+    img.save(bio, format='PNG')
+    return bio.getvalue(), img.width, img.height
+
+
+def get_signature_pool():
+    """ProcessPoolExecutor ตัวเดียวของ process (สร้างตอนใช้ครั้งแรก) — None ถ้าปิดไว้
+    ใช้ forkserver: fork จาก process ที่มี thread หลายตัว (Flask/gunicorn) เสี่ยง deadlock"""
+    global _signature_pool
+    if SIGNATURE_POOL_WORKERS <= 0:
+        return None
+    with _signature_pool_lock:
+        if _signature_pool is None:
+            ctx = multiprocessing.get_context("forkserver")
+            # forkserver import โมดูลนี้ครั้งเดียว แล้ว fork worker ออกมา (ไม่ต้อง import ใหม่ทุกตัว)
+            ctx.set_forkserver_preload([prepare_signature_png.__module__])
+            _signature_pool = concurrent.futures.ProcessPoolExecutor(SIGNATURE_POOL_WORKERS, mp_context=ctx)
+            atexit.register(_signature_pool.shutdown, wait=False, cancel_futures=True)
+        return _signature_pool
+
+
+# --- cache ภาพลายเซ็นที่เตรียมแล้ว ข้าม request ---
+# ผู้ลงนามซ้ำๆ ไม่กี่ร้อยคน upload ไฟล์ลายเซ็นเดิมทุกครั้ง → key ด้วย sha256 ของ bytes ที่ upload
+# + ความสูงเป้าหมาย + rotation เก็บ PNG สุดท้ายพร้อมขนาด (hit = ไม่ต้อง decode/resize/encode เลย)
+SIGNATURE_CACHE_SIZE = int(os.environ.get("SIGNATURE_CACHE_SIZE", "512"))
+
+
+class SignatureImageCache:
+    """LRU: (sha256, ความสูง, rotation) → (PNG bytes, width, height)"""
+
+    def __init__(self, max_entries=SIGNATURE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.images = {}  # key -> PIL image ที่ decode จาก PNG แล้ว (สำหรับตราที่ต้องวางเป็นภาพ)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(digest, height, rotation=0):
+        return digest, height, rotation
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                old, _ = self.entries.popitem(last=False)
+                self.images.pop(old, None)
+
+    def image(self, data, height):
+        """PIL image ของลายเซ็นที่ resize แล้ว (ใช้ร่วมกันทุก request — ห้ามแก้ในที่)"""
+        key = self.key(hashlib.sha256(data).hexdigest(), height)
+        value = self.get(key)
+        if value is None:
+            value = prepare_signature_png(data, height)
+            self.put(key, value)
+        with self.lock:
+            img = self.images.get(key)
+        if img is None:
+            img = Image.open(io.BytesIO(value[0]))
+            img.load()
+            with self.lock:
+                if key in self.entries:
+                    self.images[key] = img
+        return img
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+signature_image_cache = SignatureImageCache()
+
+
+class SignatureImages:
+    """ภาพลายเซ็นของ request หนึ่ง — get() คืน (PNG bytes, width, height)
+    ใช้ร่วมกันได้หลาย thread (batch endpoint แชร์ตัวเดียวทุกเอกสาร)"""
+
+    def __init__(self, files):
+        self.files = files
+        self.data = {}
+        self.digests = {}
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def _bytes(self, file_key):
+        if file_key not in self.data:
+            f = self.files[file_key]
+            f.seek(0)
+            data = f.read()
+            self.data[file_key] = data
+            self.digests[file_key] = hashlib.sha256(data).hexdigest()
+        return self.data[file_key]
+
+    def _submit(self, file_key, height, rotation):
+        """คืน (future, เจ้าของ) — เจ้าของ=True: ไม่มี pool, caller ต้องคำนวณเองแล้ว set_result"""
+        key = (file_key, height, rotation)
+        with self.lock:
+            future = self.results.get(key)
+            if future is not None:
+                return future, False
+            data = self._bytes(file_key)
+            cache_key = signature_image_cache.key(self.digests[file_key], height, rotation)
+            cached = signature_image_cache.get(cache_key)
+            pool = get_signature_pool()
+            if cached is not None:
+                future = concurrent.futures.Future()
+                future.set_result(cached)
+                owner = False
+            elif pool is None:
+                future = concurrent.futures.Future()
+                owner = True
+            else:
+                future = pool.submit(prepare_signature_png, data, height, rotation)
+                owner = False
+            if cached is None:
+                future.add_done_callback(functools.partial(self._store, cache_key))
+            self.results[key] = future
+            return future, owner
+
+    @staticmethod
+    def _store(cache_key, future):
+        if future.exception() is None:
+            signature_image_cache.put(cache_key, future.result())
+
+    def prefetch(self, signatures, layout):
+        """ส่งภาพทุกตัวที่ compile_signature_plan จะขอเข้า pool ล่วงหน้า (ขนานกัน) — ไม่มี pool ก็ไม่ทำอะไร"""
+        if get_signature_pool() is None:
+            return
+        groups, _ = group_signatures(signatures, layout)
+        for file_key, rotation in planned_signature_images(groups, layout):
+            if file_key and file_key in self.files:
+                self._submit(file_key, layout.signature_height, rotation)
+
+    def get(self, file_key, height, rotation=0):
+        future, owner = self._submit(file_key, height, rotation)
+        if owner:
+            try:
+                with self.lock:
+                    data = self._bytes(file_key)
+                future.set_result(prepare_signature_png(data, height, rotation))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+
+# --- ใช้ image XObject ซ้ำภายในเอกสาร ---
+# ลายเซ็นคนเดียวกัน / ข้อความ "ลงชื่อ" เดิมถูกวางหลายหน้า: insert_image(stream=...) ทุกครั้ง
+# PyMuPDF ต้อง hash + เปิด PNG ใหม่ (แล้วค่อย dedup ด้วย md5) — จำ xref ต่อเอกสารไว้
+# ครั้งถัดไปอ้างด้วย xref= ตรงๆ (key = PNG bytes ซึ่ง Python cache hash ของ object ไว้ให้)
+def insert_png(page, rect, png, **kwargs):
+    """insert_image(stream=png) ที่ embed ภาพแต่ละแบบครั้งเดียวต่อเอกสาร — คืน xref"""
+    doc = page.parent
+    placed = getattr(doc, "placed_images", None)
+    if placed is None:
+        placed = doc.placed_images = {}
+    xref = placed.get(png)
+    if xref:
+        page.insert_image(rect, xref=xref, **kwargs)
+        return xref
+    xref = page.insert_image(rect, stream=png, **kwargs)
+    placed[png] = xref
+    return xref
+
 
 def insert_visual_image(page, img, vis_rect):
     """Insert PIL image ที่ตำแหน่ง visual โดยจัดการ rotation อัตโนมัติ"""
+    # TextWriter วางตามพิกัด visual และตั้งตรงให้เองอยู่แล้ว ไม่ต้องหมุน
+    if vector_text_enabled() and write_text_runs(page, vis_rect, img):
+        return
     rotated_img = rotate_img_for_page(img, page)
     mb_rect = visual_to_mb_rect(page, vis_rect)
-    bio = io.BytesIO()
-    rotated_img.save(bio, format='PNG')
-    page.insert_image(mb_rect, stream=bio.getvalue(), overlay=True)
+    insert_png(page, mb_rect, encode_png(rotated_img), overlay=True)
 
 def draw_visual_rect(page, vis_rect, color=None, width=1):
     """วาด rect ที่ตำแหน่ง visual โดยจัดการ rotation อัตโนมัติ"""
@@ -240,17 +1460,361 @@ def patch_page_for_visual_coords(page):
     """No-op — ใช้ helper functions (insert_visual_image, draw_visual_rect) แทน"""
     pass
 
+
+# --- ตรวจว่าหน้าไหนต้อง flatten ก่อนวางลายเซ็น ---
+# เดิม add_signature_v2 rasterize ทุกหน้าที่มีลายเซ็น (กันกรณี scanned PDF ที่ overlay ถูกบัง)
+# → ไฟล์บวมจาก ~0.3 MB เป็น ~6.7 MB แม้หน้านั้นจะวางทับตรง ๆ ได้อยู่แล้ว
+# ตอนนี้ลองวาง probe สีทึบทับกรอบที่ลายเซ็น/ข้อความจะลงจริง (Placement.rect จาก compile_signature_plan
+# — ไม่ใช่ (x, y) ดิบของ client ซึ่ง layout แบบ "flip" กลับแกน Y) บนสำเนาของหน้า แล้ว render เทียบกับก่อนวาง
+# ถ้า probe ไม่โผล่ (ถูก annotation/เนื้อหาที่ค้าง state บัง) ค่อย flatten เฉพาะหน้านั้น
+# SIGNATURE_FLATTEN: auto (default) | always (แบบเดิม) | never
+SIGNATURE_FLATTEN = os.environ.get("SIGNATURE_FLATTEN", "auto").strip().lower()
+OVERLAY_PROBE_DPI = 24
+
+
+def overlay_flatten_reason(pdf, page_number, rects):
+    """เหตุผลที่ต้อง flatten หน้านี้ ("always"/"hidden") หรือ None ถ้าวาง overlay ตรง ๆ ได้
+    rects = กรอบที่จะวางลายเซ็น/ข้อความ (Placement.rect — พิกัดเดียวกับ insert_image)"""
+    if SIGNATURE_FLATTEN == "always":
+        return "always"
+    if SIGNATURE_FLATTEN == "never":
+        return None
+    probe = fitz.open()
+    try:
+        probe.insert_pdf(pdf, from_page=page_number, to_page=page_number)
+        page = probe[0]
+        before = page.get_pixmap(dpi=OVERLAY_PROBE_DPI).samples
+        page.wrap_contents()
+        area = page.mediabox if page.rotation else page.rect
+        for rect in rects:
+            rect = fitz.Rect(rect) & area
+            if not rect.is_empty:
+                page.draw_rect(rect, color=None, fill=(1, 0, 1), overlay=True)
+        after = page.get_pixmap(dpi=OVERLAY_PROBE_DPI).samples
+        return None if after != before else "hidden"
+    finally:
+        probe.close()
+
+
+# การ encode หน้าที่ flatten: เดิม PNG RGB 150 DPI เสมอ และ insert_image เก็บ pixel แบบไม่บีบอัด
+# (ที่มาของ 0.3 MB → 6.7 MB) — ตอนนี้เลือก colourspace/DPI/codec ตามเนื้อหาหน้า
+# FLATTEN_CODEC: auto (default) | jpeg | flate | bilevel
+#   auto: ดูพื้นที่ที่ภาพคลุมหน้า — ภาพคลุม >= FLATTEN_SCAN_COVERAGE ของหน้าถือว่าเป็นสแกน
+#         สแกนขาวดำ (ภาพ 1-bit ล้วน) → bilevel, สแกน/ภาพถ่ายอื่น → jpeg,
+#         หน้า digital (ไม่มีภาพ หรือมีแค่ภาพเล็กๆ เช่นตราครุฑบนบันทึกข้อความ) → flate
+#         (lossless, ตัวอักษรคม และเล็กกว่า jpeg)
+#   gray แทน rgb เมื่อหน้าไม่มีสี
+FLATTEN_CODEC = os.environ.get("FLATTEN_CODEC", "auto").strip().lower()
+FLATTEN_DPI = int(os.environ.get("FLATTEN_DPI", "150"))
+FLATTEN_BILEVEL_DPI = int(os.environ.get("FLATTEN_BILEVEL_DPI", "200"))
+FLATTEN_JPEG_QUALITY = int(os.environ.get("FLATTEN_JPEG_QUALITY", "85"))
+FLATTEN_GRAY_TOLERANCE = 12  # ต่างกันระหว่าง channel ไม่เกินนี้ถือว่าเป็นสีเทา
+FLATTEN_BILEVEL_THRESHOLD = 160
+FLATTEN_SCAN_COVERAGE = float(os.environ.get("FLATTEN_SCAN_COVERAGE", "0.5"))
+
+
+def _page_is_gray(page):
+    pix = page.get_pixmap(dpi=24, colorspace=fitz.csRGB, alpha=False)
+    r, g, b = Image.frombytes("RGB", (pix.width, pix.height), pix.samples).split()
+    return max(ImageChops.difference(r, g).getextrema()[1],
+               ImageChops.difference(g, b).getextrema()[1]) <= FLATTEN_GRAY_TOLERANCE
+
+
+def _image_coverage(page, images):
+    """สัดส่วนพื้นที่หน้าที่ภาพคลุม (0-1) — รวมพื้นที่ bbox ที่อยู่ในหน้า (สแกนแบ่งเป็นแถบไม่ซ้อนกัน)
+    ภาพซ้อนกันนับซ้ำได้ จึงตัดที่ 1"""
+    area = abs(page.rect)
+    if not area:
+        return 0.0
+    return min(1.0, sum(abs(fitz.Rect(img["bbox"]) & page.rect) for img in images) / area)
+
+
+def choose_flatten_encoding(page):
+    """(codec, colorspace, dpi) สำหรับ flatten หน้านี้"""
+    codec = FLATTEN_CODEC
+    if codec == "auto":
+        images = page.get_image_info()
+        scan = _image_coverage(page, images) >= FLATTEN_SCAN_COVERAGE
+        # สแกนขาวดำ = ภาพทุกภาพเป็น 1 bit
+        if scan and all(img["bpc"] == 1 for img in images):
+            codec = "bilevel"
+        else:
+            codec = "jpeg" if scan else "flate"
+    if codec == "bilevel":
+        return "bilevel", "gray", FLATTEN_BILEVEL_DPI
+    if codec not in ("jpeg", "flate"):
+        codec = "jpeg"
+    return codec, "gray" if _page_is_gray(page) else "rgb", FLATTEN_DPI
+
+
+def flatten_page(pdf, page_number):
+    """แทนหน้าด้วยภาพ render ของหน้าเดิม (workaround สำหรับ scanned PDF)
+    คืน (หน้าใหม่, label ของการ encode เช่น "jpeg-gray@150")"""
+    old_page = pdf[page_number]
+    page_rect = old_page.rect
+    codec, colorspace, dpi = choose_flatten_encoding(old_page)
+    pix = old_page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY if colorspace == "gray" else fitz.csRGB, alpha=False)
+    if codec == "jpeg":
+        img_bytes = pix.tobytes("jpeg", jpg_quality=FLATTEN_JPEG_QUALITY)
+    elif codec == "bilevel":
+        gray = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+        bio = io.BytesIO()
+        gray.point(lambda v: 255 if v > FLATTEN_BILEVEL_THRESHOLD else 0).convert("1").save(bio, format="PNG")
+        img_bytes = bio.getvalue()
+    else:
+        # flate: ใส่ pixmap ตรง ๆ ไม่ต้อง encode/decode PNG ไปกลับ
+        img_bytes = None
+    # ลบหน้าเก่า แล้วสร้างหน้าใหม่ที่ตำแหน่งเดิม (เอกสารที่ flatten แล้วบันทึกแบบ full เสมอ)
+    pdf.flattened = True
+    pdf.delete_page(page_number)
+    new_page = pdf.new_page(pno=page_number, width=page_rect.width, height=page_rect.height)
+    if img_bytes is None:
+        xref = new_page.insert_image(new_page.rect, pixmap=pix)
+    else:
+        xref = new_page.insert_image(new_page.rect, stream=img_bytes)
+    # JPEG เก็บเป็น DCT ตรง ๆ แต่ภาพอื่นถูกเก็บเป็น pixel ดิบ → deflate เฉพาะภาพนี้
+    if pdf.xref_get_key(xref, "Filter")[0] == "null":
+        pdf.update_stream(xref, pdf.xref_stream(xref), compress=True)
+    return new_page, f"{codec}-{colorspace}@{dpi}"
+
+# --- cache font THSarabunNew (PIL) ---
+# ImageFont.truetype อ่าน + parse ไฟล์ TTF (~400KB) ใหม่ทุกครั้ง — เดิมเรียกทุกบรรทัดข้อความ
+# ใช้ FreeTypeFont ร่วมกันทุก helper แยกตาม (ไฟล์, ขนาด) แบบจำกัดจำนวน (LRU)
+FONT_CACHE_SIZE = int(os.environ.get("FONT_CACHE_SIZE", "64"))
+
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def _load_font(font_path, size):
+    return ImageFont.truetype(font_path, size)
+
+
+def get_font(font_path, size):
+    """FreeTypeFont ของ (font_path, size) จาก cache — ห้ามแก้ object ที่ได้ (ใช้ร่วมทุก request)"""
+    return _load_font(os.path.abspath(font_path), size)
+
+
+# --- cache ภาพข้อความ (RGBA + PNG ที่ encode แล้ว) ---
+# ข้อความซ้ำ ๆ (ชื่อ/ตำแหน่งผู้ลงนาม, "ลงชื่อ", ชื่อหน่วยงานใน stamp) เดิม rasterize + encode PNG ใหม่ทุก request
+# key = ฟังก์ชันวาด + อาร์กิวเมนต์ทั้งหมด (ข้อความ, font, ขนาด, สี, น้ำหนัก, line height, align)
+# ภาพที่ได้จาก cache ใช้ร่วมกันทุก request — ห้ามแก้ภาพในที่ (rotate/resize คืนภาพใหม่อยู่แล้ว)
+TEXT_IMAGE_CACHE_SIZE = int(os.environ.get("TEXT_IMAGE_CACHE_SIZE", "512"))
+
+
+def _freeze(value):
+    """list (เช่นสีจาก JSON) → tuple เพื่อใช้เป็น key"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class TextImageCache:
+    """LRU ของภาพข้อความ + PNG bytes พร้อมตัวนับ hit/miss"""
+
+    def __init__(self, max_entries=TEXT_IMAGE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> PIL image
+        self.ids = {}  # id(image) -> key ของภาพที่ยังอยู่ใน cache
+        self.png = {}  # id(image) -> PNG bytes
+        self.hits = 0
+        self.misses = 0
+        self.png_hits = 0
+        self.png_misses = 0
+
+    def render(self, draw, *args, **kwargs):
+        """คืนภาพจาก cache หรือเรียก draw(*args, **kwargs) แล้วเก็บไว้"""
+        if self.max_entries <= 0:
+            return draw(*args, **kwargs)
+        key = (draw.__qualname__, _freeze(args), tuple(sorted((k, _freeze(v)) for k, v in kwargs.items())))
+        with self.lock:
+            img = self.entries.get(key)
+            if img is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return img
+            self.misses += 1
+        img = draw(*args, **kwargs)
+        with self.lock:
+            # สอง thread วาดข้อความเดียวกันพร้อมกัน → ใช้ภาพที่เข้า cache ก่อน
+            if key in self.entries:
+                return self.entries[key]
+            self.entries[key] = img
+            self.ids[id(img)] = key
+            while len(self.entries) > self.max_entries:
+                _, old = self.entries.popitem(last=False)
+                self.ids.pop(id(old), None)
+                self.png.pop(id(old), None)
+        return img
+
+    def encode_png(self, img):
+        """PNG bytes ของภาพ — ภาพที่มาจาก cache encode ครั้งเดียว"""
+        with self.lock:
+            cached = id(img) in self.ids
+            png = self.png.get(id(img)) if cached else None
+            if cached:
+                if png is not None:
+                    self.png_hits += 1
+                else:
+                    self.png_misses += 1
+        if png is not None:
+            return png
+        bio = io.BytesIO()
+        img.save(bio, format='PNG')
+        png = bio.getvalue()
+        if cached:
+            with self.lock:
+                if id(img) in self.ids:
+                    self.png[id(img)] = png
+        return png
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "png_hits": self.png_hits,
+                "png_misses": self.png_misses,
+            }
+
+
+text_image_cache = TextImageCache()
+
+
+def encode_png(img):
+    return text_image_cache.encode_png(img)
+
+
+# --- โหมดข้อความ vector (เขียนข้อความจริงแทนภาพ PNG) ---
+# image (default): วาดข้อความเป็น RGBA แล้ว insert_image เหมือนเดิม
+# vector: ใช้ตำแหน่งที่วาดในภาพ (img.text_runs) เขียนเป็นข้อความ PDF ด้วย THSarabunNew
+#         font ฝังครั้งเดียวต่อเอกสาร + subset ตอนบันทึก → ไฟล์เล็กลง ค้นหา/คัดลอกข้อความได้
+# เลือกต่อ request ด้วย ?text_mode=vector หรือ form field text_mode, ค่า default จาก TEXT_RENDER_MODE
+TEXT_RENDER_MODE = os.environ.get("TEXT_RENDER_MODE", "image").strip().lower()
+
+
+class TextRunDraw(ImageDraw.ImageDraw):
+    """ImageDraw ที่จำข้อความที่วาด (ตำแหน่ง, font, สี) ไว้ใน img.text_runs"""
+
+    def __init__(self, im):
+        super().__init__(im)
+        self.runs = im.text_runs = []
+
+    def text(self, xy, text, fill=None, font=None, anchor=None, *args, **kwargs):
+        run = (xy[0], xy[1], text, font, fill, anchor or "la")
+        # วาดซ้ำที่เดิมเพื่อให้เส้นเข้ม (v2) — vector เขียนครั้งเดียวพอ
+        if not self.runs or self.runs[-1] != run:
+            self.runs.append(run)
+        return super().text(xy, text, fill, font, anchor, *args, **kwargs)
+
+
+def vector_text_enabled():
+    mode = TEXT_RENDER_MODE
+    if has_request_context():
+        mode = request.args.get("text_mode") or request.form.get("text_mode") or mode
+    return str(mode).strip().lower() == "vector"
+
+
+@functools.lru_cache(maxsize=8)
+def _vector_font(font_path):
+    return fitz.Font(fontfile=font_path)
+
+
+def _pdf_color(fill):
+    if isinstance(fill, (list, tuple)):
+        return tuple(c / 255 for c in fill[:3])
+    return (0, 0, 0)
+
+
+def _vector_scratch_page(page):
+    """หน้าพัก (ขนาด/การหมุนเดียวกับ page) ที่รวมข้อความ vector ของหน้านั้น
+    เขียนลงหน้าพักก่อน แล้วค่อย subset + วางทับทีเดียวตอน finish_vector_text
+    (subset_fonts บนเอกสารจริงจะไป subset font เดิมของไฟล์ที่อัพโหลดด้วย — ช้าและไม่จำเป็น)"""
+    doc = page.parent
+    if getattr(doc, "vector_scratch", None) is None:
+        doc.vector_scratch = fitz.open()
+        doc.vector_pages = {}
+    spno = doc.vector_pages.get(page.number)
+    if spno is None:
+        scratch_page = doc.vector_scratch.new_page(width=page.mediabox.width, height=page.mediabox.height)
+        scratch_page.set_rotation(page.rotation)
+        spno = doc.vector_pages[page.number] = scratch_page.number
+    return doc.vector_scratch[spno]
+
+
+def write_text_runs(page, rect, img):
+    """เขียน img.text_runs เป็นข้อความ PDF ลงใน rect (พิกัด visual) ขนาดเท่าที่ภาพจะวาง
+    คืน False ถ้าภาพนี้เขียนเป็น vector ไม่ได้ (ไม่มี runs / anchor อื่น / หลายบรรทัดในครั้งเดียว /
+    หน้าหมุน 90/270 — show_pdf_page ตัดหน้าพักตามความกว้าง mediabox ข้อความที่เลยออกไปหายหมด
+    จึงให้ caller ใช้ภาพ PNG + visual_to_mb_rect แบบเดิม)"""
+    if page.rotation in (90, 270):
+        return False
+    runs = getattr(img, "text_runs", None)
+    if not runs or any(anchor != "la" or "\n" in text or font is None for _, _, text, font, _, anchor in runs):
+        return False
+    target = _vector_scratch_page(page)
+    sx = rect.width / img.width
+    sy = rect.height / img.height
+    writers = {}
+    for x, y, text, font, fill, _ in runs:
+        if not text.strip():
+            continue
+        color = _pdf_color(fill)
+        writer = writers.get(color)
+        if writer is None:
+            writer = writers[color] = fitz.TextWriter(target.rect, color=color)
+        # anchor "la" = มุมบนซ้ายที่ ascender → baseline อยู่ต่ำลงมา ascent
+        baseline = y + font.getmetrics()[0]
+        writer.append((rect.x0 + x * sx, rect.y0 + baseline * sy), text,
+                      font=_vector_font(font.path), fontsize=font.size * sy)
+    for writer in writers.values():
+        writer.write_text(target)
+    return True
+
+
+def insert_text_image(page, rect, img):
+    """วางภาพข้อความที่ rect (พิกัดเดียวกับ insert_image) — โหมด vector เขียนข้อความจริงแทน
+    (หน้าที่หมุนอยู่ยังใช้ภาพ เพราะ rect ชุดนี้ไม่ได้แปลงเป็นพิกัด visual)"""
+    if vector_text_enabled() and page.rotation == 0 and write_text_runs(page, rect, img):
+        return
+    insert_png(page, rect, encode_png(img), overlay=True)
+
+
+def finish_vector_text(doc):
+    """เรียกก่อนบันทึก: subset font ของข้อความ vector แล้ววางทับหน้าจริงหน้าละครั้ง"""
+    scratch = getattr(doc, "vector_scratch", None)
+    if scratch is None:
+        return
+    scratch.subset_fonts()
+    # subset แล้วยังไม่บีบอัด — deflate ก่อนวางเข้าเอกสารจริง
+    subset = scratch.tobytes(garbage=3, deflate=True)
+    scratch.close()
+    scratch = fitz.open("pdf", subset)
+    for pno, spno in doc.vector_pages.items():
+        page = doc[pno]
+        page.show_pdf_page(page.rect, scratch, spno, overlay=True)
+    scratch.close()
+    doc.vector_scratch = None
+    doc.vector_pages = None
+
+
 # --- ฟังก์ชันวาดข้อความเป็นภาพ ---
 def draw_text_image(text, font_path, font_size=20, color=(2, 53, 139), scale=1):
+    """ภาพข้อความ (ผ่าน text_image_cache — ห้ามแก้ภาพที่ได้ในที่)"""
+    return text_image_cache.render(_draw_text_image, text, os.path.abspath(font_path), font_size, color, scale)
+
+
+def _draw_text_image(text, font_path, font_size, color, scale):
     from PIL import ImageFont, ImageDraw
     big_font_size = font_size * scale
-    font = ImageFont.truetype(font_path, big_font_size)
+    font = get_font(font_path, big_font_size)
     padding = 4 * scale
     lines = text.split('\n')
     width = max([font.getbbox(line)[2] for line in lines]) + 2 * padding
     height = sum([font.getbbox(line)[3] - font.getbbox(line)[1] for line in lines]) + 2 * padding + (len(lines)-1)*2*scale
     img = Image.new("RGBA", (width, height), (255, 255, 255, 0))
-    draw = ImageDraw.Draw(img)
+    draw = TextRunDraw(img)
     y = padding
     for line in lines:
         draw.text((padding, y), line, font=font, fill=color)
@@ -258,6 +1822,404 @@ def draw_text_image(text, font_path, font_size=20, color=(2, 53, 139), scale=1):
     return img
 
 
+def draw_signature_text_image(text, font_path, font_size=20, color=(2, 53, 139), scale=1, font_weight="regular", line_height_ratio=1.2, align="left"):
+    """ภาพข้อความของลายเซ็น (v2 / add_signature_receive) ผ่าน text_image_cache — ห้ามแก้ภาพที่ได้ในที่"""
+    return text_image_cache.render(_draw_signature_text_image, text, font_path, font_size, color, scale, font_weight, line_height_ratio, align)
+
+
+def _draw_signature_text_image(text, font_path, font_size, color, scale, font_weight, line_height_ratio, align):
+    # เลือก font ตาม font_weight
+    if font_weight == "bold":
+        font_path = os.path.join(FONTS_DIR, "THSarabunNew Bold.ttf")
+    big_font_size = font_size * scale
+    font = get_font(font_path, big_font_size)
+    padding = 4 * scale
+    lines = text.split('\n')
+
+    # ใช้ fixed line height แทน bbox เพื่อหลีกเลี่ยงปัญหา tone marks ทำให้ความสูงไม่เท่ากัน
+    # รองรับการปรับ line_height_ratio (default 1.2, สำหรับ comment ใช้ 0.96 = 1.2 * 0.8)
+    fixed_line_height = int(font_size * line_height_ratio * scale)
+
+    # วัดความกว้างเท่านั้น
+    dummy_img = Image.new("RGBA", (10, 10), (255, 255, 255, 0))
+    dummy_draw = ImageDraw.Draw(dummy_img)
+    line_widths = []
+    for line in lines:
+        bbox = dummy_draw.textbbox((0, 0), line, font=font)
+        width = bbox[2] - bbox[0]
+        line_widths.append(width)
+
+    max_width = max(line_widths) + 2 * padding
+    total_height = len(lines) * fixed_line_height + 2 * padding
+
+    img = Image.new("RGBA", (max_width, total_height), (255, 255, 255, 0))
+    draw = TextRunDraw(img)
+
+    content_width = max(line_widths)
+    y = padding
+    for line, lw in zip(lines, line_widths):
+        # align="center": วางแต่ละบรรทัดกึ่งกลางภายในรูป (ใช้กับ org/role ที่ตัดหลายบรรทัด)
+        # align="left" (default): ชิดซ้ายตามเดิม (comment ฯลฯ)
+        line_x = padding + (content_width - lw) / 2 if align == "center" else padding
+        # ใช้ anchor="la" (left-ascender) เพื่อยึดตำแหน่งที่ ascender line
+        # ทำให้ทุกบรรทัดวางที่ตำแหน่งเดียวกัน ไม่ว่าจะมี tone marks หรือไม่
+        # วาด 2 ครั้งซ้อนกันเพื่อให้เส้นเข้มขึ้น
+        draw.text((line_x, y), line, font=font, fill=color, anchor="la")
+        draw.text((line_x, y), line, font=font, fill=color, anchor="la")
+        y += fixed_line_height
+
+    return img
+
+
+def draw_memo_signature_text_image(text, font_path, font_size=20, color=(2, 53, 139), scale=1, font_weight="regular"):
+    """ภาพข้อความของลายเซ็นใน /2in1memo (แต่ละบรรทัดจัดกึ่งกลาง สูงตาม bbox)"""
+    return text_image_cache.render(_draw_memo_signature_text_image, text, font_path, font_size, color, scale, font_weight)
+
+
+def _draw_memo_signature_text_image(text, font_path, font_size, color, scale, font_weight):
+    if font_weight == "bold":
+        font_path = os.path.join(FONTS_DIR, "THSarabunNew Bold.ttf")
+    big_font_size = font_size * scale
+    font = get_font(font_path, big_font_size)
+    padding = 4 * scale
+    lines = text.split('\n')
+    dummy_img = Image.new("RGBA", (10, 10), (255, 255, 255, 0))
+    dummy_draw = ImageDraw.Draw(dummy_img)
+    line_sizes = []
+    for line in lines:
+        bbox = dummy_draw.textbbox((0, 0), line, font=font)
+        width = bbox[2] - bbox[0]
+        height = bbox[3] - bbox[1]
+        line_sizes.append((width, height, bbox))
+    max_width = max([w for w, h, _ in line_sizes]) + 2 * padding
+    total_height = sum([h for w, h, _ in line_sizes]) + 2 * padding + (len(lines)-1)*2*scale
+    img = Image.new("RGBA", (max_width, total_height), (255, 255, 255, 0))
+    draw = TextRunDraw(img)
+    y = padding
+    for i, line in enumerate(lines):
+        w, h, bbox = line_sizes[i]
+        offset_x = (max_width - w) // 2
+        draw.text((offset_x, y - bbox[1]), line, font=font, fill=color)
+        y += h + 2*scale
+    return img
+
+
+# --- placement plan ของลายเซ็น ---
+# เดิม add_signature / add_signature_v2 / 2in1memo / add_signature_receive ต่างมี loop ซ้อน
+# per-sig/per-line ของตัวเอง (copy กันมา ต่างกันแค่ขนาด ระยะห่าง การจัดกึ่งกลาง การหมุน)
+# ตอนนี้ compile_signature_plan อ่าน signatures JSON รอบเดียว: จัดกลุ่ม, คำนวณพิกัด,
+# เตรียมภาพข้อความ/ลายเซ็นครบ → ได้ Placement ต่อหน้า แล้ว execute_signature_plan วางลง PDF
+# ความต่างของแต่ละ route อยู่ใน SignatureLayout ตัวเดียว
+Placement = collections.namedtuple("Placement", "rect kind image")  # kind: "text" (PIL) | "png" (bytes)
+
+THAI_MARKS = frozenset([
+    '\u0E31', '\u0E34', '\u0E35', '\u0E36', '\u0E37',
+    '\u0E38', '\u0E39', '\u0E3A', '\u0E47', '\u0E48',
+    '\u0E49', '\u0E4A', '\u0E4B', '\u0E4C', '\u0E4D', '\u0E4E'
+])
+
+
+def count_visible_chars(s):
+    """นับตัวอักษรที่มองเห็น (ไม่รวม tone marks, vowel marks)"""
+    return len([c for c in s if c not in THAI_MARKS])
+
+
+def wrap_by_visible_chars(text, max_chars=30):
+    """ตัดข้อความตามจำนวนตัวอักษรที่มองเห็น"""
+    if count_visible_chars(text) <= max_chars:
+        return [text]
+
+    lines = []
+    current = ""
+    for char in text:
+        test = current + char
+        if count_visible_chars(test) <= max_chars:
+            current = test
+        else:
+            if current:
+                lines.append(current)
+            current = char
+    if current:
+        lines.append(current)
+    return lines
+
+
+def signature_line_text(line_type, text_value, max_chars):
+    """ข้อความของบรรทัดเป็นเลขไทย — comment ที่มี - แยกเป็นหลายบรรทัด (เก็บ - ไว้หน้าแต่ละบรรทัด)
+    แล้วตัดแต่ละบรรทัดไม่ให้เกิน max_chars ตัวอักษรที่มองเห็น"""
+    if line_type == 'comment' and '-' in text_value:
+        text_lines = ['-' + part for part in text_value.split('-') if part.strip()]
+        wrapped_lines = []
+        for tline in text_lines:
+            wrapped_lines.extend(wrap_by_visible_chars(tline, max_chars=max_chars))
+        return '\n'.join([to_thai_digits(t) for t in wrapped_lines])
+    return to_thai_digits(text_value)
+
+
+def signature_text_color(orig_color):
+    """สีจาก JSON เข้มขึ้น 20% (ไม่ใช่ list/tuple → น้ำเงินราชการ)"""
+    if isinstance(orig_color, (list, tuple)):
+        r = min(int(orig_color[0]*0.8), 255)
+        g = min(int(orig_color[1]*0.8), 255)
+        b = min(int(orig_color[2]*0.8), 255)
+        return (r, g, b)
+    return (2, 53, 139)
+
+
+class SignatureLayout:
+    """ค่าที่ต่างกันระหว่าง route
+
+    anchor: "top-left" วางที่ (x, y) | "center-x" จัดกึ่งกลางแนวนอนที่ x |
+            "flip" กลับแกน Y และถ้ามี width/height ถือเป็นกล่องที่จัดกึ่งกลาง (v2/receive)
+    text_styles: kwargs ของ draw ตามชนิดข้อความ "comment" / "text" (บรรทัดใน lines) / "fallback" (sig แบบเก่า)
+    line_spacing: ข้อความบรรทัดเดียวเลื่อนลงเท่านี้ (หลายบรรทัด = ความสูงภาพ + 4) — None = ความสูงภาพ
+    image_advance: ปรับระยะหลังภาพลายเซ็น (v2 ใช้ -10 ให้ชิดข้อความด้านล่าง)
+    rotate: branch ที่หมุนภาพลายเซ็นตาม rotation ของกลุ่ม ("fallback", "lines")
+    """
+
+    def __init__(self, draw, signature_height, text_styles, *, anchor="top-left", comment_wrap=30,
+                 line_spacing=None, image_advance=0, rotate=(), lines=True, skip_missing_pages=False):
+        self.draw = draw
+        self.signature_height = signature_height
+        self.text_styles = text_styles
+        self.anchor = anchor
+        self.comment_wrap = comment_wrap
+        self.line_spacing = line_spacing
+        self.image_advance = image_advance
+        self.rotate = rotate
+        self.lines = lines
+        self.skip_missing_pages = skip_missing_pages
+
+    def text_advance(self, text, img):
+        if self.line_spacing is None:
+            return img.height
+        # ถ้าเป็นบรรทัดเดียวใช้ fixed spacing, ถ้าหลายบรรทัดใช้ความสูงจริง
+        if text.count('\n') == 0:
+            return self.line_spacing
+        return img.height + 4
+
+
+_V2_TEXT_STYLES = {
+    # comment: font 18 ตัวหนา line height 0.96 (= 1.2 * 0.8) ชิดซ้าย, อื่นๆ 16 ปกติ จัดกึ่งกลาง
+    "comment": dict(font_size=18, scale=1, font_weight="bold", line_height_ratio=0.96, align="left"),
+    "text": dict(font_size=16, scale=1, font_weight="regular", line_height_ratio=1.2, align="center"),
+}
+
+ADD_SIGNATURE_LAYOUT = SignatureLayout(
+    draw_text_image, 70, {"fallback": dict(font_size=20, scale=1)}, lines=False)
+ADD_SIGNATURE_V2_LAYOUT = SignatureLayout(
+    draw_signature_text_image, 50, dict(_V2_TEXT_STYLES, fallback=_V2_TEXT_STYLES["text"]),
+    anchor="flip", line_spacing=20, image_advance=-10, rotate=("fallback", "lines"))
+SIGNATURE_RECEIVE_LAYOUT = SignatureLayout(
+    draw_signature_text_image, 50, dict(_V2_TEXT_STYLES, fallback=dict(font_size=16, scale=1, font_weight="regular")),
+    anchor="flip", rotate=("fallback",))
+MEMO_2IN1_LAYOUT = SignatureLayout(
+    draw_memo_signature_text_image, 50,
+    {"comment": dict(font_size=18, scale=1, font_weight="bold"), "text": dict(font_size=16, scale=1, font_weight="regular"),
+     "fallback": dict(font_size=16, scale=1, font_weight="regular")},
+    anchor="center-x", comment_wrap=15, rotate=("lines",), skip_missing_pages=True)
+
+
+def group_signatures(signatures, layout):
+    """จัด signatures ตามจุดวาง (page, x, y, width, height) — คืน (groups, จำนวนที่ใช้กล่อง default 120x60)"""
+    groups = {}
+    default_boxes = 0
+    for sig in signatures:
+        page_number = int(sig.get('page', 0))
+        x = int(sig['x'])
+        y = int(sig['y'])
+        width = height = 0
+        if layout.anchor == "flip":
+            # รองรับ width/height สำหรับ center positioning
+            width = sig.get('width', 0)
+            height = sig.get('height', 0)
+            # ถ้าไม่มี width/height ให้ใช้ค่า default สำหรับ center positioning
+            if width == 0 and height == 0:
+                width = 120
+                height = 60
+                default_boxes += 1
+        groups.setdefault((page_number, x, y, width, height), []).append(sig)
+    return groups, default_boxes
+
+
+def planned_signature_images(groups, layout):
+    """(file_key, rotation) ของภาพทุกตัวที่ compile_signature_plan จะขอ
+    rotation มาจาก sig แรกของกลุ่ม และหมุนเฉพาะ branch ที่อยู่ใน layout.rotate — กฎเดียวกับตอนวาง"""
+    for sigs in groups.values():
+        rotation = int(sigs[0].get('rotation', 0))
+        has_lines = layout.lines and any('lines' in sig for sig in sigs)
+        for sig in sigs:
+            lines = sig.get('lines') if has_lines else None
+            if lines:
+                branch_rotation = rotation if "lines" in layout.rotate else 0
+                for line in lines:
+                    if line.get('type') == 'image':
+                        yield line.get('file_key'), branch_rotation
+            elif sig.get('type') == 'image':
+                branch = "fallback" if has_lines else "sorted"
+                yield sig.get('file_key'), rotation if branch in layout.rotate else 0
+
+
+def compile_signature_plan(signatures, layout, pdf, signature_images, font_path):
+    """signatures (JSON ที่ parse แล้ว) → {page_number: [Placement, ...]} ตามลำดับการวาดเดิม"""
+    groups, default_boxes = group_signatures(signatures, layout)
+
+    files = signature_images.files
+    plan = collections.defaultdict(list)
+    rotations = collections.Counter()
+    for (page_number, x, y, width, height), sigs in groups.items():
+        if layout.skip_missing_pages and page_number >= len(pdf):
+            continue  # ข้ามถ้าหน้าไม่มี
+        page_rect = pdf[page_number].rect
+        placements = plan[page_number]
+        # boxed = กล่องที่จัดกึ่งกลางรอบจุด (center_x, center_y), centered = จัดกึ่งกลางแนวนอนที่ x
+        boxed = layout.anchor == "flip" and width > 0 and height > 0
+        centered = boxed or layout.anchor == "center-x"
+        center_x = x
+        if layout.anchor != "flip":
+            center_y = y
+        elif boxed:
+            # กลับแกน Y (บนเป็นล่าง ล่างเป็นบน) แล้วเลื่อนลงเท่ากับ height + 30
+            center_y = page_rect.height - y - height
+            center_y += height+30
+        else:
+            # top-left positioning ใช้ความสูงกล่อง default 60 แล้วเลื่อนลง 60
+            center_y = page_rect.height - y - 60
+            center_y += 60
+        current_y = center_y
+        rotation = int(sigs[0].get('rotation', 0))
+        if rotation:
+            rotations[rotation] += 1
+
+        def text_image(text, item, style):
+            color = signature_text_color(item.get('color', (2, 53, 139)))
+            return layout.draw(text, font_path, color=color, **layout.text_styles[style])
+
+        def signature_image(file_key, branch):
+            return signature_images.get(file_key, layout.signature_height, rotation if branch in layout.rotate else 0)
+
+        def place(kind, image, left_x, top_y, w, h):
+            placements.append(Placement(fitz.Rect(left_x, top_y, left_x + w, top_y + h), kind, image))
+
+        has_lines = layout.lines and any('lines' in sig for sig in sigs)
+        if has_lines:
+            for sig in sigs:
+                lines = sig.get('lines')
+                if not lines:
+                    # sig แบบเก่าปนอยู่ในกลุ่มที่มี lines — กล่อง: จัดกึ่งกลางรอบจุด ไม่เลื่อน current_y
+                    if sig['type'] == 'text':
+                        text = to_thai_digits(sig.get('text', ''))
+                        img = text_image(text, sig, "fallback")
+                        w, h, advance = img.width, img.height, layout.text_advance(text, img)
+                        kind, image = "text", img
+                    elif sig['type'] == 'image':
+                        file_key = sig['file_key']
+                        if file_key not in files:
+                            continue
+                        image, w, h = signature_image(file_key, "fallback")
+                        kind, advance = "png", h + layout.image_advance
+                    else:
+                        continue
+                    if boxed:
+                        place(kind, image, center_x - w // 2, center_y - h // 2, w, h)
+                    else:
+                        place(kind, image, x - w // 2 if centered else x, current_y, w, h)
+                        current_y += advance
+                    continue
+                # draw lines in order — กล่อง: เริ่มจากด้านบนของ bounding box
+                if boxed:
+                    current_y = center_y - height // 2
+                for line in lines:
+                    line_type = line.get('type')
+                    if line_type == 'image':
+                        file_key = line.get('file_key')
+                        if not (file_key and file_key in files):
+                            continue
+                        image, w, h = signature_image(file_key, "lines")
+                        place("png", image, center_x - w // 2 if centered else x, current_y, w, h)
+                        current_y += h + layout.image_advance
+                    else:
+                        # For text types: 'comment', 'name', 'position', 'academic_rank', 'org_structure_role', 'timestamp'
+                        text_value = line.get('text') or line.get('value') or line.get('comment') or ''
+                        text = signature_line_text(line_type, text_value, layout.comment_wrap)
+                        img = text_image(text, line, "comment" if line_type == 'comment' else "text")
+                        place("text", img, center_x - img.width // 2 if centered else x, current_y, img.width, img.height)
+                        current_y += layout.text_advance(text, img)
+        else:
+            # แบบเก่า: ข้อความก่อน แล้วตามด้วยภาพ เรียงลงมาจากจุด (x, y)
+            left_of = (lambda w: x - w // 2) if layout.anchor == "center-x" else (lambda w: x)
+            for sig in sorted(sigs, key=lambda s: 0 if s['type'] == 'text' else 1):
+                if sig['type'] == 'text':
+                    text = to_thai_digits(sig.get('text', ''))
+                    img = text_image(text, sig, "fallback")
+                    place("text", img, left_of(img.width), current_y, img.width, img.height)
+                    current_y += layout.text_advance(text, img)
+                elif sig['type'] == 'image':
+                    file_key = sig['file_key']
+                    if file_key not in files:
+                        continue
+                    image, w, h = signature_image(file_key, "sorted")
+                    place("png", image, left_of(w), current_y, w, h)
+                    current_y += h + layout.image_advance
+    # log บรรทัดเดียวต่อ request (ไม่ใช่ต่อลายเซ็น)
+    print(f"DEBUG: signature plan placed {sum(len(p) for p in plan.values())} items on pages {sorted(plan)}, "
+          f"default 120x60 boxes {default_boxes}, rotated groups {dict(rotations)}")
+    return plan
+
+
+def execute_signature_plan(pdf, plan):
+    """วาง Placement ทั้งหมดลง pdf ทีละหน้า"""
+    for page_number, placements in plan.items():
+        page = pdf[page_number]
+        for placement in placements:
+            if placement.kind == "text":
+                insert_text_image(page, placement.rect, placement.image)
+            else:
+                insert_png(page, placement.rect, placement.image, overlay=True)
+
+
+# --- render memo ตาม renderer ที่เลือก ---
+def render_memo_pdf(data, renderer):
+    """render memo ตาม renderer ที่เลือก — คืน (fitz.Document, renderer ที่ใช้จริง) (ยังไม่มีหน้าเปล่าท้าย)
+    direct พังเมื่อไร → ถอยไปใช้ LibreOffice (layout เดิม) แทนการตอบ error — renderer ที่คืนจึงเป็น libreoffice"""
+    if renderer == "direct":
+        try:
+            return direct_memo_renderer.render(data), "direct"
+        except Exception as e:
+            print(f"direct memo renderer failed, falling back to LibreOffice: {e}")
+
+    doc = memo_template.render(data)
+
+    # บังคับ justify ทุก paragraph (รวมใน table ด้วย)
+    # ยกเว้น paragraph ที่มี marker \u200B (ไม่ justify)
+    for paragraph in doc.paragraphs:
+        if '\u200B' in paragraph.text:
+            paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
+            for run in paragraph.runs:
+                run.text = run.text.replace('\u200B', '')
+        else:
+            paragraph.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                for paragraph in cell.paragraphs:
+                    if '\u200B' in paragraph.text:
+                        paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
+                        for run in paragraph.runs:
+                            run.text = run.text.replace('\u200B', '')
+                    else:
+                        paragraph.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+
+    # docx/pdf ชั่วคราวอยู่ใน directory ที่ลบทิ้งทั้งหมดเมื่อโหลด PDF เข้า memory แล้ว
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_docx = os.path.join(tmp_dir, "memo.docx")
+        tmp_pdf = os.path.join(tmp_dir, "memo.pdf")
+        doc.save(tmp_docx)
+        convert_docx_to_pdf(tmp_docx, tmp_pdf)
+        with open(tmp_pdf, "rb") as f:
+            return fitz.open("pdf", f.read()), "libreoffice"
+
+
 # --- สร้าง PDF จาก template docx ---
 @app.route('/pdf', methods=['POST'])
 def generate_pdf():
@@ -291,46 +2253,44 @@ def generate_pdf():
                 data[f'{field}_lines'] = []
 
         data['date'] = to_thai_digits(data.get('date', ''))
-        template_path = os.path.join(os.path.dirname(__file__), "templates", "memo-template2.docx")
-        if not os.path.exists(template_path):
-            return jsonify({'error': f'Template file not found: {template_path}'}), 500
-        doc = DocxTemplate(template_path)
-        doc.render(data)
-
-        # บังคับ justify ทุก paragraph (รวมใน table ด้วย)
-        # ยกเว้น paragraph ที่มี marker \u200B (ไม่ justify)
-        for paragraph in doc.paragraphs:
-            if '\u200B' in paragraph.text:
-                paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                for run in paragraph.runs:
-                    run.text = run.text.replace('\u200B', '')
-            else:
-                paragraph.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for paragraph in cell.paragraphs:
-                        if '\u200B' in paragraph.text:
-                            paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                            for run in paragraph.runs:
-                                run.text = run.text.replace('\u200B', '')
-                        else:
-                            paragraph.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.docx') as tmp_docx:
-            doc.save(tmp_docx.name)
-            tmp_pdf = tmp_docx.name.replace('.docx', '.pdf')
-            convert_docx_to_pdf(tmp_docx.name, tmp_pdf)
-
+        try:
+            renderer = select_memo_renderer(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not memo_template.refresh():
+            return jsonify({'error': f'Template file not found: {memo_template.path}'}), 500
+
+        # payload เดิม + template เดิม → ส่งไฟล์ที่ render ไว้แล้วได้เลย
+        cache_key = None
+        if render_cache is not None:
+            cache_key = render_cache_key(memo_template.sha256, data, renderer)
+            cached_pdf = render_cache.get(cache_key)
+            if cached_pdf:
+                # ส่งจากไฟล์ที่เปิดไว้แล้ว (send_file ปิดให้ตอนจบ response) ไม่ใช่ path ที่อาจถูก evict ไปก่อนเปิด
+                response = send_file(cached_pdf, mimetype="application/pdf", as_attachment=True, download_name="memo.pdf")
+                response.headers['X-Render-Cache'] = 'hit'
+                response.headers['X-Memo-Renderer'] = renderer
+                return response
+
+        pdf, used_renderer = render_memo_pdf(data, renderer)
+        if cache_key is not None and used_renderer != renderer:
+            # direct ถอยไป LibreOffice — เก็บใต้ key ของ renderer ที่ใช้จริง ไม่ให้ request direct ครั้งหน้าได้ผล LibreOffice
+            cache_key = render_cache_key(memo_template.sha256, data, used_renderer)
         # เพิ่มหน้าเปล่า 1 หน้าสำหรับพื้นที่ลายเซ็น
-        pdf = fitz.open(tmp_pdf)
         pdf.new_page(width=pdf[0].rect.width, height=pdf[0].rect.height)
-        tmp_pdf_with_blank = tmp_pdf.replace('.pdf', '_blank.pdf')
-        pdf.save(tmp_pdf_with_blank)
+        pdf_data, compress_decision = save_pdf_bytes(pdf, defer=cache_key is not None)
         pdf.close()
-        compress_pdf_inplace(tmp_pdf_with_blank)
-
-        return send_file(tmp_pdf_with_blank, mimetype="application/pdf", as_attachment=True, download_name="memo.pdf")
+        if cache_key is not None:
+            render_cache.put(cache_key, pdf_data)
+            if compress_decision == "deferred":
+                # ตอบด้วยไฟล์ที่ยังไม่ผ่าน qpdf ไปก่อน แล้วค่อย compress ตัวที่อยู่ใน cache
+                compression_policy.compress_async("pdf", render_cache.path(cache_key))
+
+        response = pdf_response(pdf_data, "memo.pdf")
+        if cache_key is not None:
+            response.headers['X-Render-Cache'] = 'miss'
+        response.headers['X-Memo-Renderer'] = used_renderer
+        return response
     except Exception as e:
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
@@ -339,8 +2299,6 @@ def generate_pdf():
 @app.route('/add_signature', methods=['POST'])
 def add_signature():
     try:
-        DEFAULT_SIGNATURE_HEIGHT = 70
-        DEFAULT_COMMENT_FONT_SIZE = 20
         font_path = os.path.join(os.path.dirname(__file__), "fonts", "THSarabunNew.ttf")
         if not os.path.isfile(font_path):
             return jsonify({'error': f"Font file not found: {font_path}"}), 500
@@ -352,65 +2310,20 @@ def add_signature():
         if 'signatures' not in request.form:
             return jsonify({'error': 'No signatures data'}), 400
         signatures = json.loads(request.form['signatures'])
+        signature_images = SignatureImages(request.files)
+        signature_images.prefetch(signatures, ADD_SIGNATURE_LAYOUT)
 
-        pdf_bytes = pdf_file.read()
-        pdf = fitz.open(stream=pdf_bytes, filetype="pdf")
-
-
-        # --- กลุ่ม sig ตามตำแหน่ง (page, x, y) ---
-        from collections import defaultdict
-        sig_dict = defaultdict(list)
-        for sig in signatures:
-            page_number = int(sig.get('page', 0))
-            x = int(sig['x'])
-            y = int(sig['y'])
-            sig_dict[(page_number, x, y)].append(sig)
-
-        # --- วาดลายเซ็นและความเห็นทีละจุด ---
-        for (page_number, x, y), sigs in sig_dict.items():
-            page = pdf[page_number]
-            patch_page_for_visual_coords(page)
-            sigs_sorted = sorted(sigs, key=lambda s: 0 if s['type'] == 'text' else 1)
-            current_y = y
-            for sig in sigs_sorted:
-                if sig['type'] == 'text':
-                    text = to_thai_digits(sig.get('text', ''))
-                    font_size = DEFAULT_COMMENT_FONT_SIZE
-                    orig_color = sig.get('color', (2, 53, 139))
-                    if isinstance(orig_color, (list, tuple)):
-                        r = min(int(orig_color[0]*0.8), 255)
-                        g = min(int(orig_color[1]*0.8), 255)
-                        b = min(int(orig_color[2]*0.8), 255)
-                        color = (r, g, b)
-                    else:
-                        color = (2, 53, 139)
-                    img = draw_text_image(text, font_path, font_size=font_size, color=color, scale=1)
-                    img_byte_arr = io.BytesIO()
-                    img.save(img_byte_arr, format='PNG')
-                    rect = fitz.Rect(x, current_y, x + img.width, current_y + img.height)
-                    page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                    current_y += img.height
-                elif sig['type'] == 'image':
-                    file_key = sig['file_key']
-                    if file_key not in request.files:
-                        continue
-                    signature_file = request.files[file_key]
-                    img = Image.open(signature_file)
-                    fixed_height = DEFAULT_SIGNATURE_HEIGHT
-                    ratio = fixed_height / img.height
-                    new_width = int(img.width * ratio)
-                    img = img.resize((new_width, fixed_height), resample=Image.LANCZOS)
-                    img_byte_arr = io.BytesIO()
-                    img.save(img_byte_arr, format='PNG')
-                    rect = fitz.Rect(x, current_y, x + new_width, current_y + fixed_height)
-                    page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                    current_y += fixed_height
+        pdf = open_upload_pdf(pdf_file)
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_pdf:
-            pdf.save(tmp_pdf.name)
+
+        # --- วาดลายเซ็นและความเห็นทีละจุด (ข้อความก่อน แล้วภาพ) ---
+        plan = compile_signature_plan(signatures, ADD_SIGNATURE_LAYOUT, pdf, signature_images, font_path)
+        execute_signature_plan(pdf, plan)
+
+        finish_vector_text(pdf)
+        response = send_pdf(pdf, "signed.pdf")
         pdf.close()
-        compress_pdf_inplace(tmp_pdf.name)
-        return send_file(tmp_pdf.name, mimetype="application/pdf", as_attachment=True, download_name="signed.pdf")
+        return response
     except Exception as e:
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
@@ -418,54 +2331,7 @@ def add_signature():
 
 @app.route('/add_signature_v2', methods=['POST'])
 def add_signature_v2():
-    # --- ฟังก์ชันวาดข้อความเป็นภาพ (v2) ---
-    def draw_text_image_v2(text, font_path, font_size=20, color=(2, 53, 139), scale=1, font_weight="regular", line_height_ratio=1.2, align="left"):
-        from PIL import ImageFont, ImageDraw, Image
-        # เลือก font ตาม font_weight
-        if font_weight == "bold":
-            font_path = os.path.join(os.path.dirname(__file__), "fonts", "THSarabunNew Bold.ttf")
-        big_font_size = font_size * scale
-        font = ImageFont.truetype(font_path, big_font_size)
-        padding = 4 * scale
-        lines = text.split('\n')
-
-        # ใช้ fixed line height แทน bbox เพื่อหลีกเลี่ยงปัญหา tone marks ทำให้ความสูงไม่เท่ากัน
-        # รองรับการปรับ line_height_ratio (default 1.2, สำหรับ comment ใช้ 0.96 = 1.2 * 0.8)
-        fixed_line_height = int(font_size * line_height_ratio * scale)
-
-        # วัดความกว้างเท่านั้น
-        dummy_img = Image.new("RGBA", (10, 10), (255, 255, 255, 0))
-        dummy_draw = ImageDraw.Draw(dummy_img)
-        line_widths = []
-        for line in lines:
-            bbox = dummy_draw.textbbox((0, 0), line, font=font)
-            width = bbox[2] - bbox[0]
-            line_widths.append(width)
-
-        max_width = max(line_widths) + 2 * padding
-        total_height = len(lines) * fixed_line_height + 2 * padding
-
-        img = Image.new("RGBA", (max_width, total_height), (255, 255, 255, 0))
-        draw = ImageDraw.Draw(img)
-
-        content_width = max(line_widths)
-        y = padding
-        for line, lw in zip(lines, line_widths):
-            # align="center": วางแต่ละบรรทัดกึ่งกลางภายในรูป (ใช้กับ org/role ที่ตัดหลายบรรทัด)
-            # align="left" (default): ชิดซ้ายตามเดิม (comment ฯลฯ)
-            line_x = padding + (content_width - lw) / 2 if align == "center" else padding
-            # ใช้ anchor="la" (left-ascender) เพื่อยึดตำแหน่งที่ ascender line
-            # ทำให้ทุกบรรทัดวางที่ตำแหน่งเดียวกัน ไม่ว่าจะมี tone marks หรือไม่
-            # วาด 2 ครั้งซ้อนกันเพื่อให้เส้นเข้มขึ้น
-            draw.text((line_x, y), line, font=font, fill=color, anchor="la")
-            draw.text((line_x, y), line, font=font, fill=color, anchor="la")
-            y += fixed_line_height
-
-        return img
     try:
-        DEFAULT_SIGNATURE_HEIGHT = 50
-        DEFAULT_COMMENT_FONT_SIZE = 16
-        LINE_SPACING = 20  # ระยะห่างคงที่ระหว่างบรรทัดข้อความ (สำหรับ single-line text)
         font_path = os.path.join(os.path.dirname(__file__), "fonts", "THSarabunNew.ttf")
         if not os.path.isfile(font_path):
             return jsonify({'error': f"Font file not found: {font_path}"}), 500
@@ -477,330 +2343,35 @@ def add_signature_v2():
         if 'signatures' not in request.form:
             return jsonify({'error': 'No signatures data'}), 400
         signatures = json.loads(request.form['signatures'])
+        # batch endpoint ส่งตัวที่แชร์ทุกเอกสารมาทาง environ (ภาพเดียวกัน decode/resize ครั้งเดียวทั้ง batch)
+        signature_images = request.environ.get("memo.signature_images") or SignatureImages(request.files)
+        signature_images.prefetch(signatures, ADD_SIGNATURE_V2_LAYOUT)
 
-        pdf_bytes = pdf_file.read()
-        pdf = fitz.open(stream=pdf_bytes, filetype="pdf")
+        pdf = open_upload_pdf(pdf_file)
 
         # --- Workaround: สำหรับ scanned PDF ที่ insert_image ถูกรูปสแกนทับ ---
-        # Rasterize ทุกหน้าที่จะมีลายเซ็นก่อน เพื่อ flatten content เป็น image เดียว
-        # แล้วค่อย insert_image ลายเซ็นทับบน page ที่ clean แล้ว
-        signatures_list = json.loads(request.form['signatures'])
-        pages_needing_sig = set(int(s.get('page', 0)) for s in signatures_list)
-        for pn in pages_needing_sig:
-            if pn < len(pdf):
-                old_page = pdf[pn]
-                page_rect = old_page.rect
-                # Rasterize หน้าเดิมที่ 200 DPI
-                pix = old_page.get_pixmap(dpi=150)
-                img_bytes = pix.tobytes("png")
-                # ลบหน้าเก่า แล้วสร้างหน้าใหม่ที่ตำแหน่งเดิม
-                pdf.delete_page(pn)
-                new_page = pdf.new_page(pno=pn, width=page_rect.width, height=page_rect.height)
-                new_page.insert_image(new_page.rect, stream=img_bytes)
-                print(f"DEBUG: Page {pn} rasterized at 150 DPI and rebuilt for clean overlay")
-
-        from collections import defaultdict
-        sig_dict = defaultdict(list)
-        for sig in signatures:
-            page_number = int(sig.get('page', 0))
-            x = int(sig['x'])
-            y = int(sig['y'])
-            # รองรับ width/height สำหรับ center positioning
-            width = sig.get('width', 0)
-            height = sig.get('height', 0)
-
-            # ถ้าไม่มี width/height ให้ใช้ค่า default สำหรับ center positioning
-            if width == 0 and height == 0:
-                width = 120  # default width
-                height = 60  # default height
-                print(f"DEBUG: Using default dimensions {width}x{height} for signature at ({x}, {y})")
-
-            sig_dict[(page_number, x, y, width, height)].append(sig)
-
-        for (page_number, x, y, width, height), sigs in sig_dict.items():
-            page = pdf[page_number]
-            patch_page_for_visual_coords(page)
-
-            # Debug: แสดงข้อมูล page และพิกัด
-            page_rect = page.rect
-            print(f"DEBUG: Page {page_number} - Size: {page_rect.width}x{page_rect.height}")
-            print(f"DEBUG: Original coordinates: ({x}, {y})")
-            print(f"DEBUG: Signature dimensions: {width}x{height}")
-            print(f"DEBUG: Page bounds: x(0-{page_rect.width}), y(0-{page_rect.height})")
-            
-            # ถ้ามี width/height แสดงว่าเป็น center positioning
-            is_center_positioning = width > 0 and height > 0
-            
-            # Logic สำหรับปรับพิกัด Y ให้กลับกัน (บนเป็นล่าง ล่างเป็นบน)
-            # คำนวณ: new_y = (page_height - original_y - signature_height) + height_offset
-            if is_center_positioning:
-                # สำหรับ center positioning ใช้ height ที่กำหนดมา
-                adjusted_y = page_rect.height - y - height
-                # เลื่อนลงแนวดิ่งเท่ากับ height (60)
-                adjusted_y += height+30
-                print(f"DEBUG: Y-axis flip with center positioning: {y} -> {adjusted_y} (with +{height} offset)")
-                center_x = x
-                center_y = adjusted_y
-                print(f"DEBUG: Using center positioning - adjusted coordinates")
-                print(f"DEBUG: Center point: ({center_x}, {center_y})")
-                print(f"DEBUG: Bounding box: {width}x{height}")
+        # flatten (rasterize) เฉพาะหน้าที่ overlay จะถูกบังจริง — หน้าอื่นวางทับตรง ๆ
+        # ผลการตัดสินใจต่อหน้าส่งกลับใน header X-Page-Overlay (เช่น "0:direct,2:flatten-hidden:jpeg-gray@150")
+        # compile ก่อนเพื่อ probe ตรงกรอบที่จะวางจริง — หน้าที่ flatten ขนาดเท่าเดิม plan จึงใช้ต่อได้
+        plan = compile_signature_plan(signatures, ADD_SIGNATURE_V2_LAYOUT, pdf, signature_images, font_path)
+        overlay_decisions = []
+        for pn in sorted(pn for pn, placements in plan.items() if placements):
+            reason = overlay_flatten_reason(pdf, pn, [placement.rect for placement in plan[pn]])
+            if reason:
+                _, encoding = flatten_page(pdf, pn)
+                overlay_decisions.append(f"{pn}:flatten-{reason}:{encoding}")
+                print(f"DEBUG: Page {pn} rasterized ({encoding}) and rebuilt for clean overlay ({reason})")
             else:
-                # สำหรับ top-left positioning ใช้ default signature height
-                signature_box_height = 60  # default height สำหรับการคำนวณ
-                adjusted_y = page_rect.height - y - signature_box_height
-                # เลื่อนลงแนวดิ่งเท่ากับ 60
-                adjusted_y += 60
-                print(f"DEBUG: Y-axis flip with top-left positioning: {y} -> {adjusted_y} (with +60 offset)")
-                center_x = x
-                center_y = adjusted_y
-                print(f"DEBUG: Using top-left positioning - adjusted coordinates")
-            
-            current_y = center_y  # ใช้ค่า Y ที่ปรับแล้ว
-            # อ่าน rotation จาก sig
-            sig_rotation = int(sigs[0].get('rotation', 0))
-            if sig_rotation:
-                print(f"DEBUG: Signature rotation: {sig_rotation}°")
-
-            # Check if any signature has 'lines' field
-            has_lines = any('lines' in sig for sig in sigs)
-            if has_lines:
-                # For each sig with lines, draw lines in order
-                for sig in sigs:
-                    lines = sig.get('lines')
-                    if not lines:
-                        # fallback to old logic for this sig
-                        if sig['type'] == 'text':
-                            text = to_thai_digits(sig.get('text', ''))
-                            # ถ้า type == "comment" ให้ font_size=18, font_weight="bold", line_height_ratio=0.96
-                            font_size = 18 if sig.get('type') == 'comment' else DEFAULT_COMMENT_FONT_SIZE
-                            font_weight = "bold" if sig.get('type') == 'comment' else "regular"
-                            line_height_ratio = 0.96 if sig.get('type') == 'comment' else 1.2
-                            orig_color = sig.get('color', (2, 53, 139))
-                            if isinstance(orig_color, (list, tuple)):
-                                r = min(int(orig_color[0]*0.8), 255)
-                                g = min(int(orig_color[1]*0.8), 255)
-                                b = min(int(orig_color[2]*0.8), 255)
-                                color = (r, g, b)
-                            else:
-                                color = (2, 53, 139)
-                            align = "left" if sig.get('type') == 'comment' else "center"
-                            img = draw_text_image_v2(text, font_path, font_size=font_size, color=color, scale=1, font_weight=font_weight, line_height_ratio=line_height_ratio, align=align)
-                            img_byte_arr = io.BytesIO()
-                            img.save(img_byte_arr, format='PNG')
-                            # ใช้ center positioning ถ้ามี width/height
-                            if is_center_positioning:
-                                left_x = center_x - img.width // 2
-                                top_y = center_y - img.height // 2
-                            else:
-                                left_x = x
-                                top_y = current_y
-                            rect = fitz.Rect(left_x, top_y, left_x + img.width, top_y + img.height)
-                            print(f"DEBUG: Text '{text}' placed at rect: {rect} (center_pos: {is_center_positioning})")
-                            page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                            if not is_center_positioning:
-                                num_lines = text.count('\n') + 1
-                                if num_lines == 1:
-                                    current_y += LINE_SPACING
-                                else:
-                                    current_y += img.height + 4
-                        elif sig['type'] == 'image':
-                            file_key = sig['file_key']
-                            if file_key not in request.files:
-                                continue
-                            signature_file = request.files[file_key]
-                            img = Image.open(signature_file)
-                            fixed_height = DEFAULT_SIGNATURE_HEIGHT
-                            ratio = fixed_height / img.height
-                            new_width = int(img.width * ratio)
-                            img = img.resize((new_width, fixed_height), resample=Image.LANCZOS)
-                            # หมุนลายเซ็นตาม pin rotation
-                            if sig_rotation:
-                                img = apply_sig_rotation(img, sig_rotation)
-                                new_width, fixed_height = img.size
-                            img_byte_arr = io.BytesIO()
-                            img.save(img_byte_arr, format='PNG')
-                            # ใช้ center positioning ถ้ามี width/height
-                            if is_center_positioning:
-                                left_x = center_x - new_width // 2
-                                top_y = center_y - fixed_height // 2
-                            else:
-                                left_x = x
-                                top_y = current_y
-                            rect = fitz.Rect(left_x, top_y, left_x + new_width, top_y + fixed_height)
-                            print(f"DEBUG: Image placed at rect: {rect} (center_pos: {is_center_positioning})")
-                            page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                            if not is_center_positioning:
-                                current_y += fixed_height - 10  # ลดระยะห่างให้ใกล้กับข้อความด้านล่าง
-                    else:
-                        # draw lines in order - รองรับ center positioning
-                        if is_center_positioning:
-                            # สำหรับ center positioning ให้เริ่มจากด้านบนของ bounding box
-                            current_y = center_y - height // 2
-                        
-                        for line in lines:
-                            line_type = line.get('type')
-                            if line_type == 'image':
-                                file_key = line.get('file_key')
-                                if file_key and file_key in request.files:
-                                    signature_file = request.files[file_key]
-                                    img = Image.open(signature_file)
-                                    fixed_height = DEFAULT_SIGNATURE_HEIGHT
-                                    ratio = fixed_height / img.height
-                                    new_width = int(img.width * ratio)
-                                    img = img.resize((new_width, fixed_height), resample=Image.LANCZOS)
-                                    if sig_rotation:
-                                        img = apply_sig_rotation(img, sig_rotation)
-                                        new_width, fixed_height = img.size
-                                    img_byte_arr = io.BytesIO()
-                                    img.save(img_byte_arr, format='PNG')
-
-                                    if is_center_positioning:
-                                        left_x = center_x - new_width // 2  # คืนค่าเดิม แต่เพิ่ม debug
-                                        top_y = current_y
-                                        print(f"DEBUG: Image center positioning - center_x:{center_x}, new_width:{new_width}, left_x:{left_x}")
-                                        print(f"DEBUG: Expected position - should place image at left edge: {left_x}")
-                                    else:
-                                        left_x = x
-                                        top_y = current_y
+                pdf[pn].wrap_contents()
+                overlay_decisions.append(f"{pn}:direct")
 
-                                    rect = fitz.Rect(left_x, top_y, left_x + new_width, top_y + fixed_height)
-                                    print(f"DEBUG: Image rect: {rect}")
-                                    page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                                    current_y += fixed_height - 10  # ลดระยะห่างให้ใกล้กับข้อความด้านล่าง
-                            else:
-                                # For text types: 'comment', 'name', 'position', 'academic_rank', 'org_structure_role', 'timestamp'
-                                text_value = line.get('text') or line.get('value') or line.get('comment') or ''
-
-                                # ฟังก์ชันนับตัวอักษรที่มองเห็น (ไม่รวม tone marks, vowel marks)
-                                def count_visible_chars(s):
-                                    thai_marks = set([
-                                        '\u0E31', '\u0E34', '\u0E35', '\u0E36', '\u0E37',
-                                        '\u0E38', '\u0E39', '\u0E3A', '\u0E47', '\u0E48',
-                                        '\u0E49', '\u0E4A', '\u0E4B', '\u0E4C', '\u0E4D', '\u0E4E'
-                                    ])
-                                    return len([c for c in s if c not in thai_marks])
-
-                                # ฟังก์ชันตัดข้อความตามจำนวนตัวอักษรที่มองเห็น
-                                def wrap_by_visible_chars(text, max_chars=30):
-                                    if count_visible_chars(text) <= max_chars:
-                                        return [text]
-
-                                    lines = []
-                                    current = ""
-                                    for char in text:
-                                        test = current + char
-                                        if count_visible_chars(test) <= max_chars:
-                                            current = test
-                                        else:
-                                            if current:
-                                                lines.append(current)
-                                            current = char
-                                    if current:
-                                        lines.append(current)
-                                    return lines
-
-                                # ถ้าเป็น comment และมี - ให้แยกเป็นหลายบรรทัด
-                                if line_type == 'comment' and '-' in text_value:
-                                    # แยกตาม - และเก็บ - ไว้ข้างหน้าแต่ละบรรทัด
-                                    parts = text_value.split('-')
-                                    # เอา parts ที่ไม่ว่างเปล่าออกมา
-                                    text_lines = ['-' + part for part in parts if part.strip()]
-
-                                    # ตัดแต่ละบรรทัดให้ไม่เกิน 30 ตัวอักษรที่มองเห็น
-                                    wrapped_lines = []
-                                    for tline in text_lines:
-                                        wrapped = wrap_by_visible_chars(tline, max_chars=30)
-                                        wrapped_lines.extend(wrapped)
-
-                                    text = '\n'.join([to_thai_digits(t) for t in wrapped_lines])
-                                else:
-                                    text = to_thai_digits(text_value)
-                                # ถ้า type == "comment" ให้ font_size=18, font_weight="bold", line_height_ratio=0.96 (ลด 20%)
-                                font_size = 18 if line_type == 'comment' else DEFAULT_COMMENT_FONT_SIZE
-                                font_weight = "bold" if line_type == 'comment' else "regular"
-                                line_height_ratio = 0.96 if line_type == 'comment' else 1.2  # comment ใช้ 0.96 = 1.2 * 0.8
-                                orig_color = line.get('color', (2, 53, 139))
-                                if isinstance(orig_color, (list, tuple)):
-                                    r = min(int(orig_color[0]*0.8), 255)
-                                    g = min(int(orig_color[1]*0.8), 255)
-                                    b = min(int(orig_color[2]*0.8), 255)
-                                    color = (r, g, b)
-                                else:
-                                    color = (2, 53, 139)
-                                align = "left" if line_type == 'comment' else "center"
-                                img = draw_text_image_v2(text, font_path, font_size=font_size, color=color, scale=1, font_weight=font_weight, line_height_ratio=line_height_ratio, align=align)
-                                img_byte_arr = io.BytesIO()
-                                img.save(img_byte_arr, format='PNG')
-
-                                if is_center_positioning:
-                                    left_x = center_x - img.width // 2  # คืนค่าเดิม
-                                    top_y = current_y
-                                    print(f"DEBUG: Text center positioning - center_x:{center_x}, img.width:{img.width}, left_x:{left_x}")
-                                    print(f"DEBUG: Expected position - should place text at left edge: {left_x}")
-                                else:
-                                    left_x = x
-                                    top_y = current_y
-
-                                rect = fitz.Rect(left_x, top_y, left_x + img.width, top_y + img.height)
-                                print(f"DEBUG: Text '{text}' rect: {rect}")
-                                num_lines = text.count('\n') + 1
-                                print(f"DEBUG: Text has {num_lines} lines, img.height={img.height}")
-                                page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                                # ถ้าเป็นบรรทัดเดียวใช้ fixed spacing, ถ้าหลายบรรทัดใช้ความสูงจริง
-                                if num_lines == 1:
-                                    current_y += LINE_SPACING
-                                else:
-                                    current_y += img.height + 4
-            else:
-                # fallback to old logic
-                sigs_sorted = sorted(sigs, key=lambda s: 0 if s['type'] == 'text' else 1)
-                for sig in sigs_sorted:
-                    if sig['type'] == 'text':
-                        text = to_thai_digits(sig.get('text', ''))
-                        # ถ้า type == "comment" ให้ font_size=18, font_weight="bold", line_height_ratio=0.96
-                        font_size = 18 if sig.get('type') == 'comment' else DEFAULT_COMMENT_FONT_SIZE
-                        font_weight = "bold" if sig.get('type') == 'comment' else "regular"
-                        line_height_ratio = 0.96 if sig.get('type') == 'comment' else 1.2
-                        orig_color = sig.get('color', (2, 53, 139))
-                        if isinstance(orig_color, (list, tuple)):
-                            r = min(int(orig_color[0]*0.8), 255)
-                            g = min(int(orig_color[1]*0.8), 255)
-                            b = min(int(orig_color[2]*0.8), 255)
-                            color = (r, g, b)
-                        else:
-                            color = (2, 53, 139)
-                        align = "left" if sig.get('type') == 'comment' else "center"
-                        img = draw_text_image_v2(text, font_path, font_size=font_size, color=color, scale=1, font_weight=font_weight, line_height_ratio=line_height_ratio, align=align)
-                        img_byte_arr = io.BytesIO()
-                        img.save(img_byte_arr, format='PNG')
-                        rect = fitz.Rect(x, current_y, x + img.width, current_y + img.height)
-                        page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                        num_lines = text.count('\n') + 1
-                        if num_lines == 1:
-                            current_y += LINE_SPACING
-                        else:
-                            current_y += img.height + 4
-                    elif sig['type'] == 'image':
-                        file_key = sig['file_key']
-                        if file_key not in request.files:
-                            continue
-                        signature_file = request.files[file_key]
-                        img = Image.open(signature_file)
-                        fixed_height = DEFAULT_SIGNATURE_HEIGHT
-                        ratio = fixed_height / img.height
-                        new_width = int(img.width * ratio)
-                        img = img.resize((new_width, fixed_height), resample=Image.LANCZOS)
-                        img_byte_arr = io.BytesIO()
-                        img.save(img_byte_arr, format='PNG')
-                        rect = fitz.Rect(x, current_y, x + new_width, current_y + fixed_height)
-                        page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                        current_y += fixed_height - 10  # ลดระยะห่างให้ใกล้กับข้อความด้านล่าง
+        execute_signature_plan(pdf, plan)
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_pdf:
-            pdf.save(tmp_pdf.name)
+        finish_vector_text(pdf)
+        response = send_pdf(pdf, "signed.pdf")
         pdf.close()
-        compress_pdf_inplace(tmp_pdf.name)
-        return send_file(tmp_pdf.name, mimetype="application/pdf", as_attachment=True, download_name="signed.pdf")
+        response.headers['X-Page-Overlay'] = ",".join(overlay_decisions)
+        return response
     except Exception as e:
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
@@ -854,54 +2425,27 @@ def generate_2in1_memo():
 
         data['doc_number'] = to_thai_digits(data.get('doc_number', ''))
         data['date'] = to_thai_digits(data.get('date', ''))
-        
-        template_path = os.path.join(os.path.dirname(__file__), "templates", "memo-template2.docx")
-        if not os.path.exists(template_path):
-            return jsonify({'error': f'Template file not found: {template_path}'}), 500
-        
-        doc = DocxTemplate(template_path)
-        doc.render(data)
-
-        # บังคับ justify ทุก paragraph (รวมใน table ด้วย)
-        # ยกเว้น paragraph ที่มี marker \u200B (ไม่ justify)
-        for paragraph in doc.paragraphs:
-            if '\u200B' in paragraph.text:
-                paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                for run in paragraph.runs:
-                    run.text = run.text.replace('\u200B', '')
-            else:
-                paragraph.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for paragraph in cell.paragraphs:
-                        if '\u200B' in paragraph.text:
-                            paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                            for run in paragraph.runs:
-                                run.text = run.text.replace('\u200B', '')
-                        else:
-                            paragraph.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+        try:
+            renderer = select_memo_renderer(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if not memo_template.refresh():
+            return jsonify({'error': f'Template file not found: {memo_template.path}'}), 500
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.docx') as tmp_docx:
-            doc.save(tmp_docx.name)
-            tmp_pdf = tmp_docx.name.replace('.docx', '.pdf')
-            convert_docx_to_pdf(tmp_docx.name, tmp_pdf)
+        pdf_for_blank, renderer = render_memo_pdf(data, renderer)
 
         # เพิ่มหน้าเปล่า 1 หน้าสำหรับพื้นที่ลายเซ็น
-        pdf_for_blank = fitz.open(tmp_pdf)
         pdf_for_blank.new_page(width=pdf_for_blank[0].rect.width, height=pdf_for_blank[0].rect.height)
-        tmp_pdf_with_blank = tmp_pdf.replace('.pdf', '_blank.pdf')
-        pdf_for_blank.save(tmp_pdf_with_blank)
+        blank_pdf_data, _ = save_pdf_bytes(pdf_for_blank)
         pdf_for_blank.close()
-        tmp_pdf = tmp_pdf_with_blank  # ใช้ไฟล์ที่มีหน้าเปล่าต่อ
 
         # ===== ส่วนที่ 2: เพิ่มลายเซ็น (จาก /add_signature_v2) =====
 
         # ตรวจสอบว่ามี signatures หรือไม่
         if 'signatures' not in request.form:
             # ถ้าไม่มี signatures ให้ return PDF ธรรมดา
-            compress_pdf_inplace(tmp_pdf)
-            return send_file(tmp_pdf, mimetype="application/pdf", as_attachment=True, download_name="memo.pdf")
+            return pdf_response(blank_pdf_data, "memo.pdf")
         
         signatures = json.loads(request.form['signatures'])
         
@@ -909,244 +2453,29 @@ def generate_2in1_memo():
         attachment_pdf = None
         if 'attachment_pdf' in request.files:
             attachment_file = request.files['attachment_pdf']
-            attachment_pdf_bytes = attachment_file.read()
-            attachment_pdf = fitz.open(stream=attachment_pdf_bytes, filetype="pdf")
+            attachment_pdf = open_upload_pdf(attachment_file)
         
-        # ฟังก์ชันวาดข้อความเป็นภาพ (v2)
-        def draw_text_image_v2(text, font_path, font_size=20, color=(2, 53, 139), scale=1, font_weight="regular"):
-            from PIL import ImageFont, ImageDraw, Image
-            if font_weight == "bold":
-                font_path = os.path.join(os.path.dirname(__file__), "fonts", "THSarabunNew Bold.ttf")
-            big_font_size = font_size * scale
-            font = ImageFont.truetype(font_path, big_font_size)
-            padding = 4 * scale
-            lines = text.split('\n')
-            dummy_img = Image.new("RGBA", (10, 10), (255, 255, 255, 0))
-            dummy_draw = ImageDraw.Draw(dummy_img)
-            line_sizes = []
-            for line in lines:
-                bbox = dummy_draw.textbbox((0, 0), line, font=font)
-                width = bbox[2] - bbox[0]
-                height = bbox[3] - bbox[1]
-                line_sizes.append((width, height, bbox))
-            max_width = max([w for w, h, _ in line_sizes]) + 2 * padding
-            total_height = sum([h for w, h, _ in line_sizes]) + 2 * padding + (len(lines)-1)*2*scale
-            img = Image.new("RGBA", (max_width, total_height), (255, 255, 255, 0))
-            draw = ImageDraw.Draw(img)
-            y = padding
-            for i, line in enumerate(lines):
-                w, h, bbox = line_sizes[i]
-                offset_x = (max_width - w) // 2
-                draw.text((offset_x, y - bbox[1]), line, font=font, fill=color)
-                y += h + 2*scale
-            return img
-
-        DEFAULT_SIGNATURE_HEIGHT = 50
-        DEFAULT_COMMENT_FONT_SIZE = 16
         font_path = os.path.join(os.path.dirname(__file__), "fonts", "THSarabunNew.ttf")
+        signature_images = SignatureImages(request.files)
+        signature_images.prefetch(signatures, MEMO_2IN1_LAYOUT)
         
         if not os.path.isfile(font_path):
             return jsonify({'error': f"Font file not found: {font_path}"}), 500
 
         # เปิด PDF ที่เพิ่งสร้าง
-        main_pdf = fitz.open(tmp_pdf)
-
-        from collections import defaultdict
-        sig_dict = defaultdict(list)
-        for sig in signatures:
-            page_number = int(sig.get('page', 0))
-            x = int(sig['x'])
-            y = int(sig['y'])
-            # แยกประเภท PDF ที่จะแปะลายเซ็น
-            pdf_type = sig.get('pdf_type', 'main')  # 'main' หรือ 'attachment'
-            sig_dict[(pdf_type, page_number, x, y)].append(sig)
-
-        # ฟังก์ชันสำหรับวาดลายเซ็น
-        def process_signatures_on_pdf(pdf, sig_dict_filtered):
-            for (page_number, x, y), sigs in sig_dict_filtered.items():
-                if page_number >= len(pdf):
-                    continue  # ข้ามถ้าหน้าไม่มี
-                page = pdf[page_number]
-                patch_page_for_visual_coords(page)
-                current_y = y
-                has_lines = any('lines' in sig for sig in sigs)
-                
-                if has_lines:
-                    for sig in sigs:
-                        lines = sig.get('lines')
-                        if not lines:
-                            # fallback to old logic
-                            if sig['type'] == 'text':
-                                text = to_thai_digits(sig.get('text', ''))
-                                font_size = 18 if sig.get('type') == 'comment' else DEFAULT_COMMENT_FONT_SIZE
-                                font_weight = "bold" if sig.get('type') == 'comment' else "regular"
-                                orig_color = sig.get('color', (2, 53, 139))
-                                if isinstance(orig_color, (list, tuple)):
-                                    r = min(int(orig_color[0]*0.8), 255)
-                                    g = min(int(orig_color[1]*0.8), 255)
-                                    b = min(int(orig_color[2]*0.8), 255)
-                                    color = (r, g, b)
-                                else:
-                                    color = (2, 53, 139)
-                                img = draw_text_image_v2(text, font_path, font_size=font_size, color=color, scale=1, font_weight=font_weight)
-                                img_byte_arr = io.BytesIO()
-                                img.save(img_byte_arr, format='PNG')
-                                left_x = x - img.width // 2
-                                rect = fitz.Rect(left_x, current_y, left_x + img.width, current_y + img.height)
-                                page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                                current_y += img.height
-                            elif sig['type'] == 'image':
-                                file_key = sig['file_key']
-                                if file_key in request.files:
-                                    signature_file = request.files[file_key]
-                                    img = Image.open(signature_file)
-                                    fixed_height = DEFAULT_SIGNATURE_HEIGHT
-                                    ratio = fixed_height / img.height
-                                    new_width = int(img.width * ratio)
-                                    img = img.resize((new_width, fixed_height), resample=Image.LANCZOS)
-                                    img_byte_arr = io.BytesIO()
-                                    img.save(img_byte_arr, format='PNG')
-                                    left_x = x - new_width // 2
-                                    rect = fitz.Rect(left_x, current_y, left_x + new_width, current_y + fixed_height)
-                                    page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                                    current_y += fixed_height
-                        else:
-                            # draw lines in order
-                            for line in lines:
-                                line_type = line.get('type')
-                                if line_type == 'image':
-                                    file_key = line.get('file_key')
-                                    if file_key and file_key in request.files:
-                                        signature_file = request.files[file_key]
-                                        img = Image.open(signature_file)
-                                        fixed_height = DEFAULT_SIGNATURE_HEIGHT
-                                        ratio = fixed_height / img.height
-                                        new_width = int(img.width * ratio)
-                                        img = img.resize((new_width, fixed_height), resample=Image.LANCZOS)
-                                        if sig_rotation:
-                                            img = apply_sig_rotation(img, sig_rotation)
-                                            new_width, fixed_height = img.size
-                                        img_byte_arr = io.BytesIO()
-                                        img.save(img_byte_arr, format='PNG')
-                                        left_x = x - new_width // 2
-                                        rect = fitz.Rect(left_x, current_y, left_x + new_width, current_y + fixed_height)
-                                        page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                                        current_y += fixed_height
-                                else:
-                                    text_value = line.get('text') or line.get('value') or line.get('comment') or ''
-
-                                    # ฟังก์ชันนับตัวอักษรที่มองเห็น (ไม่รวม tone marks, vowel marks)
-                                    def count_visible_chars(s):
-                                        thai_marks = set([
-                                            '\u0E31', '\u0E34', '\u0E35', '\u0E36', '\u0E37',
-                                            '\u0E38', '\u0E39', '\u0E3A', '\u0E47', '\u0E48',
-                                            '\u0E49', '\u0E4A', '\u0E4B', '\u0E4C', '\u0E4D', '\u0E4E'
-                                        ])
-                                        return len([c for c in s if c not in thai_marks])
-
-                                    # ฟังก์ชันตัดข้อความตามจำนวนตัวอักษรที่มองเห็น
-                                    def wrap_by_visible_chars(text, max_chars=30):
-                                        if count_visible_chars(text) <= max_chars:
-                                            return [text]
-
-                                        lines = []
-                                        current = ""
-                                        for char in text:
-                                            test = current + char
-                                            if count_visible_chars(test) <= max_chars:
-                                                current = test
-                                            else:
-                                                if current:
-                                                    lines.append(current)
-                                                current = char
-                                        if current:
-                                            lines.append(current)
-                                        return lines
-
-                                    # ถ้าเป็น comment และมี - ให้แยกเป็นหลายบรรทัด
-                                    if line_type == 'comment' and '-' in text_value:
-                                        # แยกตาม - และเก็บ - ไว้ข้างหน้าแต่ละบรรทัด
-                                        parts = text_value.split('-')
-                                        # เอา parts ที่ไม่ว่างเปล่าออกมา
-                                        text_lines = ['-' + part for part in parts if part.strip()]
-
-                                        # ตัดแต่ละบรรทัดให้ไม่เกิน 15 ตัวอักษรที่มองเห็น
-                                        wrapped_lines = []
-                                        for tline in text_lines:
-                                            wrapped = wrap_by_visible_chars(tline, max_chars=15)
-                                            wrapped_lines.extend(wrapped)
-
-                                        text = '\n'.join([to_thai_digits(t) for t in wrapped_lines])
-                                    else:
-                                        text = to_thai_digits(text_value)
-
-                                    font_size = 18 if line_type == 'comment' else DEFAULT_COMMENT_FONT_SIZE
-                                    font_weight = "bold" if line_type == 'comment' else "regular"
-                                    orig_color = line.get('color', (2, 53, 139))
-                                    if isinstance(orig_color, (list, tuple)):
-                                        r = min(int(orig_color[0]*0.8), 255)
-                                        g = min(int(orig_color[1]*0.8), 255)
-                                        b = min(int(orig_color[2]*0.8), 255)
-                                        color = (r, g, b)
-                                    else:
-                                        color = (2, 53, 139)
-                                    img = draw_text_image_v2(text, font_path, font_size=font_size, color=color, scale=1, font_weight=font_weight)
-                                    img_byte_arr = io.BytesIO()
-                                    img.save(img_byte_arr, format='PNG')
-                                    left_x = x - img.width // 2
-                                    rect = fitz.Rect(left_x, current_y, left_x + img.width, current_y + img.height)
-                                    page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                                    current_y += img.height
-                else:
-                    # fallback to old logic
-                    sigs_sorted = sorted(sigs, key=lambda s: 0 if s['type'] == 'text' else 1)
-                    for sig in sigs_sorted:
-                        if sig['type'] == 'text':
-                            text = to_thai_digits(sig.get('text', ''))
-                            font_size = 18 if sig.get('type') == 'comment' else DEFAULT_COMMENT_FONT_SIZE
-                            font_weight = "bold" if sig.get('type') == 'comment' else "regular"
-                            orig_color = sig.get('color', (2, 53, 139))
-                            if isinstance(orig_color, (list, tuple)):
-                                r = min(int(orig_color[0]*0.8), 255)
-                                g = min(int(orig_color[1]*0.8), 255)
-                                b = min(int(orig_color[2]*0.8), 255)
-                                color = (r, g, b)
-                            else:
-                                color = (2, 53, 139)
-                            img = draw_text_image_v2(text, font_path, font_size=font_size, color=color, scale=1, font_weight=font_weight)
-                            img_byte_arr = io.BytesIO()
-                            img.save(img_byte_arr, format='PNG')
-                            left_x = x - img.width // 2
-                            rect = fitz.Rect(left_x, current_y, left_x + img.width, current_y + img.height)
-                            page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                            current_y += img.height
-                        elif sig['type'] == 'image':
-                            file_key = sig['file_key']
-                            if file_key in request.files:
-                                signature_file = request.files[file_key]
-                                img = Image.open(signature_file)
-                                fixed_height = DEFAULT_SIGNATURE_HEIGHT
-                                ratio = fixed_height / img.height
-                                new_width = int(img.width * ratio)
-                                img = img.resize((new_width, fixed_height), resample=Image.LANCZOS)
-                                img_byte_arr = io.BytesIO()
-                                img.save(img_byte_arr, format='PNG')
-                                left_x = x - new_width // 2
-                                rect = fitz.Rect(left_x, current_y, left_x + new_width, current_y + fixed_height)
-                                page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                                current_y += fixed_height
-
-        # แยกลายเซ็นตามประเภท PDF
-        main_sigs = {(page, x, y): sigs for (pdf_type, page, x, y), sigs in sig_dict.items() if pdf_type == 'main'}
-        attachment_sigs = {(page, x, y): sigs for (pdf_type, page, x, y), sigs in sig_dict.items() if pdf_type == 'attachment'}
-
-        # วาดลายเซ็นลง PDF หลัก
-        if main_sigs:
-            process_signatures_on_pdf(main_pdf, main_sigs)
+        main_pdf = fitz.open("pdf", blank_pdf_data)
 
-        # วาดลายเซ็นลงเอกสารแนบ (ถ้ามี)
+        # วาดลายเซ็นลง PDF หลัก / เอกสารแนบ (แยกตาม pdf_type: 'main' หรือ 'attachment')
+        main_sigs = [sig for sig in signatures if sig.get('pdf_type', 'main') == 'main']
+        attachment_sigs = [sig for sig in signatures if sig.get('pdf_type', 'main') == 'attachment']
+        if main_sigs:
+            execute_signature_plan(main_pdf, compile_signature_plan(main_sigs, MEMO_2IN1_LAYOUT, main_pdf, signature_images, font_path))
         if attachment_pdf and attachment_sigs:
-            process_signatures_on_pdf(attachment_pdf, attachment_sigs)
+            execute_signature_plan(attachment_pdf, compile_signature_plan(attachment_sigs, MEMO_2IN1_LAYOUT, attachment_pdf, signature_images, font_path))
+
+        finish_vector_text(main_pdf)
+        if attachment_pdf:
+            finish_vector_text(attachment_pdf)
 
         # รวม PDF ทั้งหมดเป็นไฟล์เดียว
         final_pdf = fitz.open()
@@ -1159,69 +2488,136 @@ def generate_2in1_memo():
             final_pdf.insert_pdf(attachment_pdf)
 
         # บันทึก PDF ที่มีลายเซ็นแล้ว
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as final_pdf_file:
-            final_pdf.save(final_pdf_file.name)
+        response = send_pdf(final_pdf, "signed_memo.pdf")
+        response.headers['X-Memo-Renderer'] = renderer
         
         # ปิด PDF ทั้งหมด
         main_pdf.close()
         if attachment_pdf:
             attachment_pdf.close()
         final_pdf.close()
-        
-        # ลบไฟล์ชั่วคราว
-        os.unlink(tmp_pdf)
 
-        compress_pdf_inplace(final_pdf_file.name)
-        return send_file(final_pdf_file.name, mimetype="application/pdf", as_attachment=True, download_name="signed_memo.pdf")
+        return response
         
     except Exception as e:
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
 
+# --- รวม PDF หลายไฟล์ใน request เดียว ---
+# เดิม /PDFmerge รับแค่ pdf1 + pdf2 — ประกอบแฟ้มเรื่อง (memo + สิ่งที่แนบหลายไฟล์) ต้องเรียกต่อกันหลายรอบ
+# แต่ละรอบ upload/เปิด/save/compress เอกสารที่โตขึ้นเรื่อยๆ ใหม่ทั้งไฟล์ (I/O โตแบบกำลังสอง)
+# ตอนนี้รับกี่ไฟล์ก็ได้ เปิดทีละไฟล์ต่อท้ายแล้วปิดทันที (ถือ input ทีละไฟล์) แล้ว save + compress ครั้งเดียวตอนจบ
+# object ที่ซ้ำกันข้ามไฟล์ (ฟอนต์/ภาพ/ตราที่ฝังเหมือนกัน) ถูกรวมเป็นตัวเดียวตอน save (garbage=4)
+MERGE_MAX_DOCUMENTS = int(os.environ.get("MERGE_MAX_DOCUMENTS", "100"))
+
+
+def _merge_uploads():
+    """[FileStorage] ตามลำดับ — pdf ส่งซ้ำได้หลายไฟล์ หรือ pdf1, pdf2, ..., pdfN แบบเดิม (เรียงตามเลข)"""
+    uploads = request.files.getlist('pdf')
+    numbered = sorted(((int(key[3:]), f) for key, f in request.files.items(multi=True)
+                       if re.fullmatch(r"pdf\d+", key)), key=lambda kv: kv[0])
+    return uploads + [f for _, f in numbered]
+
+
+def _merge_ranges(spec, uploads):
+    """ranges ต่อไฟล์ — list ตามลำดับไฟล์ หรือ object {ชื่อไฟล์: ...} (ไม่ระบุ = ทุกหน้า)"""
+    if spec is None:
+        return [None] * len(uploads)
+    if isinstance(spec, dict):
+        unknown = sorted(set(spec) - {f.filename for f in uploads})
+        if unknown:
+            raise ValueError(f"ranges names files that were not uploaded: {', '.join(unknown)}")
+        return [spec.get(f.filename) for f in uploads]
+    if not isinstance(spec, list):
+        raise TypeError("ranges must be a list or an object keyed by filename")
+    if len(spec) != len(uploads):
+        raise ValueError(f"ranges has {len(spec)} entries for {len(uploads)} documents")
+    return spec
+
+
+def parse_page_ranges(spec, page_count):
+    """ช่วงหน้า → [(จาก, ถึง)] สำหรับ insert_pdf (เลขหน้าเริ่ม 0, ติดลบนับจากท้าย)
+    spec: None = ทุกหน้า หรือ list ของเลขหน้า / [จาก, ถึง] (รวมหน้า ถึง) เช่น [[0, 2], 5, -1]"""
+    if spec is None:
+        return [(0, page_count - 1)]
+    if not isinstance(spec, list) or not spec:
+        raise ValueError("expected a non-empty list of pages")
+
+    def page_number(n):
+        # bool เป็น subclass ของ int — true/false ใน JSON ไม่ใช่เลขหน้า
+        if isinstance(n, bool) or not isinstance(n, int):
+            raise ValueError(f"page {n!r} is not an integer")
+        return n + page_count if n < 0 else n
+
+    runs = []
+    for item in spec:
+        if isinstance(item, list) and len(item) == 2:
+            first, last = item
+        elif isinstance(item, list):
+            raise ValueError(f"page range {item} must be [from, to]")
+        else:
+            first = last = item
+        first, last = page_number(first), page_number(last)
+        if not (0 <= first < page_count and 0 <= last < page_count):
+            raise ValueError(f"page range {item} out of range for {page_count} pages")
+        # หน้าติดกันต่อเป็นช่วงเดียว — insert_pdf ครั้งเดียวต่อช่วง
+        if runs and first <= last and runs[-1][0] <= runs[-1][1] and runs[-1][1] + 1 == first:
+            runs[-1] = (runs[-1][0], last)
+        else:
+            runs.append((first, last))
+    return runs
+
+
 @app.route('/PDFmerge', methods=['POST'])
 def merge_pdfs():
-    """รวมไฟล์ PDF 2 ไฟล์เป็นไฟล์เดียว"""
+    """รวมไฟล์ PDF หลายไฟล์เป็นไฟล์เดียวตามลำดับ
+
+    multipart/form-data:
+      - pdf: ส่งซ้ำได้หลายไฟล์ (เรียงตามลำดับที่ส่ง) หรือ pdf1, pdf2, ..., pdfN แบบเดิม
+      - ranges (ไม่บังคับ): JSON — list ตามลำดับไฟล์ หรือ {ชื่อไฟล์: ...}
+        แต่ละไฟล์เป็น null (ทุกหน้า) หรือ list ของเลขหน้า (เริ่ม 0) / [จาก, ถึง]
+        เช่น [null, [[0, 2], 5], [-1]] = ไฟล์แรกทั้งหมด, หน้า 1-3 และ 6 ของไฟล์ที่สอง, หน้าสุดท้ายของไฟล์ที่สาม
+    """
     try:
-        # ตรวจสอบไฟล์ที่ส่งมา
-        if 'pdf1' not in request.files:
-            return jsonify({'error': 'No pdf1 file uploaded'}), 400
-        if 'pdf2' not in request.files:
-            return jsonify({'error': 'No pdf2 file uploaded'}), 400
-        
-        pdf1_file = request.files['pdf1']
-        pdf2_file = request.files['pdf2']
-        
-        # อ่านไฟล์ PDF เป็น bytes (blob)
-        pdf1_bytes = pdf1_file.read()
-        pdf2_bytes = pdf2_file.read()
-        
-        # เปิดไฟล์ PDF จาก bytes
-        pdf1 = fitz.open(stream=pdf1_bytes, filetype="pdf")
-        pdf2 = fitz.open(stream=pdf2_bytes, filetype="pdf")
-        
-        # สร้าง PDF ใหม่สำหรับรวมไฟล์
+        uploads = _merge_uploads()
+        if not uploads:
+            return jsonify({'error': 'No PDF files uploaded'}), 400
+        if len(uploads) > MERGE_MAX_DOCUMENTS:
+            return jsonify({'error': f'Too many documents ({len(uploads)} > {MERGE_MAX_DOCUMENTS})'}), 400
+        try:
+            ranges = _merge_ranges(json.loads(request.form['ranges']) if 'ranges' in request.form else None, uploads)
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': f'Invalid ranges: {e}'}), 400
+
+        # สร้าง PDF ใหม่สำหรับรวมไฟล์ แล้วต่อท้ายทีละไฟล์
+        # (ไฟล์ใหญ่เปิดจากไฟล์ที่ spool ไว้ ไม่อ่านเข้า memory และปิดก่อนเปิดไฟล์ถัดไป)
         merged_pdf = fitz.open()
-        
-        # เพิ่มหน้าจาก PDF แรก
-        merged_pdf.insert_pdf(pdf1)
-        
-        # เพิ่มหน้าจาก PDF ที่สอง
-        merged_pdf.insert_pdf(pdf2)
-        
-        # ปิดไฟล์ต้นฉบับ
-        pdf1.close()
-        pdf2.close()
-        
-        # บันทึกไฟล์ที่รวมแล้ว
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as merged_file:
-            merged_pdf.save(merged_file.name)
-
+        for index, (upload, spec) in enumerate(zip(uploads, ranges)):
+            name = upload.filename or f"document-{index}.pdf"
+            src = open_upload_pdf(upload)
+            try:
+                try:
+                    runs = parse_page_ranges(spec, len(src))
+                except (ValueError, TypeError) as e:
+                    merged_pdf.close()
+                    return jsonify({'error': f'Invalid ranges for {name}: {e}'}), 400
+                for from_page, to_page in runs:
+                    merged_pdf.insert_pdf(src, from_page=from_page, to_page=to_page)
+            finally:
+                src.close()
+        if len(merged_pdf) == 0:
+            merged_pdf.close()
+            return jsonify({'error': 'No pages selected'}), 400
+
+        # บันทึกไฟล์ที่รวมแล้ว (compress ครั้งเดียว)
+        response = send_pdf(merged_pdf, "merged.pdf")
+        response.headers['X-Merge-Documents'] = str(len(uploads))
+        response.headers['X-Merge-Pages'] = str(len(merged_pdf))
         merged_pdf.close()
-        compress_pdf_inplace(merged_file.name)
 
         # ส่งไฟล์กลับ
-        return send_file(merged_file.name, mimetype="application/pdf", as_attachment=True, download_name="merged.pdf")
+        return response
         
     except Exception as e:
         print(traceback.format_exc())
@@ -1259,8 +2655,7 @@ def receive_num():
         # เปิด PDF + แปลงเป็น A4 แนวตั้งถ้าไม่ใช่ A4 (เอกสารรับภายนอกมักขนาดแปลก)
         # ทำที่นี่เพราะ /receive_num คือจุดที่ไฟล์รับภายนอกเข้าระบบครั้งแรก
         # พอ normalize ก่อนประทับเลข ไฟล์ที่เก็บลง storage จะเป็น A4 → display/คลิก/เซ็นตรงกันหมด
-        pdf_bytes = request.files['pdf'].read()
-        doc = normalize_to_a4(pdf_bytes)
+        doc = normalize_to_a4(open_upload_pdf(request.files['pdf']))
         if page_no >= len(doc):
             return jsonify({'error': 'Page out of range'}), 400
         page = doc[page_no]
@@ -1321,13 +2716,11 @@ def receive_num():
 
         # ส่งไฟล์กลับ
         print("[DEBUG] Saving final PDF...")
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as outpdf:
-            doc.save(outpdf.name)
+        finish_vector_text(doc)
+        response = send_pdf(doc, "receive_num.pdf")
         doc.close()
-        compress_pdf_inplace(outpdf.name)
         print(f"[DEBUG] PDF saved, sending response...")
 
-        response = send_file(outpdf.name, mimetype="application/pdf", as_attachment=True, download_name="receive_num.pdf")
         response.headers['X-Debug'] = 'receive_num_processed'
         return response
 
@@ -1361,8 +2754,7 @@ def receive_num2():
         page_no = int(p.get('page', 0))
         color = tuple(p.get('color', [2,53,139]))
 
-        pdf_bytes = request.files['pdf'].read()
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        doc = open_upload_pdf(request.files['pdf'])
         if page_no >= len(doc):
             return jsonify({'error': 'Page out of range'}), 400
         page = doc[page_no]
@@ -1421,12 +2813,10 @@ def receive_num2():
 
         print(f"[DEBUG] Stamp at center=({center_x},{center_y}), vis_w={vis_w}, rotation={page.rotation}")
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as outpdf:
-            doc.save(outpdf.name)
+        finish_vector_text(doc)
+        response = send_pdf(doc, "receive_num2.pdf")
         doc.close()
-        compress_pdf_inplace(outpdf.name)
 
-        response = send_file(outpdf.name, mimetype="application/pdf", as_attachment=True, download_name="receive_num2.pdf")
         response.headers['X-Debug'] = 'receive_num2_processed'
         return response
 
@@ -1487,8 +2877,7 @@ def stamp_summary():
         print(f"[DEBUG] Position: page={page_number}, x={pos_x}, y={pos_y}, width={pos_width}, height={pos_height}")
 
         # เปิด PDF
-        pdf_bytes = pdf_file.read()
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        doc = open_upload_pdf(pdf_file)
         page = doc[page_number]  # ใช้หน้าที่ระบุ
         patch_page_for_visual_coords(page)
 
@@ -1525,7 +2914,7 @@ def stamp_summary():
                 return img
 
             # มี max_width ให้ wrap text
-            font = ImageFont.truetype(fp, size)
+            font = get_font(fp, size)
             padding = 4
 
             # แยกข้อความเป็นบรรทัดตาม max_width
@@ -1604,7 +2993,7 @@ def stamp_summary():
 
             # สร้างภาพ
             img = Image.new("RGBA", (img_width, img_height), (255, 255, 255, 0))
-            draw = ImageDraw.Draw(img)
+            draw = TextRunDraw(img)
 
             y = padding
             for i, line in enumerate(lines):
@@ -1757,8 +3146,8 @@ def stamp_summary():
             prefix = to_thai_digits(prefix)
             content = to_thai_digits(content)
 
-            bold_font = ImageFont.truetype(bold_font_path, size)
-            normal_font = ImageFont.truetype(font_path, size)
+            bold_font = get_font(bold_font_path, size)
+            normal_font = get_font(font_path, size)
 
             # วาด prefix (ตัวหนา) + content (ตัวปกติ) โดย wrap ทั้งหมด
             full_text = prefix + " " + content
@@ -1842,7 +3231,7 @@ def stamp_summary():
 
             # สร้างภาพและวาดข้อความ
             img = Image.new("RGBA", (img_width, img_height), (255, 255, 255, 0))
-            draw = ImageDraw.Draw(img)
+            draw = TextRunDraw(img)
 
             y = padding
             for line in lines:
@@ -1865,11 +3254,7 @@ def stamp_summary():
         img_subject = draw_mixed_text_img("เรื่อง", summary, size=font_size, max_width=text_max_width)
         img_assign = draw_mixed_text_img("เห็นควรมอบ", group_name, size=font_size, max_width=text_max_width)
 
-        sign_img_temp = Image.open(sign_file)
-        sign_height = int(30 * ps)
-        ratio = sign_height / sign_img_temp.height
-        sign_width = int(sign_img_temp.width * ratio)
-        sign_img = sign_img_temp.resize((sign_width, sign_height), Image.LANCZOS)
+        sign_img = signature_image_cache.image(sign_file.read(), int(30 * ps))
 
         sign_text = "ลงชื่อ"
         img_sign_text = draw_text_img(sign_text, size=font_size, bold=False)
@@ -1956,7 +3341,7 @@ def stamp_summary():
 
         # คำนวณตำแหน่งเริ่มต้นให้อยู่กึ่งกลาง
         sign_gap = int(5 * ps)
-        total_width = img_sign_text.width + sign_gap + sign_width
+        total_width = img_sign_text.width + sign_gap + sign_img.width
         start_x = center_x_frame - total_width//2
 
         sign_y = current_y
@@ -1976,15 +3361,13 @@ def stamp_summary():
 
         # ส่งไฟล์กลับ
         print("[DEBUG] Saving final PDF...")
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as outpdf:
-            doc.save(outpdf.name)
-            doc.close()
-            compress_pdf_inplace(outpdf.name)
-            print(f"[DEBUG] PDF saved, sending response...")
-
-            response = send_file(outpdf.name, mimetype="application/pdf", as_attachment=True, download_name="summary_stamped.pdf")
-            response.headers['X-Debug'] = 'stamp_summary_processed'
-            return response
+        finish_vector_text(doc)
+        response = send_pdf(doc, "summary_stamped.pdf")
+        doc.close()
+        print(f"[DEBUG] PDF saved, sending response...")
+
+        response.headers['X-Debug'] = 'stamp_summary_processed'
+        return response
 
     except Exception as e:
         print(f"[ERROR] {str(e)}")
@@ -2012,55 +3395,8 @@ def add_signature_receive():
     """
     print("[DEBUG] /add_signature_receive API called")
 
-    # ฟังก์ชันวาดข้อความเป็นภาพ (v2)
-    def draw_text_image_v2(text, font_path, font_size=20, color=(2, 53, 139), scale=1, font_weight="regular", line_height_ratio=1.2, align="left"):
-        from PIL import ImageFont, ImageDraw, Image
-        # เลือก font ตาม font_weight
-        if font_weight == "bold":
-            font_path = os.path.join(os.path.dirname(__file__), "fonts", "THSarabunNew Bold.ttf")
-        big_font_size = font_size * scale
-        font = ImageFont.truetype(font_path, big_font_size)
-        padding = 4 * scale
-        lines = text.split('\n')
-
-        # ใช้ fixed line height แทน bbox เพื่อหลีกเลี่ยงปัญหา tone marks ทำให้ความสูงไม่เท่ากัน
-        # รองรับการปรับ line_height_ratio (default 1.2, สำหรับ comment ใช้ 0.96 = 1.2 * 0.8)
-        fixed_line_height = int(font_size * line_height_ratio * scale)
-
-        # วัดความกว้างเท่านั้น
-        dummy_img = Image.new("RGBA", (10, 10), (255, 255, 255, 0))
-        dummy_draw = ImageDraw.Draw(dummy_img)
-        line_widths = []
-        for line in lines:
-            bbox = dummy_draw.textbbox((0, 0), line, font=font)
-            width = bbox[2] - bbox[0]
-            line_widths.append(width)
-
-        max_width = max(line_widths) + 2 * padding
-        total_height = len(lines) * fixed_line_height + 2 * padding
-
-        img = Image.new("RGBA", (max_width, total_height), (255, 255, 255, 0))
-        draw = ImageDraw.Draw(img)
-
-        content_width = max(line_widths)
-        y = padding
-        for line, lw in zip(lines, line_widths):
-            # align="center": วางแต่ละบรรทัดกึ่งกลางภายในรูป (ใช้กับ org/role ที่ตัดหลายบรรทัด)
-            # align="left" (default): ชิดซ้ายตามเดิม (comment ฯลฯ)
-            line_x = padding + (content_width - lw) / 2 if align == "center" else padding
-            # ใช้ anchor="la" (left-ascender) เพื่อยึดตำแหน่งที่ ascender line
-            # ทำให้ทุกบรรทัดวางที่ตำแหน่งเดียวกัน ไม่ว่าจะมี tone marks หรือไม่
-            # วาด 2 ครั้งซ้อนกันเพื่อให้เส้นเข้มขึ้น
-            draw.text((line_x, y), line, font=font, fill=color, anchor="la")
-            draw.text((line_x, y), line, font=font, fill=color, anchor="la")
-            y += fixed_line_height
-
-        return img
-
     try:
         # ===== ส่วนที่ 1: เพิ่มลายเซ็น (จาก /add_signature_v2) =====
-        DEFAULT_SIGNATURE_HEIGHT = 50
-        DEFAULT_COMMENT_FONT_SIZE = 16
         font_path = os.path.join(os.path.dirname(__file__), "fonts", "THSarabunNew.ttf")
         bold_font_path = os.path.join(os.path.dirname(__file__), "fonts", "THSarabunNew Bold.ttf")
 
@@ -2074,282 +3410,14 @@ def add_signature_receive():
         if 'signatures' not in request.form:
             return jsonify({'error': 'No signatures data'}), 400
         signatures = json.loads(request.form['signatures'])
+        signature_images = SignatureImages(request.files)
+        signature_images.prefetch(signatures, SIGNATURE_RECEIVE_LAYOUT)
 
-        pdf_bytes = pdf_file.read()
-        pdf = fitz.open(stream=pdf_bytes, filetype="pdf")
-
-
-        from collections import defaultdict
-        sig_dict = defaultdict(list)
-        for sig in signatures:
-            page_number = int(sig.get('page', 0))
-            x = int(sig['x'])
-            y = int(sig['y'])
-            # รองรับ width/height สำหรับ center positioning
-            width = sig.get('width', 0)
-            height = sig.get('height', 0)
-
-            # ถ้าไม่มี width/height ให้ใช้ค่า default สำหรับ center positioning
-            if width == 0 and height == 0:
-                width = 120  # default width
-                height = 60  # default height
-                print(f"DEBUG: Using default dimensions {width}x{height} for signature at ({x}, {y})")
-
-            sig_dict[(page_number, x, y, width, height)].append(sig)
-
-        for (page_number, x, y, width, height), sigs in sig_dict.items():
-            page = pdf[page_number]
-            patch_page_for_visual_coords(page)
-
-            # Debug: แสดงข้อมูล page และพิกัด
-            page_rect = page.rect
-            print(f"DEBUG: Page {page_number} - Size: {page_rect.width}x{page_rect.height}")
-            print(f"DEBUG: Original coordinates: ({x}, {y})")
-            print(f"DEBUG: Signature dimensions: {width}x{height}")
-            print(f"DEBUG: Page bounds: x(0-{page_rect.width}), y(0-{page_rect.height})")
-
-            # ถ้ามี width/height แสดงว่าเป็น center positioning
-            is_center_positioning = width > 0 and height > 0
-
-            # Logic สำหรับปรับพิกัด Y ให้กลับกัน (บนเป็นล่าง ล่างเป็นบน)
-            if is_center_positioning:
-                # สำหรับ center positioning ใช้ height ที่กำหนดมา
-                adjusted_y = page_rect.height - y - height
-                # เลื่อนลงแนวดิ่งเท่ากับ height (60)
-                adjusted_y += height+30
-                print(f"DEBUG: Y-axis flip with center positioning: {y} -> {adjusted_y} (with +{height} offset)")
-                center_x = x
-                center_y = adjusted_y
-                print(f"DEBUG: Using center positioning - adjusted coordinates")
-                print(f"DEBUG: Center point: ({center_x}, {center_y})")
-                print(f"DEBUG: Bounding box: {width}x{height}")
-            else:
-                # สำหรับ top-left positioning ใช้ default signature height
-                signature_box_height = 60  # default height สำหรับการคำนวณ
-                adjusted_y = page_rect.height - y - signature_box_height
-                # เลื่อนลงแนวดิ่งเท่ากับ 60
-                adjusted_y += 60
-                print(f"DEBUG: Y-axis flip with top-left positioning: {y} -> {adjusted_y} (with +60 offset)")
-                center_x = x
-                center_y = adjusted_y
-                print(f"DEBUG: Using top-left positioning - adjusted coordinates")
-
-            current_y = center_y  # ใช้ค่า Y ที่ปรับแล้ว
-            # อ่าน rotation จาก sig
-            sig_rotation = int(sigs[0].get('rotation', 0))
-            if sig_rotation:
-                print(f"DEBUG: Signature rotation: {sig_rotation}°")
-
-            # Check if any signature has 'lines' field
-            has_lines = any('lines' in sig for sig in sigs)
-            if has_lines:
-                # For each sig with lines, draw lines in order
-                for sig in sigs:
-                    lines = sig.get('lines')
-                    if not lines:
-                        # fallback to old logic for this sig
-                        if sig['type'] == 'text':
-                            text = to_thai_digits(sig.get('text', ''))
-                            font_size = 18 if sig.get('type') == 'comment' else DEFAULT_COMMENT_FONT_SIZE
-                            font_weight = "bold" if sig.get('type') == 'comment' else "regular"
-                            orig_color = sig.get('color', (2, 53, 139))
-                            if isinstance(orig_color, (list, tuple)):
-                                r = min(int(orig_color[0]*0.8), 255)
-                                g = min(int(orig_color[1]*0.8), 255)
-                                b = min(int(orig_color[2]*0.8), 255)
-                                color = (r, g, b)
-                            else:
-                                color = (2, 53, 139)
-                            img = draw_text_image_v2(text, font_path, font_size=font_size, color=color, scale=1, font_weight=font_weight)
-                            img_byte_arr = io.BytesIO()
-                            img.save(img_byte_arr, format='PNG')
-                            # ใช้ center positioning ถ้ามี width/height
-                            if is_center_positioning:
-                                left_x = center_x - img.width // 2
-                                top_y = center_y - img.height // 2
-                            else:
-                                left_x = x
-                                top_y = current_y
-                            rect = fitz.Rect(left_x, top_y, left_x + img.width, top_y + img.height)
-                            print(f"DEBUG: Text '{text}' placed at rect: {rect} (center_pos: {is_center_positioning})")
-                            page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                            if not is_center_positioning:
-                                current_y += img.height
-                        elif sig['type'] == 'image':
-                            file_key = sig['file_key']
-                            if file_key not in request.files:
-                                continue
-                            signature_file = request.files[file_key]
-                            img = Image.open(signature_file)
-                            fixed_height = DEFAULT_SIGNATURE_HEIGHT
-                            ratio = fixed_height / img.height
-                            new_width = int(img.width * ratio)
-                            img = img.resize((new_width, fixed_height), resample=Image.LANCZOS)
-                            # หมุนลายเซ็นตาม pin rotation
-                            if sig_rotation:
-                                img = apply_sig_rotation(img, sig_rotation)
-                                new_width, fixed_height = img.size
-                            img_byte_arr = io.BytesIO()
-                            img.save(img_byte_arr, format='PNG')
-                            # ใช้ center positioning ถ้ามี width/height
-                            if is_center_positioning:
-                                left_x = center_x - new_width // 2
-                                top_y = center_y - fixed_height // 2
-                            else:
-                                left_x = x
-                                top_y = current_y
-                            rect = fitz.Rect(left_x, top_y, left_x + new_width, top_y + fixed_height)
-                            print(f"DEBUG: Image placed at rect: {rect} (center_pos: {is_center_positioning})")
-                            page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                            if not is_center_positioning:
-                                current_y += fixed_height
-                    else:
-                        # draw lines in order - รองรับ center positioning
-                        if is_center_positioning:
-                            # สำหรับ center positioning ให้เริ่มจากด้านบนของ bounding box
-                            current_y = center_y - height // 2
-
-                        for line in lines:
-                            line_type = line.get('type')
-                            if line_type == 'image':
-                                file_key = line.get('file_key')
-                                if file_key and file_key in request.files:
-                                    signature_file = request.files[file_key]
-                                    img = Image.open(signature_file)
-                                    fixed_height = DEFAULT_SIGNATURE_HEIGHT
-                                    ratio = fixed_height / img.height
-                                    new_width = int(img.width * ratio)
-                                    img = img.resize((new_width, fixed_height), resample=Image.LANCZOS)
-                                    img_byte_arr = io.BytesIO()
-                                    img.save(img_byte_arr, format='PNG')
-
-                                    if is_center_positioning:
-                                        left_x = center_x - new_width // 2
-                                        top_y = current_y
-                                        print(f"DEBUG: Image center positioning - center_x:{center_x}, new_width:{new_width}, left_x:{left_x}")
-                                        print(f"DEBUG: Expected position - should place image at left edge: {left_x}")
-                                    else:
-                                        left_x = x
-                                        top_y = current_y
+        pdf = open_upload_pdf(pdf_file)
 
-                                    rect = fitz.Rect(left_x, top_y, left_x + new_width, top_y + fixed_height)
-                                    print(f"DEBUG: Image rect: {rect}")
-                                    page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                                    current_y += fixed_height
-                            else:
-                                # For text types: 'comment', 'name', 'position', 'academic_rank', 'org_structure_role', 'timestamp'
-                                text_value = line.get('text') or line.get('value') or line.get('comment') or ''
-
-                                # ฟังก์ชันนับตัวอักษรที่มองเห็น (ไม่รวม tone marks, vowel marks)
-                                def count_visible_chars(s):
-                                    thai_marks = set([
-                                        '\u0E31', '\u0E34', '\u0E35', '\u0E36', '\u0E37',
-                                        '\u0E38', '\u0E39', '\u0E3A', '\u0E47', '\u0E48',
-                                        '\u0E49', '\u0E4A', '\u0E4B', '\u0E4C', '\u0E4D', '\u0E4E'
-                                    ])
-                                    return len([c for c in s if c not in thai_marks])
-
-                                # ฟังก์ชันตัดข้อความตามจำนวนตัวอักษรที่มองเห็น
-                                def wrap_by_visible_chars(text, max_chars=30):
-                                    if count_visible_chars(text) <= max_chars:
-                                        return [text]
-
-                                    lines = []
-                                    current = ""
-                                    for char in text:
-                                        test = current + char
-                                        if count_visible_chars(test) <= max_chars:
-                                            current = test
-                                        else:
-                                            if current:
-                                                lines.append(current)
-                                            current = char
-                                    if current:
-                                        lines.append(current)
-                                    return lines
-
-                                # ถ้าเป็น comment และมี - ให้แยกเป็นหลายบรรทัด
-                                if line_type == 'comment' and '-' in text_value:
-                                    # แยกตาม - และเก็บ - ไว้ข้างหน้าแต่ละบรรทัด
-                                    parts = text_value.split('-')
-                                    # เอา parts ที่ไม่ว่างเปล่าออกมา
-                                    text_lines = ['-' + part for part in parts if part.strip()]
-
-                                    # ตัดแต่ละบรรทัดให้ไม่เกิน 30 ตัวอักษรที่มองเห็น
-                                    wrapped_lines = []
-                                    for tline in text_lines:
-                                        wrapped = wrap_by_visible_chars(tline, max_chars=30)
-                                        wrapped_lines.extend(wrapped)
-
-                                    text = '\n'.join([to_thai_digits(t) for t in wrapped_lines])
-                                else:
-                                    text = to_thai_digits(text_value)
-                                font_size = 18 if line_type == 'comment' else DEFAULT_COMMENT_FONT_SIZE
-                                font_weight = "bold" if line_type == 'comment' else "regular"
-                                line_height_ratio = 0.96 if line_type == 'comment' else 1.2
-                                orig_color = line.get('color', (2, 53, 139))
-                                if isinstance(orig_color, (list, tuple)):
-                                    r = min(int(orig_color[0]*0.8), 255)
-                                    g = min(int(orig_color[1]*0.8), 255)
-                                    b = min(int(orig_color[2]*0.8), 255)
-                                    color = (r, g, b)
-                                else:
-                                    color = (2, 53, 139)
-                                align = "left" if line_type == 'comment' else "center"
-                                img = draw_text_image_v2(text, font_path, font_size=font_size, color=color, scale=1, font_weight=font_weight, line_height_ratio=line_height_ratio, align=align)
-                                img_byte_arr = io.BytesIO()
-                                img.save(img_byte_arr, format='PNG')
-
-                                if is_center_positioning:
-                                    left_x = center_x - img.width // 2
-                                    top_y = current_y
-                                    print(f"DEBUG: Text center positioning - center_x:{center_x}, img.width:{img.width}, left_x:{left_x}")
-                                    print(f"DEBUG: Expected position - should place text at left edge: {left_x}")
-                                else:
-                                    left_x = x
-                                    top_y = current_y
 
-                                rect = fitz.Rect(left_x, top_y, left_x + img.width, top_y + img.height)
-                                print(f"DEBUG: Text '{text}' rect: {rect}")
-                                page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                                current_y += img.height
-            else:
-                # fallback to old logic
-                sigs_sorted = sorted(sigs, key=lambda s: 0 if s['type'] == 'text' else 1)
-                for sig in sigs_sorted:
-                    if sig['type'] == 'text':
-                        text = to_thai_digits(sig.get('text', ''))
-                        font_size = 18 if sig.get('type') == 'comment' else DEFAULT_COMMENT_FONT_SIZE
-                        font_weight = "bold" if sig.get('type') == 'comment' else "regular"
-                        orig_color = sig.get('color', (2, 53, 139))
-                        if isinstance(orig_color, (list, tuple)):
-                            r = min(int(orig_color[0]*0.8), 255)
-                            g = min(int(orig_color[1]*0.8), 255)
-                            b = min(int(orig_color[2]*0.8), 255)
-                            color = (r, g, b)
-                        else:
-                            color = (2, 53, 139)
-                        img = draw_text_image_v2(text, font_path, font_size=font_size, color=color, scale=1, font_weight=font_weight)
-                        img_byte_arr = io.BytesIO()
-                        img.save(img_byte_arr, format='PNG')
-                        rect = fitz.Rect(x, current_y, x + img.width, current_y + img.height)
-                        page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                        current_y += img.height
-                    elif sig['type'] == 'image':
-                        file_key = sig['file_key']
-                        if file_key not in request.files:
-                            continue
-                        signature_file = request.files[file_key]
-                        img = Image.open(signature_file)
-                        fixed_height = DEFAULT_SIGNATURE_HEIGHT
-                        ratio = fixed_height / img.height
-                        new_width = int(img.width * ratio)
-                        img = img.resize((new_width, fixed_height), resample=Image.LANCZOS)
-                        img_byte_arr = io.BytesIO()
-                        img.save(img_byte_arr, format='PNG')
-                        rect = fitz.Rect(x, current_y, x + new_width, current_y + fixed_height)
-                        page.insert_image(rect, stream=img_byte_arr.getvalue(), overlay=True)
-                        current_y += fixed_height
+        plan = compile_signature_plan(signatures, SIGNATURE_RECEIVE_LAYOUT, pdf, signature_images, font_path)
+        execute_signature_plan(pdf, plan)
 
         # ===== ส่วนที่ 2: เพิ่มตราสรุป (จาก /stamp_summary) =====
         if 'summary_payload' in request.form and 'sign_png' in request.files:
@@ -2440,7 +3508,7 @@ def add_signature_receive():
                     return img
 
                 # มี max_width ให้ wrap text
-                font = ImageFont.truetype(fp, size)
+                font = get_font(fp, size)
                 padding = 4
 
                 # แยกข้อความเป็นบรรทัดตาม max_width
@@ -2519,7 +3587,7 @@ def add_signature_receive():
 
                 # สร้างภาพ
                 img = Image.new("RGBA", (img_width, img_height), (255, 255, 255, 0))
-                draw = ImageDraw.Draw(img)
+                draw = TextRunDraw(img)
 
                 y = padding
                 for i, line in enumerate(lines):
@@ -2550,8 +3618,8 @@ def add_signature_receive():
                 prefix = to_thai_digits(prefix)
                 content = to_thai_digits(content)
 
-                bold_font = ImageFont.truetype(bold_font_path, size)
-                normal_font = ImageFont.truetype(font_path, size)
+                bold_font = get_font(bold_font_path, size)
+                normal_font = get_font(font_path, size)
 
                 # วาด prefix (ตัวหนา) + content (ตัวปกติ) โดย wrap ทั้งหมด
                 full_text = prefix + " " + content
@@ -2631,7 +3699,7 @@ def add_signature_receive():
 
                 # สร้างภาพและวาดข้อความ
                 img = Image.new("RGBA", (img_width, img_height), (255, 255, 255, 0))
-                draw = ImageDraw.Draw(img)
+                draw = TextRunDraw(img)
 
                 y = padding
                 for line in lines:
@@ -2651,11 +3719,7 @@ def add_signature_receive():
             img_subject = draw_mixed_text_img("เรื่อง", summary, size=font_size, max_width=text_max_width)
             img_assign = draw_mixed_text_img("เห็นควรมอบ", group_name, size=font_size, max_width=text_max_width)
 
-            sign_img_temp = Image.open(sign_file)
-            sign_height = 30
-            ratio = sign_height / sign_img_temp.height
-            sign_width = int(sign_img_temp.width * ratio)
-            sign_img = sign_img_temp.resize((sign_width, sign_height), Image.LANCZOS)
+            sign_img = signature_image_cache.image(sign_file.read(), 30)
 
             sign_text = "ลงชื่อ"
             img_sign_text = draw_text_img(sign_text, size=font_size, bold=False)
@@ -2698,9 +3762,7 @@ def add_signature_receive():
 
             def paste_at_position(img, x, y):
                 rect = fitz.Rect(x, y, x+img.width, y+img.height)
-                bio = io.BytesIO()
-                img.save(bio, format='PNG')
-                page.insert_image(rect, stream=bio.getvalue(), overlay=True)
+                insert_text_image(page, rect, img)
 
             # วาดข้อความในตรา (ใช้ภาพที่สร้างไว้แล้ว)
             # ใช้ระยะห่างแบบเดิม
@@ -2723,7 +3785,7 @@ def add_signature_receive():
             # ลายเซ็น (ใช้ภาพที่สร้างไว้แล้ว)
             center_x_frame = box_left + stamp_width//2
 
-            total_width = img_sign_text.width + 5 + sign_width
+            total_width = img_sign_text.width + 5 + sign_img.width
             start_x = center_x_frame - total_width//2
 
             sign_y = current_y
@@ -2740,13 +3802,11 @@ def add_signature_receive():
             paste_at_position(img_date, center_x_frame - img_date.width//2, current_y)
 
         # บันทึกและส่งไฟล์กลับ
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_pdf:
-            pdf.save(tmp_pdf.name)
+        finish_vector_text(pdf)
+        response = send_pdf(pdf, "signed_receive.pdf")
         pdf.close()
-        compress_pdf_inplace(tmp_pdf.name)
 
         print("[DEBUG] PDF saved, sending response...")
-        response = send_file(tmp_pdf.name, mimetype="application/pdf", as_attachment=True, download_name="signed_receive.pdf")
         response.headers['X-Debug'] = 'add_signature_receive_processed'
         return response
 
@@ -2755,12 +3815,699 @@ def add_signature_receive():
         return jsonify({'error': str(e)}), 500
 
 
+# --- Batch: ลงนามหลาย PDF ใน request เดียว (ตรรกะเดียวกับ /add_signature_v2) ---
+# ลงนาม memo 20-50 ฉบับติดกันด้วยผู้ลงนามคนเดิม เดิมต้อง upload ทีละฉบับ และ decode/resize ภาพลายเซ็นเดิมซ้ำทุกครั้ง
+# multipart:
+#   pdf (ส่งซ้ำได้หลายไฟล์) และ/หรือ archive (zip ของ PDF เรียงตามชื่อ)
+#   signatures: JSON — list ของ signature ใช้กับทุกฉบับ, list ของ list ตามลำดับเอกสาร,
+#               หรือ object {ชื่อไฟล์: [...]} ต่อฉบับ
+#   ไฟล์ภาพลายเซ็นตาม file_key แบบเดียวกับ /add_signature_v2 (แชร์ทุกฉบับ)
+# ตอบกลับเป็น zip (default) หรือ multipart/mixed (?format=multipart) ฉบับที่ error อยู่ใน errors.json / part ที่ status ไม่ใช่ 200
+# ไม่อ่าน/แตกไฟล์ล่วงหน้า: ตรวจจำนวนและขนาดหลังแตก (file_size ใน zip) ก่อน แล้วเปิดทีละฉบับตอนลงนาม
+# (zip เล็กๆ ที่แตกแล้วใหญ่มากถูกปฏิเสธก่อนอ่าน, PDF ที่ spool ลง disk ส่งต่อเป็น stream ไม่อ่านเข้า memory)
+BATCH_MAX_DOCUMENTS = int(os.environ.get("BATCH_MAX_DOCUMENTS", "50"))
+BATCH_MAX_DOCUMENT_BYTES = int(os.environ.get("BATCH_MAX_DOCUMENT_BYTES", str(64 * 1024 * 1024)))
+BATCH_MAX_ARCHIVE_BYTES = int(os.environ.get("BATCH_MAX_ARCHIVE_BYTES", str(256 * 1024 * 1024)))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "2"))
+
+
+def _batch_documents(archive):
+    """[(ชื่อไฟล์, ฟังก์ชันเปิด stream)] ตามลำดับที่ส่งมา — ยังไม่อ่านเนื้อไฟล์
+    raise ValueError ถ้าจำนวนเอกสารหรือขนาดหลังแตก zip เกินเพดาน"""
+    documents = [(f.filename or f"document-{i}.pdf", functools.partial(getattr, f, "stream"))
+                 for i, f in enumerate(request.files.getlist('pdf'))]
+    entries = []
+    if archive is not None:
+        entries = sorted((info for info in archive.infolist()
+                          if info.filename.lower().endswith('.pdf') and not info.is_dir()),
+                         key=lambda info: info.filename)
+    if len(documents) + len(entries) > BATCH_MAX_DOCUMENTS:
+        raise ValueError(f"Too many documents ({len(documents) + len(entries)} > {BATCH_MAX_DOCUMENTS})")
+    total = 0
+    for info in entries:
+        # file_size คือขนาดหลังแตก — ZipExtFile อ่านไม่เกินนี้ (ข้อมูลไม่ตรง → BadZipFile ตอนอ่าน)
+        if info.file_size > BATCH_MAX_DOCUMENT_BYTES:
+            raise ValueError(f"{info.filename} is too large ({info.file_size} > {BATCH_MAX_DOCUMENT_BYTES} bytes)")
+        total += info.file_size
+        if total > BATCH_MAX_ARCHIVE_BYTES:
+            raise ValueError(f"archive is too large when extracted (> {BATCH_MAX_ARCHIVE_BYTES} bytes)")
+        documents.append((os.path.basename(info.filename), functools.partial(archive.open, info)))
+    return documents
+
+
+def _batch_output_name(index, name):
+    """ชื่อไฟล์ผลของฉบับที่ index — ชื่อจาก client ตัด path และตัวควบคุม (CR/LF ฯลฯ) ทิ้ง"""
+    name = os.path.basename(name.replace("\\", "/"))
+    name = "".join(ch for ch in name if ch.isprintable()) or f"document-{index}.pdf"
+    return f"signed_{index:03d}_{name}"
+
+
+def _content_disposition(filename):
+    """Content-Disposition ของ part — filename= เป็น ASCII ล้วน + filename*= (RFC 5987) เก็บชื่อไทยเต็ม"""
+    fallback = secure_filename(filename) or "document.pdf"
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{urllib.parse.quote(filename, safe='')}"
+
+
+def _batch_signatures(spec, documents):
+    if isinstance(spec, dict):
+        return [spec.get(name) for name, _ in documents]
+    if spec and all(isinstance(item, list) for item in spec):
+        if len(spec) != len(documents):
+            raise ValueError(f"signatures has {len(spec)} lists for {len(documents)} documents")
+        return spec
+    return [spec] * len(documents)
+
+
+@app.route('/add_signature_v2_batch', methods=['POST'])
+def add_signature_v2_batch():
+    try:
+        if 'signatures' not in request.form:
+            return jsonify({'error': 'No signatures data'}), 400
+        try:
+            archive = zipfile.ZipFile(request.files['archive']) if 'archive' in request.files else None
+        except zipfile.BadZipFile as e:
+            return jsonify({'error': f'Invalid archive: {e}'}), 400
+        try:
+            return _sign_batch(archive)
+        finally:
+            if archive is not None:
+                archive.close()
+    except Exception as e:
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+
+def _sign_batch(archive):
+    """ลงนามทุกฉบับใน request batch ปัจจุบัน (archive = ZipFile ที่เปิดค้างไว้จนเสร็จ หรือ None)"""
+    try:
+        documents = _batch_documents(archive)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not documents:
+        return jsonify({'error': 'No PDF files (pdf or archive)'}), 400
+    try:
+        per_document = _batch_signatures(json.loads(request.form['signatures']), documents)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # ภาพลายเซ็นส่งให้ทุกฉบับผ่าน shared_images (request.files ของ batch) — ไม่ต้องแนบซ้ำใน request ย่อย
+    # field อื่น (เช่น text_mode) และ query string ส่งต่อให้ทุกฉบับเหมือนกัน
+    form_fields = {k: v for k, v in request.form.items() if k != 'signatures'}
+    query_string = request.query_string.decode()
+    shared_images = SignatureImages(request.files)
+
+    def sign(index):
+        name, open_document = documents[index]
+        if per_document[index] is None:
+            return name, (400, {}, json.dumps({'error': f'No signatures for {name}'}).encode())
+        data = dict(form_fields)
+        data['signatures'] = json.dumps(per_document[index])
+        # body ของ request ย่อยเกิน threshold → EnvironBuilder spool ลง tempfile (อ่าน stream ทีละ chunk)
+        # request ย่อยเปิด PDF ผ่าน open_upload_pdf จากไฟล์ที่ spool ไว้ — ไม่มีฉบับไหนถูกอ่านทั้งก้อนเข้า memory
+        stream = open_document()
+        try:
+            data['pdf'] = (stream, name)
+            builder = EnvironBuilder(path='/add_signature_v2', method='POST', data=data, query_string=query_string)
+            environ = builder.get_environ()
+        finally:
+            stream.close()
+        environ["memo.signature_images"] = shared_images
+        with app.request_context(environ):
+            response = app.make_response(add_signature_v2())
+            result = capture_response(response)
+            response.close()
+        return name, result
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, BATCH_WORKERS)) as executor:
+        results = list(executor.map(sign, range(len(documents))))
+
+    failed = sum(1 for _, (status, _, _) in results if status != 200)
+    if request.args.get('format') == 'multipart':
+        boundary = uuid.uuid4().hex
+        body = io.BytesIO()
+        for i, (name, (status, headers_out, content)) in enumerate(results):
+            body.write(f"--{boundary}\r\n".encode())
+            body.write(f"Content-Type: {headers_out.get('Content-Type', 'application/octet-stream')}\r\n".encode())
+            body.write(f"Content-Disposition: {_content_disposition(_batch_output_name(i, name))}\r\n".encode())
+            body.write(f"X-Status: {status}\r\n".encode())
+            for k, v in headers_out.items():
+                if k.startswith("X-"):
+                    body.write(f"{k}: {v}\r\n".encode())
+            body.write(b"\r\n")
+            body.write(content)
+            body.write(b"\r\n")
+        body.write(f"--{boundary}--\r\n".encode())
+        response = app.response_class(body.getvalue(), mimetype=f"multipart/mixed; boundary={boundary}")
+    else:
+        out = io.BytesIO()
+        errors = {}
+        # PDF ผ่าน deflate มาแล้ว — ZIP_STORED ไม่ต้องบีบซ้ำ
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_STORED) as zf:
+            for i, (name, (status, _, content)) in enumerate(results):
+                if status == 200:
+                    zf.writestr(_batch_output_name(i, name), content)
+                else:
+                    errors[f"{i:03d}_{name}"] = {"status": status, "body": content.decode("utf-8", "replace")}
+            if errors:
+                zf.writestr("errors.json", json.dumps(errors, ensure_ascii=False, indent=2))
+        response = send_file(io.BytesIO(out.getvalue()), mimetype="application/zip",
+                             as_attachment=True, download_name="signed.zip")
+    response.headers['X-Batch-Documents'] = str(len(results))
+    response.headers['X-Batch-Failed'] = str(failed)
+    return response
+
+
+# --- Async job API: ส่งงานยาวๆ เข้าคิวแล้ว poll ผล ---
+# /2in1memo, /add_signature_v2 ใช้เวลาหลายวินาที (LibreOffice, rasterize, qpdf) ถือ connection + thread ไว้ตลอด
+# และ frontend failover (DEPLOYMENT.md) ยิงซ้ำหลัง timeout 10 s → งานเดียวกันทำซ้ำหลายรอบ
+# POST /jobs/<route> (body/headers เหมือนเรียก route ตรงๆ) → 202 + job_id ทันที
+# GET /jobs/<id> → สถานะ, GET /jobs/<id>/result → response ของ handler เดิมทุกอย่าง
+# header Idempotency-Key: ส่งซ้ำด้วย key เดิม → ได้ job เดิม (ไม่เริ่มงานใหม่)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "16"))
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", "600"))  # วินาทีที่เก็บผลไว้หลังงานเสร็จ
+# body ของผลเขียนลง disk (JOB_RESULT_DIR) — memory ถือแค่ status/header
+# เก็บไว้จนหมด TTL หรือ client สั่ง DELETE /jobs/<id> (ดาวน์โหลดหลุดกลางทางแล้วดึงซ้ำได้)
+# รวมกันเกิน JOB_RESULT_MAX_BYTES → ทิ้งผลที่เสร็จนานสุดก่อน
+JOB_RESULT_DIR = os.environ.get("JOB_RESULT_DIR") or None
+JOB_RESULT_MAX_BYTES = int(os.environ.get("JOB_RESULT_MAX_BYTES", str(256 * 1024 * 1024)))
+# header ของ response เดิมที่เก็บไว้ส่งต่อตอนดึงผล
+JOB_RESULT_HEADERS = ("Content-Type", "Content-Disposition")
+
+
+class Job:
+    def __init__(self, job_id, endpoint, environ, fingerprint):
+        self.id = job_id
+        self.endpoint = endpoint
+        self.environ = environ
+        self.fingerprint = fingerprint
+        self.status = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None  # (status_code, headers, path ของ body บน disk)
+        self.result_size = 0
+        self.error = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        info = {
+            "job_id": self.id,
+            "endpoint": self.endpoint,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if self.result is not None:
+            info["http_status"] = self.result[0]
+        if self.error:
+            info["error"] = self.error
+        return info
+
+
+class JobQueue:
+    """คิวจำกัดขนาด + worker threads ที่รัน view function เดิมด้วย request ที่จำไว้"""
+
+    def __init__(self, workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE):
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.keys = {}
+        self.started = False
+        self.closed = False  # process กำลังจบ — ไม่รับงานใหม่
+
+    def _start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for _ in range(self.workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def _purge(self):
+        now = time.time()
+        with self.lock:
+            finished = sorted((job for job in self.jobs.values() if job.finished is not None),
+                              key=lambda job: job.finished)
+            total = sum(job.result_size for job in finished)
+            for job in finished:
+                if now - job.finished > JOB_RESULT_TTL or total > JOB_RESULT_MAX_BYTES:
+                    total -= job.result_size
+                    self._drop(job)
+            for key in [k for k, job_id in self.keys.items() if job_id not in self.jobs]:
+                del self.keys[key]
+
+    def _drop(self, job):
+        """ลบ job + ไฟล์ผล (เรียกโดยถือ self.lock)"""
+        self.jobs.pop(job.id, None)
+        if job.result is not None:
+            try:
+                os.unlink(job.result[2])
+            except OSError:
+                pass
+
+    def discard(self, job_id):
+        """ทิ้ง job ที่เสร็จแล้วตามคำขอของ client (DELETE) — คืน False ถ้าไม่มีหรือยังไม่เสร็จ"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.finished is None:
+                return False
+            self._drop(job)
+            for key in [k for k, kept in self.keys.items() if kept == job_id]:
+                del self.keys[key]
+            return True
+
+    def get(self, job_id):
+        self._purge()
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def submit(self, endpoint, environ, fingerprint, idempotency_key=None):
+        """คืน (job, created) — raise queue.Full ถ้าคิวเต็ม, ValueError ถ้า key เดิมแต่ body ไม่ตรง"""
+        self._start()
+        self._purge()
+        with self.lock:
+            if self.closed:
+                raise queue.Full
+            if idempotency_key:
+                job = self.jobs.get(self.keys.get((endpoint, idempotency_key)))
+                if job is not None:
+                    if job.fingerprint != fingerprint:
+                        raise ValueError("Idempotency-Key was already used with a different request")
+                    return job, False
+            job = Job(uuid.uuid4().hex, endpoint, environ, fingerprint)
+            self.queue.put_nowait(job)
+            self.jobs[job.id] = job
+            if idempotency_key:
+                self.keys[(endpoint, idempotency_key)] = job.id
+        return job, True
+
+    def shutdown(self):
+        """process กำลังจบ (gunicorn recycle/restart): job อยู่ใน memory ของ process นี้เท่านั้น
+        หลังจากนี้ไม่มีใครดึงผลได้ — ไม่รับงานใหม่, ทิ้งงานที่ยังไม่เริ่ม และลบไฟล์ผลทั้งหมด"""
+        with self.lock:
+            self.closed = True
+            for job in [job for job in self.jobs.values() if job.status != "running"]:
+                self._drop(job)
+            self.keys.clear()
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if self.closed:
+                self.queue.task_done()
+                continue
+            job.status = "running"
+            job.started = time.time()
+            try:
+                with app.request_context(job.environ):
+                    response = app.make_response(app.view_functions[job.endpoint]())
+                    job.result, job.result_size = spool_response(response)
+                    response.close()
+                job.status = "done"
+            except Exception as e:
+                print(traceback.format_exc())
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                job.environ = None
+                job.finished = time.time()
+                job.done.set()
+                self.queue.task_done()
+            if self.closed:
+                # เสร็จหลัง shutdown — ไม่มีใครดึงผลได้แล้ว
+                with self.lock:
+                    self._drop(job)
+                continue
+            # บังคับเพดาน JOB_RESULT_MAX_BYTES ทันทีที่มีผลใหม่
+            self._purge()
+
+
+job_queue = JobQueue()
+
+
+def capture_response(response):
+    """(status_code, headers, body) ของ response — อ่าน body ออกมาเก็บ (รวม send_file)"""
+    response.direct_passthrough = False
+    headers = {k: v for k, v in response.headers.items()
+               if k in JOB_RESULT_HEADERS or k.startswith("X-")}
+    return response.status_code, headers, response.get_data()
+
+
+def spool_response(response, prefix="job-"):
+    """เขียน body ของ response ลงไฟล์ — คืน ((status_code, headers, path), ขนาด body)"""
+    response.direct_passthrough = False
+    headers = {k: v for k, v in response.headers.items()
+               if k in JOB_RESULT_HEADERS or k.startswith("X-")}
+    fd, path = tempfile.mkstemp(dir=JOB_RESULT_DIR, prefix=prefix, suffix=".out")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in response.iter_encoded():
+                f.write(chunk)
+            size = f.tell()
+    except Exception:
+        os.unlink(path)
+        raise
+    return (response.status_code, headers, path), size
+
+
+def replay_spooled_response(result):
+    status_code, headers, path = result
+    response = send_file(path, mimetype=headers.get("Content-Type", "application/octet-stream"), conditional=False)
+    response.status_code = status_code
+    for k, v in headers.items():
+        response.headers[k] = v
+    return response
+
+
+def request_fingerprint():
+    """hash ของเนื้อหา request — multipart ที่ส่งซ้ำได้ boundary ใหม่ทุกครั้ง
+    จึง hash ทีละ field/ไฟล์แทน raw body (ต้องเรียกหลัง request.get_data())"""
+    h = hashlib.sha256()
+    h.update(request.path.encode())
+    h.update(request.query_string)
+    if request.form or request.files:
+        for key, value in sorted(request.form.items(multi=True)):
+            h.update(f"\0{key}={value}".encode())
+        for key, f in sorted(request.files.items(multi=True), key=lambda kv: kv[0]):
+            h.update(f"\0{key}:".encode())
+            h.update(hashlib.sha256(f.read()).digest())
+            f.seek(0)
+    else:
+        h.update(request.get_data())
+    return h.hexdigest()
+
+
+def _job_environ():
+    """สำเนา WSGI environ ของ request ปัจจุบัน พร้อม body ที่อ่านไว้แล้ว (ใช้ได้หลัง response ปิด)"""
+    body = request.get_data()
+    environ = {k: v for k, v in request.environ.items()
+               if k.isupper() or k.startswith("wsgi.") and k != "wsgi.input"}
+    environ["wsgi.input"] = io.BytesIO(body)
+    environ["CONTENT_LENGTH"] = str(len(body))
+    return environ, request_fingerprint()
+
+
+@app.route('/jobs/<path:target>', methods=['POST'])
+def submit_job(target):
+    try:
+        endpoint, _ = app.url_map.bind("").match("/" + target, method="POST")
+    except Exception:
+        return jsonify({'error': f'Unknown route: /{target}'}), 404
+    if endpoint == "submit_job":
+        return jsonify({'error': 'Jobs cannot submit jobs'}), 400
+
+    environ, fingerprint = _job_environ()
+    # ให้ handler เห็น path เดิมเหมือนถูกเรียกตรงๆ
+    environ["PATH_INFO"] = "/" + target
+    try:
+        job, created = job_queue.submit(endpoint, environ, fingerprint, request.headers.get("Idempotency-Key"))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except queue.Full:
+        if job_queue.closed:
+            response = jsonify({'error': 'Worker is restarting, submit again'})
+        else:
+            response = jsonify({'error': 'Job queue is full, retry later'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    response = jsonify(dict(job.to_dict(),
+                            status_url=f"/jobs/{job.id}",
+                            result_url=f"/jobs/{job.id}/result"))
+    response.headers['Location'] = f"/jobs/{job.id}"
+    response.headers['X-Job-Created'] = '1' if created else '0'
+    return response, 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    # ?wait=<วินาที> รอผลได้สั้นๆ (0-30) ก่อนตอบว่ายังไม่เสร็จ
+    try:
+        wait = float(request.args.get("wait", 0) or 0)
+    except ValueError:
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    if not math.isfinite(wait):
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    wait = min(max(wait, 0), 30)
+    if wait > 0:
+        job.done.wait(wait)
+    if job.status == "failed":
+        return jsonify({'error': job.error}), 500
+    if job.result is None:
+        return jsonify(job.to_dict()), 202
+    try:
+        return replay_spooled_response(job.result)
+    except OSError:
+        # ไฟล์ผลถูกทิ้งไปแล้ว (หมดอายุ/ถูก DELETE/เกินเพดาน ระหว่างรอ)
+        return jsonify({'error': 'Job not found or expired'}), 404
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    """client ดึงผลไปแล้ว — ทิ้งผลก่อนหมด TTL (ดาวน์โหลดซ้ำได้จนกว่าจะ DELETE หรือหมดอายุ)"""
+    if job_queue.get(job_id) is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    if not job_queue.discard(job_id):
+        return jsonify({'error': 'Job is still running'}), 409
+    return '', 204
+
+
+# --- Idempotency-Key สำหรับทุก POST route ---
+# frontend failover ส่ง request เดิมซ้ำหลัง timeout → /receive_num, /add_signature_v2 ถูกทำซ้ำหลายรอบ
+# ส่ง header Idempotency-Key มา: ถ้างานเดิมยังทำอยู่ ตัวที่สองรอผลของตัวแรก (ไม่ทำซ้ำ)
+# ถ้าเสร็จแล้วภายใน IDEMPOTENCY_TTL วินาที ได้ response เดิมกลับไปทันที
+# ไม่เก็บ response 5xx (retry ควรได้ทำงานใหม่) — /jobs ใช้ key ของตัวเอง (ผูกกับ job)
+# body ที่เก็บเขียนลง disk แบบเดียวกับผลของ job (spool_response) — memory ถือแค่ status/header
+# รวมกันเกิน IDEMPOTENCY_MAX_BYTES → ทิ้งตัวที่เสร็จนานสุดก่อน
+# ตัวที่รอผลของ request เดิมกิน thread ของ gthread — รอพร้อมกันได้ไม่เกิน IDEMPOTENCY_MAX_WAITERS
+# เกินนั้นได้ 409 + Retry-After ทันที (ไม่ให้ retry ไม่กี่ตัวกิน thread ทั้ง 4 ของ worker)
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", "300"))
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", "120"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", "256"))
+IDEMPOTENCY_MAX_BYTES = int(os.environ.get("IDEMPOTENCY_MAX_BYTES", str(128 * 1024 * 1024)))
+IDEMPOTENCY_MAX_WAITERS = int(os.environ.get("IDEMPOTENCY_MAX_WAITERS", "1"))
+
+
+class IdempotencyStore:
+    """key → งานที่กำลังทำ/ผลที่เก็บไว้ (ใน memory ของ process นี้)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.rejected = 0
+        self.waiters = 0
+        self.stored_bytes = 0
+
+    def _drop(self, key):
+        """ลบ entry + ไฟล์ body (เรียกโดยถือ self.lock)"""
+        entry = self.entries.pop(key)
+        if entry["result"] is not None:
+            self.stored_bytes -= entry["size"]
+            try:
+                os.unlink(entry["result"][2])
+            except OSError:
+                pass
+
+    def _purge(self):
+        now = time.time()
+        for key in [k for k, e in self.entries.items() if e["expires"] is not None and e["expires"] < now]:
+            self._drop(key)
+        # เรียงตามเวลาที่เสร็จ (finish ย้ายไปท้าย) — ทิ้งตัวเก่าสุดก่อน ตัวที่ยังทำอยู่ไม่แตะ
+        while len(self.entries) > IDEMPOTENCY_MAX_ENTRIES or self.stored_bytes > IDEMPOTENCY_MAX_BYTES:
+            key = next((k for k, e in self.entries.items() if e["expires"] is not None), None)
+            if key is None:
+                break
+            self._drop(key)
+
+    def begin(self, key, fingerprint):
+        """คืน (entry, owner) — owner=True: caller ต้องทำงานแล้ว finish()"""
+        with self.lock:
+            self._purge()
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = {"fingerprint": fingerprint, "done": threading.Event(), "result": None, "size": 0, "expires": None}
+                self.entries[key] = entry
+                self.misses += 1
+                return entry, True
+            if entry["done"].is_set():
+                self.hits += 1
+            else:
+                self.coalesced += 1
+            return entry, False
+
+    def finish(self, key, entry, result):
+        with self.lock:
+            if result is None:
+                # ไม่เก็บ — ให้ตัวที่รออยู่/ที่ retry มาได้ทำใหม่
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+            elif self.entries.get(key) is not entry:
+                # ถูก purge ไประหว่างทำ — ไม่มีใครอ้างถึงไฟล์นี้แล้ว
+                os.unlink(result[0][2])
+            else:
+                entry["result"], entry["size"] = result
+                entry["expires"] = time.time() + IDEMPOTENCY_TTL
+                self.entries.move_to_end(key)
+                self.stored_bytes += entry["size"]
+                self._purge()
+        entry["done"].set()
+
+    def clear(self):
+        """ลบผลที่เก็บไว้ทั้งหมด (process กำลังจบ)"""
+        with self.lock:
+            for key in [k for k, e in self.entries.items() if e["result"] is not None]:
+                self._drop(key)
+
+    def wait(self, entry):
+        """รอผลของเจ้าของงาน — คืน False ถ้าหมดเวลาหรือมีคนรออยู่ครบ IDEMPOTENCY_MAX_WAITERS แล้ว"""
+        with self.lock:
+            if not entry["done"].is_set() and self.waiters >= IDEMPOTENCY_MAX_WAITERS:
+                self.rejected += 1
+                return False
+            self.waiters += 1
+        try:
+            return entry["done"].wait(IDEMPOTENCY_WAIT)
+        finally:
+            with self.lock:
+                self.waiters -= 1
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits,
+                    "coalesced": self.coalesced, "misses": self.misses,
+                    "rejected": self.rejected, "waiters": self.waiters, "bytes": self.stored_bytes}
+
+
+idempotency_store = IdempotencyStore()
+
+
+def discard_spooled_results():
+    """ลบไฟล์ผลของ job/Idempotency-Key ตอน process จบ — state อยู่ใน memory ของ process นี้
+    process ใหม่ดึงผลเหล่านี้ไม่ได้ ถ้าไม่ลบจะค้างใน JOB_RESULT_DIR (/tmp) ทุกครั้งที่ worker ถูก recycle"""
+    job_queue.shutdown()
+    idempotency_store.clear()
+
+
+atexit.register(discard_spooled_results)
+
+
+@app.before_request
+def idempotency_begin():
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if request.method != "POST" or not idempotency_key or request.endpoint in (None, "submit_job"):
+        return None
+    request.get_data()
+    key = (request.endpoint, idempotency_key)
+    fingerprint = request_fingerprint()
+    while True:
+        entry, owner = idempotency_store.begin(key, fingerprint)
+        if entry["fingerprint"] != fingerprint:
+            return jsonify({'error': 'Idempotency-Key was already used with a different request'}), 409
+        if owner:
+            g.idempotency = (key, entry)
+            return None
+        if not idempotency_store.wait(entry):
+            response = jsonify({'error': 'Request with this Idempotency-Key is still in progress'})
+            response.headers['Retry-After'] = '5'
+            return response, 409
+        if entry["result"] is not None:
+            try:
+                response = replay_spooled_response(entry["result"])
+            except OSError:
+                continue  # ถูก evict ไประหว่างนี้ → ลองใหม่ (ได้เป็นเจ้าของงานเอง)
+            response.headers['X-Idempotent-Replay'] = '1'
+            return response
+        # ตัวแรกล้มเหลว (5xx) → ลองเป็นเจ้าของงานเอง
+
+
+@app.after_request
+def idempotency_store_response(response):
+    pending = g.pop("idempotency", None)
+    if pending is None:
+        return response
+    key, entry = pending
+    if response.status_code >= 500:
+        idempotency_store.finish(key, entry, None)
+        return response
+    result, size = spool_response(response, prefix="idempotency-")
+    # body ถูกอ่านลงไฟล์แล้ว — ส่งให้ตัวนี้จากไฟล์ (fd ที่เปิดไว้ยังอ่านได้แม้ไฟล์ถูก evict ระหว่างส่ง)
+    if hasattr(response.response, "close"):
+        response.response.close()
+    response.response = wrap_file(request.environ, open(result[2], "rb"))
+    response.direct_passthrough = True
+    idempotency_store.finish(key, entry, (result, size))
+    return response
+
+
+@app.teardown_request
+def idempotency_release(exc):
+    # exception ที่หลุด handler (after_request ไม่ถูกเรียก) → ปล่อยตัวที่รออยู่
+    pending = g.pop("idempotency", None)
+    if pending is not None:
+        key, entry = pending
+        idempotency_store.finish(key, entry, None)
+
+
+# --- สถิติ cache ในหน่วยความจำ (ดู hit/miss ของ worker นี้) ---
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    font_info = _load_font.cache_info()
+    return jsonify({
+        'text_images': text_image_cache.stats(),
+        'compression': compression_policy.stats(),
+        'idempotency': idempotency_store.stats(),
+        'signatures': signature_image_cache.stats(),
+        'fonts': {
+            'entries': font_info.currsize,
+            'max_entries': font_info.maxsize,
+            'hits': font_info.hits,
+            'misses': font_info.misses,
+        },
+    })
+
+
+# --- โหลดของที่ใช้ร่วมกันไว้ก่อน (gunicorn preload_app: โหลดครั้งเดียวใน master แล้ว fork) ---
+# PRELOAD_FONT_SIZES: ขนาดที่ endpoint stamp/ลายเซ็นใช้บ่อย (ดูจาก cache ของ get_font หลังรันจริง)
+PRELOAD_FONT_SIZES = [int(v) for v in os.environ.get("PRELOAD_FONT_SIZES", "15,16,18,20").split(",") if v.strip()]
+
+
+def preload_resources():
+    memo_template.refresh()
+    if memo_template.raw is not None:
+        direct_memo_renderer._get_archive()
+    for name in ("THSarabunNew.ttf", "THSarabunNew Bold.ttf"):
+        font_path = os.path.abspath(os.path.join(FONTS_DIR, name))
+        if os.path.isfile(font_path):
+            _vector_font(font_path)
+            for size in PRELOAD_FONT_SIZES:
+                get_font(font_path, size)
+
+
 if __name__ == "__main__":
     # สำหรับ Railway ต้องฟังที่ 0.0.0.0
     # debug=False: ปิด auto-reloader (กัน connection drop ตอน reloader restart กลางคัน)
     #              + ปิด Werkzeug interactive debugger (อุดช่อง RCE บน prod)
-    # threaded=True: รับหลาย request พร้อมกันได้แบบเดิม โดยไม่ดัน concurrency เกินที่
-    #                LibreOffice profile lock / RAM จะรับไหว (ดูก่อนค่อยตัดสินใจขึ้น gunicorn)
+    # threaded=True: รับหลาย request พร้อมกันได้แบบเดิม — งาน LibreOffice เข้าคิวของ SofficePool
+    #                (profile แยกต่อ worker จึงไม่แย่ง lock) ขนาด pool คุม RAM ผ่าน SOFFICE_POOL_SIZE
     # local dev เปิด debug ได้ผ่าน env: FLASK_DEBUG=1 python main.py
     debug_mode = os.environ.get("FLASK_DEBUG", "0") == "1"
+    # อุ่น soffice daemon ตั้งแต่ boot (background) ให้ memo แรกไม่ต้องรอ cold start
+    threading.Thread(target=get_soffice_pool, daemon=True).start()
     app.run(debug=debug_mode, threaded=True, host="0.0.0.0", port=5000)
\ No newline at end of file
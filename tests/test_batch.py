@@ -0,0 +1,113 @@
+import email
+import io
+import json
+import os
+import zipfile
+
+import pytest
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEMO_PDF = os.path.join(ROOT, "tmp_memo.pdf")
+SIGNATURES = [{"page": 0, "x": 300, "y": 500, "lines": [{"type": "name", "text": "นายทดสอบ ระบบ"}]}]
+HOSTILE_NAME = 'a"\r\nX-Injected: 1\r\n\r\n--boundary.pdf'
+
+
+def post_batch(names, fmt=None):
+    with open(MEMO_PDF, "rb") as f:
+        pdf = f.read()
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        for name in names:
+            zf.writestr(name, pdf)
+    url = "/add_signature_v2_batch" + (f"?format={fmt}" if fmt else "")
+    return main.app.test_client().post(url, data={
+        "archive": (io.BytesIO(archive.getvalue()), "docs.zip"),
+        "signatures": json.dumps(SIGNATURES),
+    }, content_type="multipart/form-data")
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("บันทึก.pdf", "signed_003_บันทึก.pdf"),
+    ("../../etc/passwd.pdf", "signed_003_passwd.pdf"),
+    ('a"\r\nb.pdf', 'signed_003_a"b.pdf'),
+    ("\r\n", "signed_003_document-3.pdf"),
+])
+def test_batch_output_name(name, expected):
+    assert main._batch_output_name(3, name) == expected
+
+
+def test_content_disposition_keeps_unicode_and_escapes_quotes():
+    header = main._content_disposition('signed_000_บันทึก "ด่วน".pdf')
+    assert header.startswith('attachment; filename="signed_000__.pdf"; ')
+    assert "filename*=UTF-8''signed_000_%E0%B8%9A" in header
+    assert '"ด่วน"' not in header and "\r" not in header and "\n" not in header
+
+
+def test_multipart_part_headers_cannot_be_injected():
+    response = post_batch([HOSTILE_NAME, "ok.pdf"], fmt="multipart")
+    assert response.status_code == 200
+    message = email.message_from_bytes(
+        b"Content-Type: " + response.headers["Content-Type"].encode() + b"\r\n\r\n" + response.data)
+    parts = message.get_payload()
+    assert len(parts) == 2
+    for part in parts:
+        assert part["X-Injected"] is None
+        assert part["X-Status"] == "200"
+        assert part.get_filename().startswith("signed_")
+
+
+def test_zip_entry_names_are_sanitised():
+    response = post_batch([HOSTILE_NAME])
+    names = zipfile.ZipFile(io.BytesIO(response.data)).namelist()
+    assert names == ["signed_000_a\"X-Injected: 1--boundary.pdf"]
+
+
+def post_archive(entries, monkeypatch=None):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in entries:
+            zf.writestr(name, data)
+    if monkeypatch is not None:
+        refuse_reads(monkeypatch)
+    return main.app.test_client().post("/add_signature_v2_batch", data={
+        "archive": (io.BytesIO(archive.getvalue()), "docs.zip"),
+        "signatures": json.dumps(SIGNATURES),
+    }, content_type="multipart/form-data")
+
+
+def refuse_reads(monkeypatch):
+    def open_entry(*args, **kwargs):
+        raise AssertionError("archive entry read before limits were checked")
+    monkeypatch.setattr(zipfile.ZipFile, "open", open_entry)
+
+
+def test_too_many_documents_rejected_before_reading(monkeypatch):
+    monkeypatch.setattr(main, "BATCH_MAX_DOCUMENTS", 2)
+    response = post_archive([(f"{i}.pdf", b"%PDF-1.4") for i in range(3)] + [("readme.txt", b"x")], monkeypatch)
+    assert response.status_code == 400
+    assert "Too many documents (3 > 2)" in response.get_json()["error"]
+
+
+def test_oversize_entry_rejected_by_declared_size(monkeypatch):
+    # zip เล็ก แต่แตกแล้วใหญ่ — ตัดสินจาก file_size ใน header ไม่ต้องแตกจริง
+    monkeypatch.setattr(main, "BATCH_MAX_DOCUMENT_BYTES", 1024 * 1024)
+    response = post_archive([("bomb.pdf", bytes(8 * 1024 * 1024))], monkeypatch)
+    assert response.status_code == 400
+    assert "bomb.pdf is too large" in response.get_json()["error"]
+
+
+def test_total_extracted_size_is_capped(monkeypatch):
+    monkeypatch.setattr(main, "BATCH_MAX_ARCHIVE_BYTES", 3 * 1024 * 1024)
+    response = post_archive([(f"{i}.pdf", bytes(2 * 1024 * 1024)) for i in range(2)], monkeypatch)
+    assert response.status_code == 400
+    assert "too large when extracted" in response.get_json()["error"]
+
+
+def test_invalid_archive_is_a_client_error():
+    response = main.app.test_client().post("/add_signature_v2_batch", data={
+        "archive": (io.BytesIO(b"not a zip"), "docs.zip"),
+        "signatures": json.dumps(SIGNATURES),
+    }, content_type="multipart/form-data")
+    assert response.status_code == 400
@@ -0,0 +1,55 @@
+import shutil
+import subprocess
+import threading
+import time
+
+import main
+
+
+def fake_qpdf(monkeypatch, delay=0.05):
+    """qpdf ปลอม — copy input → output ช้าๆ และจด path output ที่ได้รับ"""
+    outputs = []
+
+    def run(cmd, **kwargs):
+        src, out = cmd[-2], cmd[-1]
+        outputs.append(out)
+        time.sleep(delay)
+        shutil.copyfile(src, out)
+        return subprocess.CompletedProcess(cmd, 0, b"", b"")
+
+    monkeypatch.setattr(main.subprocess, "run", run)
+    return outputs
+
+
+def test_concurrent_compress_uses_distinct_temp_files(monkeypatch, tmp_path):
+    outputs = fake_qpdf(monkeypatch)
+    pdf = tmp_path / "cached.pdf"
+    pdf.write_bytes(b"%PDF-1.7 test")
+    threads = [threading.Thread(target=main.compress_pdf_inplace, args=(str(pdf),)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(outputs)) == 4
+    assert all(out.startswith(str(tmp_path)) for out in outputs)
+    assert pdf.read_bytes() == b"%PDF-1.7 test"
+    assert [p.name for p in tmp_path.iterdir()] == ["cached.pdf"]
+
+
+def test_compress_async_runs_once_per_path(monkeypatch, tmp_path):
+    outputs = fake_qpdf(monkeypatch, delay=0.2)
+    pdf = tmp_path / "cached.pdf"
+    pdf.write_bytes(b"%PDF-1.7 test")
+    policy = main.CompressionPolicy()
+    for _ in range(3):
+        policy.compress_async("pdf", str(pdf))
+    deadline = time.time() + 5
+    while policy.in_flight and time.time() < deadline:
+        time.sleep(0.02)
+    assert len(outputs) == 1
+    assert not policy.in_flight
+    policy.compress_async("pdf", str(pdf))
+    deadline = time.time() + 5
+    while policy.in_flight and time.time() < deadline:
+        time.sleep(0.02)
+    assert len(outputs) == 2
@@ -0,0 +1,51 @@
+import io
+import os
+
+import fitz
+import pytest
+from PIL import Image
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEMO_PDF = os.path.join(ROOT, "tmp_memo.pdf")
+
+
+def image_page(rect, mode):
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_text((72, 700), "Document text", fontsize=12)
+    image = Image.effect_noise((200, 280), 80).convert(mode)
+    if mode == "RGB":
+        image = Image.merge("RGB", (image.getchannel(0), image.getchannel(1).point(lambda v: 255 - v),
+                                    image.getchannel(2)))
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    page.insert_image(rect, stream=buf.getvalue())
+    return doc
+
+
+@pytest.fixture(autouse=True)
+def auto_codec(monkeypatch):
+    monkeypatch.setattr(main, "FLATTEN_CODEC", "auto")
+
+
+def test_memo_with_garuda_logo_stays_lossless():
+    with fitz.open(MEMO_PDF) as doc:
+        assert doc[0].get_images()
+        assert main.choose_flatten_encoding(doc[0])[0] == "flate"
+
+
+def test_full_page_scan_uses_jpeg():
+    with image_page(fitz.Rect(0, 0, 595, 842), "RGB") as doc:
+        assert main.choose_flatten_encoding(doc[0])[:2] == ("jpeg", "rgb")
+
+
+def test_full_page_bilevel_scan():
+    with image_page(fitz.Rect(0, 0, 595, 842), "1") as doc:
+        assert main.choose_flatten_encoding(doc[0])[0] == "bilevel"
+
+
+def test_small_bilevel_logo_is_not_a_scan():
+    with image_page(fitz.Rect(72, 36, 132, 96), "1") as doc:
+        assert main.choose_flatten_encoding(doc[0])[0] == "flate"
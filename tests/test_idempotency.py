@@ -0,0 +1,75 @@
+import io
+import json
+import os
+import threading
+
+import pytest
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEMO_PDF = os.path.join(ROOT, "tmp_memo.pdf")
+PAYLOAD = {"page": 0, "group_name": "กลุ่มงาน", "register_no": "123", "date": "1 ม.ค. 68"}
+
+
+def form(register_no="123"):
+    with open(MEMO_PDF, "rb") as f:
+        pdf = f.read()
+    return {"pdf": (io.BytesIO(pdf), "memo.pdf"), "payload": json.dumps(dict(PAYLOAD, register_no=register_no))}
+
+
+def post(key, register_no="123"):
+    return main.app.test_client().post("/receive_num2", data=form(register_no),
+                                       content_type="multipart/form-data", headers={"Idempotency-Key": key})
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "JOB_RESULT_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "idempotency_store", main.IdempotencyStore())
+    return main.idempotency_store
+
+
+def test_replay_is_served_from_disk(store, tmp_path):
+    first = post("k1")
+    assert first.status_code == 200 and first.data.startswith(b"%PDF")
+    (entry,) = store.entries.values()
+    status, headers, path = entry["result"]
+    assert os.path.dirname(path) == str(tmp_path) and os.path.getsize(path) == len(first.data)
+    assert store.stats()["bytes"] == len(first.data)
+    again = post("k1")
+    assert again.headers["X-Idempotent-Replay"] == "1"
+    assert again.data == first.data
+
+
+def test_byte_cap_evicts_oldest(store, monkeypatch):
+    first = post("k1")
+    monkeypatch.setattr(main, "IDEMPOTENCY_MAX_BYTES", len(first.data) * 3 // 2)
+    (old_entry,) = store.entries.values()
+    post("k2", register_no="456")
+    assert list(store.entries) == [("receive_num2", "k2")]
+    assert not os.path.exists(old_entry["result"][2])
+    # k1 ถูกทิ้งแล้ว → ทำใหม่ (ไม่ใช่ replay)
+    assert "X-Idempotent-Replay" not in post("k1").headers
+
+
+def test_waiters_are_capped(store, monkeypatch):
+    monkeypatch.setattr(main, "IDEMPOTENCY_MAX_WAITERS", 1)
+    monkeypatch.setattr(main, "IDEMPOTENCY_WAIT", 5)
+    with main.app.test_request_context("/receive_num2", method="POST", data=form(),
+                                       content_type="multipart/form-data"):
+        main.request.get_data()
+        fingerprint = main.request_fingerprint()
+    # งานเดิมยังทำอยู่ + มีคนรอผลอยู่แล้ว 1 ตัว
+    entry, owner = store.begin(("receive_num2", "busy"), fingerprint)
+    assert owner
+    waiter = threading.Thread(target=store.wait, args=(entry,))
+    waiter.start()
+    while store.waiters == 0:
+        pass
+    response = post("busy")
+    assert response.status_code == 409
+    assert response.headers["Retry-After"] == "5"
+    assert store.stats()["rejected"] == 1
+    store.finish(("receive_num2", "busy"), entry, None)
+    waiter.join()
@@ -0,0 +1,100 @@
+import io
+import json
+import os
+import time
+
+import pytest
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEMO_PDF = os.path.join(ROOT, "tmp_memo.pdf")
+SIGNATURES = [{"page": 0, "x": 300, "y": 500, "lines": [{"type": "name", "text": "นายทดสอบ ระบบ"}]}]
+
+
+def submit(client, key=None):
+    with open(MEMO_PDF, "rb") as f:
+        pdf = f.read()
+    response = client.post("/jobs/add_signature_v2", data={
+        "pdf": (io.BytesIO(pdf), "memo.pdf"),
+        "signatures": json.dumps(SIGNATURES),
+    }, content_type="multipart/form-data", headers={"Idempotency-Key": key} if key else {})
+    assert response.status_code == 202
+    return response.get_json()["job_id"]
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "JOB_RESULT_DIR", str(tmp_path))
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize("wait", ["abc", "nan", "inf", "-inf"])
+def test_result_rejects_bad_wait(client, wait):
+    job_id = submit(client)
+    response = client.get(f"/jobs/{job_id}/result?wait={wait}")
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_result_negative_wait_is_clamped(client):
+    job_id = submit(client)
+    assert client.get(f"/jobs/{job_id}/result?wait=-5").status_code in (200, 202)
+
+
+def test_result_survives_download_until_deleted(client, tmp_path):
+    job_id = submit(client)
+    response = client.get(f"/jobs/{job_id}/result?wait=30")
+    assert response.status_code == 200
+    assert response.data.startswith(b"%PDF")
+    path = main.job_queue.get(job_id).result[2]
+    assert os.path.dirname(path) == str(tmp_path)
+    response.close()
+    # ดาวน์โหลดหลุด/ปิด connection แล้วดึงซ้ำได้ — ไฟล์อยู่จนหมด TTL หรือ DELETE
+    again = client.get(f"/jobs/{job_id}/result")
+    assert again.status_code == 200 and again.data == response.data
+    assert client.delete(f"/jobs/{job_id}").status_code == 204
+    assert not os.path.exists(path)
+    assert client.get(f"/jobs/{job_id}/result").status_code == 404
+    assert client.delete(f"/jobs/{job_id}").status_code == 404
+
+
+def test_resubmit_with_key_after_download_reuses_job(client):
+    first = submit(client, key="same")
+    assert main.job_queue.get(first).done.wait(30)
+    client.get(f"/jobs/{first}/result").close()
+    assert submit(client, key="same") == first
+
+
+def test_result_size_cap_evicts_oldest(client, monkeypatch):
+    for job in list(main.job_queue.jobs.values()):
+        assert job.done.wait(30)
+    first = submit(client)
+    assert main.job_queue.get(first).done.wait(30)
+    monkeypatch.setattr(main, "JOB_RESULT_MAX_BYTES", main.job_queue.get(first).result_size)
+    second = submit(client)
+    assert main.job_queue.get(second).done.wait(30)
+    deadline = time.time() + 5
+    while main.job_queue.get(first) is not None and time.time() < deadline:
+        time.sleep(0.05)
+    assert main.job_queue.get(first) is None
+    assert os.path.exists(main.job_queue.get(second).result[2])
+    assert client.get(f"/jobs/{second}/result").status_code == 200
+
+
+def test_shutdown_discards_results_and_refuses_new_jobs(client, monkeypatch):
+    monkeypatch.setattr(main, "job_queue", main.JobQueue())
+    monkeypatch.setattr(main, "idempotency_store", main.IdempotencyStore())
+    job_id = submit(client)
+    job = main.job_queue.get(job_id)
+    assert job.done.wait(30)
+    path = job.result[2]
+    main.discard_spooled_results()
+    assert not os.path.exists(path)
+    assert client.get(f"/jobs/{job_id}").status_code == 404
+    with open(MEMO_PDF, "rb") as f:
+        response = client.post("/jobs/add_signature_v2", data={
+            "pdf": (io.BytesIO(f.read()), "memo.pdf"), "signatures": json.dumps(SIGNATURES),
+        }, content_type="multipart/form-data")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
@@ -0,0 +1,151 @@
+"""visual diff ของ renderer ตรง (fitz.Story) เทียบ LibreOffice
+
+- tmp_memo.pdf: memo ที่ export จาก template รุ่นก่อน (มีแถว "สิ่งที่แนบมาด้วย", เบอร์โทร/footer ต่างจาก
+  memo-template2.docx) จึงเทียบได้เฉพาะส่วนที่สองรุ่นใช้ร่วมกัน: ขนาดหน้า, ครุฑ, คอลัมน์ของหัวข้อ
+- เทียบทั้งหน้ากับ LibreOffice จริง (render template ปัจจุบันด้วย payload เดียวกัน) เมื่อเครื่องมี soffice
+"""
+import os
+import shutil
+
+import fitz
+import pytest
+from PIL import Image, ImageChops, ImageFilter, ImageStat
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REFERENCE_PDF = os.path.join(ROOT, "tmp_memo.pdf")
+
+# เนื้อหาเดียวกับ tmp_memo.docx / tmp_memo.pdf
+REFERENCE_PAYLOAD = {
+    "doc_number": "",
+    "date": "๔ กรกฎาคม ๒๕๖๗",
+    "subject": "",
+    "introduction_lines": [],
+    "fact_lines": ["ข้าพเจ้า นายสมชาย ใจดี ตำแหน่ง หัวหน้ากลุ่มงาน"],
+    "proposal_lines": [],
+}
+
+LONG_PAYLOAD = {
+    "doc_number": "๑๒๓",
+    "date": "๑ มกราคม ๒๕๖๘",
+    "subject": "ขออนุมัติเดินทางไปราชการ",
+    "introduction_lines": main.process_text_with_markers(
+        "ด้วยศูนย์การศึกษาพิเศษ เขตการศึกษา ๖ จังหวัดลพบุรี ได้รับหนังสือแจ้งให้เข้าร่วมประชุมเชิงปฏิบัติการ"
+        "!!เพื่อพัฒนาหลักสูตรสถานศึกษาสำหรับเด็กที่มีความต้องการจำเป็นพิเศษ ณ กรุงเทพมหานคร"),
+    "fact_lines": main.process_text_with_markers("ข้าพเจ้า นายสมชาย ใจดี ตำแหน่ง หัวหน้ากลุ่มงาน" * 3),
+    "proposal_lines": main.process_text_with_markers("จึงเรียนมาเพื่อโปรดพิจารณาอนุมัติ" * 40),
+}
+
+# หัวข้อที่อยู่ในตารางเดียวกันทั้งสองรุ่น — ตำแหน่งคอลัมน์ (x) ต้องตรงกัน
+HEADER_LABELS = ["ที่", "วันที่", "เรื่อง"]
+
+
+def render_gray(page, clip=None, dpi=50):
+    pix = page.get_pixmap(dpi=dpi, clip=clip, colorspace=fitz.csGRAY)
+    return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+
+def visual_diff(page_a, page_b, clip=None):
+    """(ค่าเฉลี่ยความต่าง 0-255, สัดส่วน pixel ที่ต่างชัด) หลัง blur — ทน anti-aliasing/ขยับไม่ถึง 1 pt"""
+    a = render_gray(page_a, clip).filter(ImageFilter.GaussianBlur(1.5))
+    b = render_gray(page_b, clip).filter(ImageFilter.GaussianBlur(1.5))
+    if a.size != b.size:
+        b = b.resize(a.size)
+    diff = ImageChops.difference(a, b)
+    changed = sum(diff.point(lambda v: 255 if v > 64 else 0).histogram()[255:])
+    return ImageStat.Stat(diff).mean[0], changed / (diff.width * diff.height)
+
+
+def label_rect(page, label):
+    return min(page.search_for(label), key=lambda r: (r.y0, r.x0))
+
+
+@pytest.fixture(scope="module")
+def direct_reference():
+    return main.direct_memo_renderer.render(dict(REFERENCE_PAYLOAD))
+
+
+def test_page_size_matches_reference(direct_reference):
+    reference = fitz.open(REFERENCE_PDF)
+    assert len(direct_reference) == len(reference) == 1
+    assert direct_reference[0].rect.width == pytest.approx(reference[0].rect.width, abs=1)
+    assert direct_reference[0].rect.height == pytest.approx(reference[0].rect.height, abs=1)
+
+
+def test_garuda_matches_reference(direct_reference):
+    reference = fitz.open(REFERENCE_PDF)
+    (ours,) = direct_reference[0].get_image_info()
+    (theirs,) = reference[0].get_image_info()
+    assert tuple(ours["bbox"]) == pytest.approx(tuple(theirs["bbox"]), abs=0.5)
+    mean, changed = visual_diff(direct_reference[0], reference[0], clip=fitz.Rect(70, 30, 130, 85))
+    assert mean < 4 and changed < 0.01
+
+
+def test_header_columns_match_reference(direct_reference):
+    reference = fitz.open(REFERENCE_PDF)
+    ours = [label_rect(direct_reference[0], label) for label in HEADER_LABELS]
+    theirs = [label_rect(reference[0], label) for label in HEADER_LABELS]
+    for label, a, b in zip(HEADER_LABELS, ours, theirs):
+        assert a.x0 == pytest.approx(b.x0, abs=1.5), label
+    # ลำดับแถวเหมือนกัน (ที่/วันที่ อยู่แถวเดียวกัน เหนือ เรื่อง)
+    assert ours[0].y0 == pytest.approx(ours[1].y0, abs=1)
+    assert ours[2].y0 > ours[0].y0 + 10
+
+
+def soffice_available():
+    return bool(shutil.which("soffice") or shutil.which("libreoffice"))
+
+
+@pytest.mark.skipif(not soffice_available(), reason="LibreOffice (soffice) not installed")
+@pytest.mark.parametrize("payload", [REFERENCE_PAYLOAD, LONG_PAYLOAD], ids=["reference", "long"])
+def test_direct_matches_libreoffice(payload):
+    assert main.memo_template.refresh()
+    libreoffice, used = main.render_memo_pdf(dict(payload), "libreoffice")
+    assert used == "libreoffice"
+    direct = main.direct_memo_renderer.render(dict(payload))
+    assert len(direct) == len(libreoffice)
+    for ours, theirs in zip(direct, libreoffice):
+        mean, changed = visual_diff(ours, theirs)
+        assert mean < 6 and changed < 0.03, (ours.number, mean, changed)
+    for label in HEADER_LABELS:
+        a, b = label_rect(direct[0], label), label_rect(libreoffice[0], label)
+        assert (a.x0, a.y0) == pytest.approx((b.x0, b.y0), abs=3), label
+
+
+def test_fallback_reports_libreoffice(monkeypatch, tmp_path):
+    def broken(data):
+        raise RuntimeError("story failed")
+
+    monkeypatch.setattr(main.direct_memo_renderer, "render", broken)
+    monkeypatch.setattr(main, "convert_docx_to_pdf", lambda docx, out: shutil.copy(REFERENCE_PDF, out))
+    monkeypatch.setattr(main, "render_cache", main.RenderCache(cache_dir=str(tmp_path)))
+    payload = {"date": "๔ กรกฎาคม ๒๕๖๗", "subject": "ทดสอบ fallback", "introduction": "ก",
+               "author_name": "ข", "author_position": "ค", "fact": "ง", "proposal": "จ"}
+    client = main.app.test_client()
+
+    first = client.post("/pdf?renderer=direct", json=payload)
+    assert first.status_code == 200
+    assert first.headers["X-Memo-Renderer"] == "libreoffice"
+    assert first.headers["X-Render-Cache"] == "miss"
+    # ผล LibreOffice เก็บใต้ key ของ libreoffice — request direct ครั้งถัดไปไม่ได้ผลนั้นกลับมาในชื่อ direct
+    again = client.post("/pdf?renderer=direct", json=payload)
+    assert again.headers["X-Render-Cache"] == "miss"
+    assert again.headers["X-Memo-Renderer"] == "libreoffice"
+    cached = client.post("/pdf?renderer=libreoffice", json=payload)
+    assert cached.headers["X-Render-Cache"] == "hit"
+    assert cached.headers["X-Memo-Renderer"] == "libreoffice"
+
+
+def test_cache_hit_survives_eviction(tmp_path):
+    cache = main.RenderCache(cache_dir=str(tmp_path))
+    cache.put("a" * 64, b"%PDF-1.7 cached")
+    cached = cache.get("a" * 64)
+    assert cached is not None
+    # put อื่นที่ evict ไฟล์นี้ระหว่างที่ request ยังไม่ได้ส่ง
+    cache.max_bytes = 0
+    cache.put("b" * 64, b"%PDF-1.7 other")
+    assert not os.path.exists(cache.path("a" * 64))
+    with cached:
+        assert cached.read() == b"%PDF-1.7 cached"
+    assert cache.get("a" * 64) is None
@@ -0,0 +1,57 @@
+import io
+import json
+
+import fitz
+import pytest
+
+import main
+
+
+def make_pdf(pages, tag):
+    doc = fitz.open()
+    for i in range(pages):
+        doc.new_page().insert_text((72, 72), f"{tag} {i}")
+    return doc.tobytes()
+
+
+def post_merge(files, ranges=None):
+    data = {"pdf": [(io.BytesIO(pdf), name) for name, pdf in files]}
+    if ranges is not None:
+        data["ranges"] = json.dumps(ranges)
+    return main.app.test_client().post("/PDFmerge", data=data, content_type="multipart/form-data")
+
+
+def page_labels(response):
+    return [page.get_text().strip() for page in fitz.open(stream=response.data)]
+
+
+FILES = [("a.pdf", make_pdf(3, "a")), ("b.pdf", make_pdf(2, "b"))]
+
+
+@pytest.mark.parametrize("spec, expected", [
+    (None, [(0, 4)]),
+    ([[0, 1], 2, -1], [(0, 2), (4, 4)]),
+    ([[3, 1]], [(3, 1)]),
+])
+def test_parse_page_ranges(spec, expected):
+    assert main.parse_page_ranges(spec, 5) == expected
+
+
+@pytest.mark.parametrize("spec", [[], [[]], [True], [[0, False]], [[0, 1, 2]], [5], ["1"], 0, "0-2"])
+def test_parse_page_ranges_rejects(spec):
+    with pytest.raises(ValueError):
+        main.parse_page_ranges(spec, 5)
+
+
+def test_merge_with_ranges():
+    response = post_merge(FILES, [[-1], None])
+    assert response.status_code == 200
+    assert page_labels(response) == ["a 2", "b 0", "b 1"]
+    assert response.headers["X-Merge-Pages"] == "3"
+
+
+@pytest.mark.parametrize("ranges", [[[]], [[], []], [[True], None], {"c.pdf": [0]}, "0"])
+def test_merge_bad_ranges_are_client_errors(ranges):
+    response = post_merge(FILES, ranges)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
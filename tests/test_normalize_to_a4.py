@@ -0,0 +1,67 @@
+import os
+
+import fitz
+import pytest
+
+import main
+
+MEMO_PDF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tmp_memo.pdf")
+
+
+def letter_doc():
+    doc = fitz.open()
+    doc.insert_pdf(fitz.open(MEMO_PDF), to_page=0)
+    page = doc[0]
+    page.set_mediabox(fitz.Rect(0, 0, 612, 792))
+    page.insert_text((40, 60), "top-left marker", fontsize=20)
+    return doc
+
+
+def set_parent_rotate(doc, rotation):
+    parent = doc.xref_get_key(doc[0].xref, "Parent")[1]
+    doc.xref_set_key(int(parent.split()[0]), "Rotate", str(rotation))
+
+
+def marker_rect(pdf_bytes):
+    page = fitz.open(stream=pdf_bytes)[0]
+    return page, page.search_for("top-left marker")[0]
+
+
+@pytest.mark.parametrize("how", ["explicit", "inherited"])
+def test_rotated_page_becomes_upright_a4(how):
+    doc = letter_doc()
+    if how == "explicit":
+        doc[0].set_rotation(90)
+    else:
+        set_parent_rotate(doc, 90)
+    source = fitz.open(stream=doc.tobytes())
+    assert source[0].rotation == 90
+    # search_for คืนพิกัดก่อนหมุน — แปลงเป็นตำแหน่งที่ผู้ใช้เห็นบนหน้า
+    visual = source[0].search_for("top-left marker")[0] * source[0].rotation_matrix
+
+    out = main.normalize_to_a4(source)
+    page, rect = marker_rect(out.tobytes())
+
+    assert page.rotation == 0
+    assert (round(page.rect.width), round(page.rect.height)) == (595, 842)
+    # เนื้อหาวางตาม visual เดิม (ที่ผู้ใช้เห็น) ย่อ/ขยายพอดีหน้า A4
+    scale = min(main.A4_WIDTH_PT / 792, main.A4_HEIGHT_PT / 612)
+    oy = (main.A4_HEIGHT_PT - 612 * scale) / 2
+    assert rect.x0 == pytest.approx(visual.x0 * scale, abs=2)
+    assert rect.y0 == pytest.approx(oy + visual.y0 * scale, abs=2)
+
+
+def test_unrotated_letter_page_is_scaled_to_a4():
+    doc = letter_doc()
+    out = main.normalize_to_a4(fitz.open(stream=doc.tobytes()))
+    page, rect = marker_rect(out.tobytes())
+    assert page.rotation == 0
+    assert (round(page.rect.width), round(page.rect.height)) == (595, 842)
+    assert rect.y0 < page.rect.height / 2
+
+
+def test_a4_pages_are_left_untouched():
+    source = fitz.open(MEMO_PDF)
+    contents = source[0].get_contents()
+    out = main.normalize_to_a4(source)
+    assert out[0].get_contents() == contents
@@ -0,0 +1,48 @@
+import io
+import json
+
+import fitz
+import pytest
+
+import main
+
+SIGNATURES = [{"page": 0, "x": 200, "y": 200, "lines": [{"type": "name", "text": "นายทดสอบ ระบบ"}]}]
+
+
+def covered_pdf(cover):
+    """A4 ที่มี annotation สี่เหลี่ยมทึบทับช่วง cover (พิกัดหน้า, y ลงล่าง)"""
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_text((72, 72), "memo")
+    annot = page.add_rect_annot(fitz.Rect(cover))
+    annot.set_colors(stroke=(0, 0, 0), fill=(0.2, 0.2, 0.2))
+    annot.update()
+    return doc.tobytes()
+
+
+def sign(pdf):
+    return main.app.test_client().post("/add_signature_v2", data={
+        "pdf": (io.BytesIO(pdf), "memo.pdf"),
+        "signatures": json.dumps(SIGNATURES),
+    }, content_type="multipart/form-data")
+
+
+@pytest.fixture(autouse=True)
+def auto_flatten(monkeypatch):
+    monkeypatch.setattr(main, "SIGNATURE_FLATTEN", "auto")
+
+
+def test_probe_checks_where_flipped_signature_lands():
+    # y=200 แบบ flip ลงที่ราว y 640-700 ของหน้า — annotation ทับช่วงนั้น ไม่ใช่ที่ y=200
+    response = sign(covered_pdf((0, 600, 595, 800)))
+    assert response.status_code == 200
+    assert response.headers["X-Page-Overlay"].startswith("0:flatten-hidden:")
+    page = fitz.open(stream=response.data)[0]
+    # annotation ถูก render ลงภาพหน้าแล้ว ลายเซ็นอยู่บนสุด
+    assert not list(page.annots())
+
+
+def test_probe_ignores_cover_at_raw_client_point():
+    response = sign(covered_pdf((150, 150, 300, 300)))
+    assert response.status_code == 200
+    assert response.headers["X-Page-Overlay"] == "0:direct"
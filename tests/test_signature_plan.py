@@ -0,0 +1,54 @@
+import io
+import os
+
+import fitz
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEMO_PDF = os.path.join(ROOT, "tmp_memo.pdf")
+FONT = os.path.join(ROOT, "fonts", "THSarabunNew.ttf")
+
+SIGNATURES = [
+    # กลุ่มที่มี lines + sig แบบเก่าปนอยู่ (branch "lines" และ "fallback")
+    # type/file_key ใช้เมื่อ layout ไม่รองรับ lines (/add_signature)
+    {"page": 0, "x": 300, "y": 500, "rotation": 90, "type": "image", "file_key": "sig_a",
+     "lines": [{"type": "image", "file_key": "sig_a"}, {"type": "name", "text": "ก"}]},
+    {"page": 0, "x": 300, "y": 500, "type": "image", "file_key": "sig_b"},
+    # กลุ่มแบบเก่าล้วน (branch "sorted")
+    {"page": 0, "x": 100, "y": 200, "rotation": 270, "type": "image", "file_key": "sig_c"},
+    {"page": 0, "x": 100, "y": 200, "type": "text", "text": "ข"},
+]
+
+
+def png():
+    buf = io.BytesIO()
+    Image.new("RGBA", (200, 80), (0, 0, 255, 255)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("layout", [
+    main.ADD_SIGNATURE_LAYOUT, main.ADD_SIGNATURE_V2_LAYOUT,
+    main.SIGNATURE_RECEIVE_LAYOUT, main.MEMO_2IN1_LAYOUT,
+], ids=["add_signature", "v2", "receive", "2in1"])
+def test_prefetch_matches_compiled_requests(layout, monkeypatch):
+    data = png()
+    files = {key: FileStorage(io.BytesIO(data), f"{key}.png") for key in ("sig_a", "sig_b", "sig_c")}
+    images = main.SignatureImages(files)
+    requested = []
+    real_get = main.SignatureImages.get
+
+    def get(self, file_key, height, rotation=0):
+        requested.append((file_key, height, rotation))
+        return real_get(self, file_key, height, rotation)
+
+    monkeypatch.setattr(main.SignatureImages, "get", get)
+    main.compile_signature_plan(SIGNATURES, layout, fitz.open(MEMO_PDF), images, FONT)
+
+    groups, _ = main.group_signatures(SIGNATURES, layout)
+    planned = [(key, layout.signature_height, rotation)
+               for key, rotation in main.planned_signature_images(groups, layout)]
+    assert sorted(planned) == sorted(requested)
@@ -0,0 +1,72 @@
+import io
+import os
+
+import fitz
+from werkzeug.test import EnvironBuilder
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEMO_PDF = os.path.join(ROOT, "tmp_memo.pdf")
+
+
+def big_pdf():
+    doc = fitz.open()
+    page = doc.new_page()
+    # ภาพ noise ไม่บีบอัด → ไฟล์เกิน UPLOAD_SPOOL_MAX_BYTES
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 700, 700), False)
+    pix.set_rect(pix.irect, (200, 10, 10))
+    page.insert_image(page.rect, pixmap=pix)
+    data = doc.tobytes()
+    assert len(data) > main.UPLOAD_SPOOL_MAX_BYTES
+    return data
+
+
+def parse(data):
+    builder = EnvironBuilder(method="POST", data=data, content_type="multipart/form-data")
+    request = main.SpooledUploadRequest(builder.get_environ())
+    return request, request.files
+
+
+def spooled_path(upload):
+    path = getattr(upload.stream, "name", None)
+    return path if isinstance(path, str) and os.path.isfile(path) else None
+
+
+def test_small_parts_of_large_request_stay_in_memory():
+    scan = big_pdf()
+    signature = b"\x89PNG\r\n\x1a\n" + b"0" * 1000
+    request, files = parse({"pdf": (io.BytesIO(scan), "scan.pdf"), "sig": (io.BytesIO(signature), "sig.png")})
+    try:
+        pdf_path = spooled_path(files["pdf"])
+        assert pdf_path and pdf_path.endswith(".pdf")
+        assert spooled_path(files["sig"]) is None
+        assert files["sig"].read() == signature
+        doc = main.open_upload_pdf(files["pdf"])
+        assert doc.name == pdf_path and len(doc) == 1
+        doc.close()
+    finally:
+        request.close()
+    assert not os.path.exists(pdf_path)
+
+
+def test_large_non_pdf_part_keeps_its_extension():
+    request, files = parse({"archive": (io.BytesIO(os.urandom(main.UPLOAD_SPOOL_MAX_BYTES + 1)), "docs.zip"),
+                            "odd": (io.BytesIO(os.urandom(main.UPLOAD_SPOOL_MAX_BYTES + 1)), 'x."/../y')})
+    try:
+        assert spooled_path(files["archive"]).endswith(".zip")
+        assert os.path.basename(spooled_path(files["odd"])).startswith("upload-")
+        assert "." not in os.path.basename(spooled_path(files["odd"]))
+    finally:
+        request.close()
+
+
+def test_small_request_opens_from_memory():
+    with open(MEMO_PDF, "rb") as f:
+        memo = f.read()
+    request, files = parse({"pdf": (io.BytesIO(memo), "memo.pdf")})
+    try:
+        assert spooled_path(files["pdf"]) is None
+        assert len(main.open_upload_pdf(files["pdf"])) == 1
+    finally:
+        request.close()
@@ -0,0 +1,35 @@
+import io
+import json
+
+import fitz
+import pytest
+
+import main
+
+PAYLOAD = {"page": 0, "group_name": "กลุ่มงาน", "register_no": "123", "date": "1 ม.ค. 68"}
+
+
+def receive_num2(rotation, mode):
+    doc = fitz.open()
+    doc.new_page(width=595, height=842).set_rotation(rotation)
+    response = main.app.test_client().post(f"/receive_num2?text_mode={mode}", data={
+        "pdf": (io.BytesIO(doc.tobytes()), "memo.pdf"),
+        "payload": json.dumps(PAYLOAD),
+    }, content_type="multipart/form-data")
+    assert response.status_code == 200
+    return fitz.open(stream=response.data)[0]
+
+
+def ink(page):
+    pix = page.get_pixmap(dpi=72, colorspace=fitz.csGRAY)
+    return sum(1 for v in pix.samples if v < 200)
+
+
+@pytest.mark.parametrize("rotation", [0, 90, 180, 270])
+def test_vector_stamp_text_survives_page_rotation(rotation):
+    image = receive_num2(rotation, "image")
+    vector = receive_num2(rotation, "vector")
+    # ตัวอักษรต้องไม่หาย (กรอบอย่างเดียวได้ ink ราว 3/4 ของทั้งตรา)
+    assert ink(vector) == pytest.approx(ink(image), rel=0.05)
+    if rotation in (0, 180):
+        assert "เลขรับ ๑๒๓" in vector.get_text()